@@ -0,0 +1,431 @@
+import base64
+import bisect
+import collections
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+# Local stand-ins for the APIs the script talks to: the ServiceNow Table and
+# Batch APIs, the Cisco OAuth token, Support (warranty) and EOX APIs, and the
+# Dell TechDirect token and warranty APIs. They serve a generated CMDB and
+# deterministic vendor answers, with configurable latency, errors and
+# throttling, so a run can be measured without touching live services.
+
+# Manufacturers of the generated CIs, and how often each one shows up.
+MANUFACTURERS = ['Cisco Systems', 'Meraki', 'Dell Inc.', 'HP']
+MANUFACTURER_WEIGHTS = [40, 10, 35, 15]
+
+# The paths each mock API answers at, as used in the generated config.
+CISCO_TOKEN_PATH = '/cisco/oauth2/token'
+CISCO_WARRANTY_PATH = '/sn2info/v2/coverage/summary/serial_numbers/'
+CISCO_EOX_SN_PATH = '/supporttools/eox/rest/5/EOXBySerialNumber/1/'
+CISCO_EOX_PID_PATH = '/supporttools/eox/rest/5/EOXByProductID/1/'
+DELL_TOKEN_PATH = '/dell/auth/oauth/v2/token'
+DELL_WARRANTY_PATH = '/dell/warranty'
+SNOW_TABLE_PATH = '/api/now/table/'
+SNOW_BATCH_PATH = '/api/now/v1/batch'
+
+# One ServiceNow query term: a field, an operator and a value.
+QUERY_TERM = re.compile(r'([a-z_.]+?)(LIKE|IN|>=|<=|!=|>|<|=)(.*)')
+
+
+# A generated CMDB table of the given number of CIs. The CIs are kept in
+# compact columns, in sys_id order, and only the fields written back to are
+# kept per CI.
+class MockCmdb:
+    def __init__(self, size: int, seed: int = 1):
+        rnd = random.Random(seed)
+        self.size = size
+        self.manufacturers = rnd.choices(range(len(MANUFACTURERS)),
+                                         MANUFACTURER_WEIGHTS, k=size)
+        self.serials = []
+        self.asset_tags = {}
+        for index, manufacturer in enumerate(self.manufacturers):
+            if MANUFACTURERS[manufacturer].startswith('Dell'):
+                serial = ''.join(rnd.choices('BCDFGHJKLMNPQRSTVWXYZ0123456789',
+                                             k=7))
+            else:
+                serial = 'FOC' + ''.join(rnd.choices('0123456789ABCDEF', k=8))
+
+            # Some S/Ns were put in the asset tag field, and some are junk.
+            chance = rnd.random()
+            if chance < 0.05:
+                self.asset_tags[index] = serial
+                serial = ''
+            elif chance < 0.07:
+                serial = 'N/A ' + serial[:3]
+            self.serials.append(serial)
+        self.updates = collections.defaultdict(dict)
+        self.serial_index = None
+        self.results = {}
+        self.lock = threading.Lock()
+
+    # Return the sys_id of the CI at the given index.
+    @staticmethod
+    def sys_id(index: int) -> str:
+        return '%032x' % index
+
+    # Return the index of the CI with the given sys_id, or None if there is
+    # no such CI.
+    def index(self, sys_id: str) -> int:
+        try:
+            index = int(sys_id, 16)
+        except ValueError:
+            return None
+        return index if 0 <= index < self.size else None
+
+    # Return the value of the given field of the CI at the given index.
+    def get(self, index: int, field: str) -> str:
+        updates = self.updates.get(index)
+        if updates is not None and field in updates:
+            return updates[field]
+        if field == 'sys_id':
+            return self.sys_id(index)
+        if field == 'name':
+            return 'ci%07d' % index
+        if field == 'serial_number':
+            return self.serials[index]
+        if field == 'asset_tag':
+            return self.asset_tags.get(index, '')
+        if field in ('manufacturer', 'manufacturer.name'):
+            return MANUFACTURERS[self.manufacturers[index]]
+        if field == 'sys_updated_on':
+            return '2022-01-01 00:00:00'
+        return ''
+
+    # Return the CI at the given index with the given fields.
+    def record(self, index: int, fields: list[str]) -> dict[str, str]:
+        return {field: self.get(index, field) for field in fields}
+
+    # Write the given field updates to the CI at the given index.
+    def update(self, index: int, fields: dict[str, str]):
+        with self.lock:
+            self.updates[index].update(
+                fields, sys_updated_on=time.strftime('%Y-%m-%d %H:%M:%S',
+                                                     time.gmtime()))
+
+    # Return the sorted indexes of the CIs matching the given query, which
+    # has no sys_id term. The result of a query is reused for its later
+    # pages, and worked out again when its first page is asked for.
+    def match(self, query: str, first_page: bool) -> list[int]:
+        with self.lock:
+            if not first_page and query in self.results:
+                return self.results[query]
+        clauses = parse_query(query)
+
+        # Use the S/N index for 'serial_numberIN' queries instead of going
+        # through every CI.
+        candidates = range(self.size)
+        for clause in clauses:
+            if len(clause) == 1 and clause[0][:2] == ('serial_number', 'IN'):
+                candidates = sorted(self.find_serials(clause[0][2]))
+                break
+        result = [index for index in candidates
+                  if all(any(match_term(self.get(index, field), op, value)
+                             for field, op, value in clause)
+                         for clause in clauses)]
+        with self.lock:
+            self.results[query] = result
+        return result
+
+    # Return the indexes of the CIs with any of the given comma separated
+    # S/Ns.
+    def find_serials(self, serials: str) -> set[int]:
+        with self.lock:
+            if self.serial_index is None:
+                self.serial_index = collections.defaultdict(list)
+                for index, serial in enumerate(self.serials):
+                    self.serial_index[serial].append(index)
+        found = set()
+        for serial in serials.split(','):
+            found.update(self.serial_index.get(serial, []))
+        return found
+
+
+# Split the given ServiceNow encoded query into clauses that must all match,
+# each a list of (field, operator, value) terms of which one must match.
+# Ordering terms are left out.
+def parse_query(query: str) -> list[list[tuple]]:
+    clauses = []
+    for term in query.split('^'):
+        if not term or term.startswith('ORDERBY') or term == 'EQ':
+            continue
+        is_or = term.startswith('OR')
+        if is_or:
+            term = term[2:]
+        field, op, value = QUERY_TERM.match(term).groups()
+        if is_or and clauses:
+            clauses[-1].append((field, op, value))
+        else:
+            clauses.append([(field, op, value)])
+    return clauses
+
+
+# Return whether the given field value matches the given operator and value.
+def match_term(field_value: str, op: str, value: str) -> bool:
+    if op == 'LIKE':
+        return value.lower() in field_value.lower()
+    if op == 'IN':
+        return field_value in value.split(',')
+    if op == '>=':
+        return field_value >= value
+    if op == '<=':
+        return field_value <= value
+    if op == '>':
+        return field_value > value
+    if op == '<':
+        return field_value < value
+    if op == '!=':
+        return field_value != value
+    return field_value == value
+
+
+# Return a stable number for the given string, the same in every process.
+def stable_hash(value: str) -> int:
+    return zlib.crc32(value.encode())
+
+
+# Return the Cisco warranty summary for the given S/N. About one in ten is
+# not found.
+def get_cisco_warranty(serial: str) -> dict:
+    seed = stable_hash(serial) % 10
+    if seed == 0:
+        return {'sr_no': serial,
+                'ErrorResponse': {'APIError': {'ErrorCode': 'SNNotFound'}}}
+    product_id = 'PID%d' % (seed % 3)
+    return {'sr_no': serial,
+            'warranty_end_date': '' if seed == 1 else
+            '2027-01-%02d' % (seed + 1),
+            'is_covered': 'YES' if seed % 2 else 'NO',
+            'base_pid_list': [{'base_pid': product_id}],
+            'orderable_pid_list': [{'orderable_pid': product_id}]}
+
+
+# Return the Cisco EOX record for the given S/N or product ID. About one in
+# four has no end-of-life date.
+def get_cisco_eox(value: str, by_product_id: bool) -> dict:
+    seed = stable_hash(value) % 4
+    return {'EOXInputValue': value,
+            'EOLProductID': value if by_product_id else 'PID%d' % seed,
+            'LastDateOfSupport': {
+                'value': '' if seed == 0 else '2031-0%d-01' % seed}}
+
+
+# Return the Dell warranty for the given service tag. About one in five is
+# not found.
+def get_dell_warranty(service_tag: str) -> dict:
+    seed = stable_hash(service_tag) % 5
+    if seed == 0:
+        return {'id': None, 'serviceTag': service_tag, 'entitlements': []}
+    return {'id': seed, 'serviceTag': service_tag,
+            'entitlements': [] if seed == 1 else
+            [{'endDate': '2027-0%d-01T00:00:00Z' % seed}]}
+
+
+# Return the name of the API the given request path belongs to, used to
+# break counts and latencies down.
+def get_api_name(method: str, path: str) -> str:
+    if path.startswith(SNOW_BATCH_PATH):
+        return 'snow-batch'
+    if path.startswith(SNOW_TABLE_PATH):
+        return 'snow-read' if method == 'GET' else 'snow-write'
+    if path.startswith(CISCO_TOKEN_PATH) or path.startswith(DELL_TOKEN_PATH):
+        return 'token'
+    if path.startswith(CISCO_WARRANTY_PATH):
+        return 'cisco-warranty'
+    if path.startswith(CISCO_EOX_SN_PATH) or \
+       path.startswith(CISCO_EOX_PID_PATH):
+        return 'cisco-eox'
+    if path.startswith(DELL_WARRANTY_PATH):
+        return 'dell-warranty'
+    return 'other'
+
+
+# Serves every mock API from one HTTP server. Requests are counted by API,
+# and can be slowed down, failed with a 500 or throttled with a 429 at the
+# given rates. The listen backlog is deep enough for every connection the
+# asyncio engine opens at once, so none of them is refused.
+class MockServices(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, cmdb: MockCmdb, latency: float = 0,
+                 error_rate: float = 0, throttle_rate: float = 0,
+                 retry_after: float = 1, seed: int = 1):
+        super().__init__(('127.0.0.1', 0), MockHandler)
+        self.cmdb = cmdb
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.rejected = collections.Counter()
+        self.lock = threading.Lock()
+
+    # Return the base URL the mock APIs are served at.
+    @property
+    def base_url(self) -> str:
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    # Start serving in the background.
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    # Count a request to the given API, and return the status code to fail
+    # it with, if any.
+    def admit(self, api_name: str) -> int:
+        with self.lock:
+            self.calls[api_name] += 1
+            chance = self.random.random()
+        if api_name == 'token':
+            return None
+        if chance < self.error_rate:
+            status_code = 500
+        elif chance < self.error_rate + self.throttle_rate:
+            status_code = 429
+        else:
+            return None
+        with self.lock:
+            self.rejected[api_name] += 1
+        return status_code
+
+
+# Answers one request to a mock API.
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: MockServices
+
+    # Keep the benchmark output clean.
+    def log_message(self, *args):
+        pass
+
+    # Send the given object as a JSON response with the given status code
+    # and extra headers.
+    def send_json(self, status_code: int, body, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Return the request body, if any.
+    def read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    # Answer a request with any method.
+    def handle_request(self):
+        url = urlparse(self.path)
+        params = {key: values[0]
+                  for key, values in parse_qs(url.query).items()}
+        body = self.read_body()
+        api_name = get_api_name(self.command, url.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status_code = self.server.admit(api_name)
+        if status_code == 429:
+            self.send_json(429, {'error': 'Too many requests'},
+                           {'Retry-After': str(self.server.retry_after)})
+            return
+        if status_code:
+            self.send_json(status_code, {'error': 'Internal server error'})
+            return
+
+        if api_name == 'token':
+            self.send_json(200, {'access_token': 'mock-token',
+                                 'token_type': 'Bearer',
+                                 'expires_in': 3600})
+        elif api_name == 'snow-read':
+            self.send_json(200, {'result': self.read_table(params)})
+        elif api_name == 'snow-write':
+            self.write_table(url.path, body)
+        elif api_name == 'snow-batch':
+            self.send_json(200, self.run_batch(json.loads(body)))
+        elif api_name == 'cisco-warranty':
+            serials = unquote(url.path[len(CISCO_WARRANTY_PATH):])
+            self.send_json(200, {'serial_numbers': [
+                get_cisco_warranty(serial)
+                for serial in serials.split(',')]})
+        elif api_name == 'cisco-eox':
+            by_product_id = url.path.startswith(CISCO_EOX_PID_PATH)
+            values = unquote(url.path.rsplit('/', 1)[1])
+            self.send_json(200, {'EOXRecord': [
+                get_cisco_eox(value, by_product_id)
+                for value in values.split(',')]})
+        elif api_name == 'dell-warranty':
+            self.send_json(200, [
+                get_dell_warranty(service_tag)
+                for service_tag in params.get('servicetags', '').split(',')])
+        else:
+            self.send_json(404, {'error': 'Not found: ' + url.path})
+
+    do_GET = do_POST = do_PATCH = do_PUT = handle_request
+
+    # Return the page of CIs the given Table API parameters ask for.
+    def read_table(self, params: dict[str, str]) -> list[dict]:
+        cmdb = self.server.cmdb
+        query = params.get('sysparm_query', '')
+        offset = int(params.get('sysparm_offset', 0))
+        limit = int(params.get('sysparm_limit', 10000))
+        fields = params.get('sysparm_fields', 'sys_id').split(',')
+
+        # Take the keyset term out so every page shares the query's result.
+        after = None
+        terms = []
+        for term in query.split('^'):
+            if term.startswith('sys_id>'):
+                after = cmdb.index(term[len('sys_id>'):])
+            else:
+                terms.append(term)
+        result = cmdb.match('^'.join(terms),
+                            after is None and offset == 0)
+        if after is not None:
+            offset = bisect.bisect_right(result, after)
+        return [cmdb.record(index, fields)
+                for index in result[offset:offset + limit]]
+
+    # Write the given body to the CI at the given Table API path.
+    def write_table(self, path: str, body: bytes):
+        cmdb = self.server.cmdb
+        index = cmdb.index(path.rsplit('/', 1)[1])
+        if index is None:
+            self.send_json(404, {'error': {'message': 'No Record found'}})
+            return
+        cmdb.update(index, json.loads(body))
+        self.send_json(200, {'result': cmdb.record(index, ['sys_id'])})
+
+    # Run the sub-requests of the given Batch API request and return the
+    # response.
+    def run_batch(self, batch_req: dict) -> dict:
+        cmdb = self.server.cmdb
+        serviced = []
+        for rest_req in batch_req['rest_requests']:
+            sys_id = rest_req['url'].split('?')[0].rsplit('/', 1)[1]
+            index = cmdb.index(sys_id)
+            if index is None:
+                status_code, status_text, result = 404, 'Not Found', {}
+            else:
+                cmdb.update(index,
+                            json.loads(base64.b64decode(rest_req['body'])))
+                status_code, status_text = 200, 'OK'
+                result = {'result': cmdb.record(index, ['sys_id'])}
+            serviced.append({
+                'id': rest_req['id'],
+                'status_code': status_code,
+                'status_text': status_text,
+                'headers': [],
+                'body': base64.b64encode(
+                    json.dumps(result).encode()).decode()
+            })
+        return {'batch_request_id': batch_req.get('batch_request_id'),
+                'serviced_requests': serviced, 'unserviced_requests': []}
@@ -0,0 +1,219 @@
+import argparse
+import configparser
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_services import (CISCO_EOX_PID_PATH, CISCO_EOX_SN_PATH,
+                           CISCO_TOKEN_PATH, CISCO_WARRANTY_PATH,
+                           DELL_TOKEN_PATH, DELL_WARRANTY_PATH, MockCmdb,
+                           MockServices)
+
+
+# Measures the script against local mock ServiceNow, Cisco and Dell APIs
+# (see mock_services.py). For each dataset size a mock CMDB is generated, the
+# script is run against it one or more times in a fresh work directory, and
+# each run's throughput, API calls per CI, request latencies and peak memory
+# are reported.
+
+BENCHMARK_PATH = os.path.dirname(os.path.realpath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARK_PATH)
+CONFIG_EXAMPLE_PATH = REPO_PATH + \
+    '/configs/2022-DIKO-Project-config-example.ini'
+SCRIPT_NAME = '2022-DIKO-Project.py'
+
+# Config settings every benchmark run starts from, on top of the example
+# config. Vendor rate limits are lifted so a run measures the script rather
+# than the limits, and retries back off quickly.
+BENCHMARK_SETTINGS = {
+    'ServiceNow Info': {'username': 'benchmark', 'password': 'benchmark',
+                        'cmdb-table': '/table/cmdb_ci', 'use-ssl': 'no'},
+    'Cisco Info': {'client-id': 'benchmark', 'client-secret': 'benchmark',
+                   'warranty-rate-limit': '0', 'eox-rate-limit': '0'},
+    'Dell Info': {'client-id': 'benchmark', 'client-secret': 'benchmark',
+                  'warranty-rate-limit': '0'},
+    'Retry Info': {'base-delay': '0.1', 'max-delay': '2'}
+}
+
+
+# Write the config file for a benchmark run against the given mock services
+# to the given work directory, with the given 'section:key=value' overrides.
+def write_config(work_path: str, services: MockServices,
+                 overrides: list[str]):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(CONFIG_EXAMPLE_PATH)
+    for section, settings in BENCHMARK_SETTINGS.items():
+        config[section].update(settings)
+    base_url = services.base_url
+    config['ServiceNow Info']['instance'] = ''
+    config['ServiceNow Info']['host'] = base_url.split('//', 1)[1]
+    config['Cisco Info'].update({
+        'token-url': base_url + CISCO_TOKEN_PATH,
+        'base-warranty-url': base_url + CISCO_WARRANTY_PATH,
+        'base-eox-url': base_url + CISCO_EOX_SN_PATH,
+        'base-eox-pid-url': base_url + CISCO_EOX_PID_PATH
+    })
+    config['Dell Info'].update({
+        'token-url': base_url + DELL_TOKEN_PATH,
+        'base-warranty-url': base_url + DELL_WARRANTY_PATH
+    })
+    for override in overrides:
+        section_key, value = override.split('=', 1)
+        section, key = section_key.rsplit(':', 1)
+        if not config.has_section(section):
+            config.add_section(section)
+        config[section][key] = value
+
+    os.makedirs(work_path + '/configs')
+    with open(work_path + '/configs/2022-DIKO-Project-config.ini',
+              'w') as config_file:
+        config.write(config_file)
+
+
+# Run the script once from the given work directory with the given
+# arguments, with its output going to the given log file. Return the stats
+# saved by timed_run.py.
+def run_script(work_path: str, script_args: list[str], log_path: str) \
+        -> dict:
+    stats_path = log_path + '.json'
+    env = dict(os.environ, OAUTHLIB_INSECURE_TRANSPORT='1',
+               PYTHONUNBUFFERED='1')
+    with open(log_path, 'w') as log_file:
+        subprocess.run([sys.executable,
+                        BENCHMARK_PATH + '/timed_run.py', stats_path,
+                        work_path + '/src/' + SCRIPT_NAME, *script_args],
+                       stdout=log_file, stderr=subprocess.STDOUT, env=env,
+                       cwd=work_path)
+    with open(stats_path) as stats_file:
+        return json.load(stats_file)
+
+
+# Return the 50th and 99th percentiles of the given latencies in
+# milliseconds.
+def get_percentiles(latencies: list[float]) -> tuple[float, float]:
+    if len(latencies) < 2:
+        latency = latencies[0] * 1000 if latencies else 0
+        return latency, latency
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+    return cuts[49] * 1000, cuts[98] * 1000
+
+
+# Return the results of one run from its stats, the mock services it ran
+# against and the size of the mock CMDB.
+def get_results(size: int, run: int, stats: dict,
+                services: MockServices, log_path: str) -> dict:
+    latencies = [latency for api_latencies in stats['latencies'].values()
+                 for latency in api_latencies]
+    p50, p99 = get_percentiles(latencies)
+    calls = sum(services.calls.values())
+    return {
+        'records': size,
+        'run': run,
+        'exit_code': stats['exit_code'],
+        'seconds': round(stats['run_time'], 3),
+        'records_per_second': round(size / stats['run_time'], 1),
+        'api_calls': calls,
+        'api_calls_per_record': round(calls / size, 4),
+        'p50_ms': round(p50, 2),
+        'p99_ms': round(p99, 2),
+        'peak_memory_mb': None if stats['peak_memory'] is None else
+        round(stats['peak_memory'] / 2 ** 20, 1),
+        'apis': {
+            api_name: {
+                'calls': services.calls[api_name],
+                'rejected': services.rejected[api_name],
+                'p50_ms': round(get_percentiles(api_latencies)[0], 2),
+                'p99_ms': round(get_percentiles(api_latencies)[1], 2)
+            }
+            for api_name, api_latencies in sorted(stats['latencies'].items())
+        },
+        'log': log_path
+    }
+
+
+# Print the given results of one run as a table row, with a row for each API
+# if asked for.
+def print_results(results: dict, by_api: bool):
+    print('%9d %4d %9.2f %11.1f %9d %9.3f %8.2f %8.2f %9s %5d' % (
+        results['records'], results['run'], results['seconds'],
+        results['records_per_second'], results['api_calls'],
+        results['api_calls_per_record'], results['p50_ms'],
+        results['p99_ms'], results['peak_memory_mb'], results['exit_code']))
+    if by_api:
+        for api_name, api_results in results['apis'].items():
+            print('%14s: %d calls (%d rejected), p50 %.2f ms, p99 %.2f ms' % (
+                api_name, api_results['calls'], api_results['rejected'],
+                api_results['p50_ms'], api_results['p99_ms']))
+    if results['exit_code']:
+        print('  Run failed, see ' + results['log'])
+
+
+# Main method to run the benchmark.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the script against local mock ServiceNow, '
+                    'Cisco and Dell APIs.')
+    parser.add_argument('--records', type=int, nargs='+', default=[1000],
+                        help='mock CMDB sizes to run with (default 1000)')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='runs in a row on each mock CMDB, sharing '
+                             'caches and run state (default 1)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'],
+                        default='threads', help='engine to run with')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every mock API response')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='share of API requests failed with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='share of API requests throttled with a 429')
+    parser.add_argument('--retry-after', type=float, default=1,
+                        help='Retry-After seconds sent with each 429')
+    parser.add_argument('--set', dest='overrides', action='append',
+                        default=[], metavar='SECTION:KEY=VALUE',
+                        help='override a config setting, such as '
+                             '"Run Info:mode=incremental"')
+    parser.add_argument('--by-api', action='store_true',
+                        help='also break calls and latencies down by API')
+    parser.add_argument('--json', action='store_true',
+                        help='print each run\'s results as a JSON line')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the work directories and run logs')
+    args = parser.parse_args()
+
+    if not args.json:
+        print('%9s %4s %9s %11s %9s %9s %8s %8s %9s %5s' % (
+            'records', 'run', 'seconds', 'records/s', 'calls', 'calls/CI',
+            'p50 ms', 'p99 ms', 'peak MB', 'exit'))
+    for size in args.records:
+        print('Generating ' + str(size) + ' mock CIs...', file=sys.stderr)
+        services = MockServices(MockCmdb(size), args.latency,
+                                args.error_rate, args.throttle_rate,
+                                args.retry_after)
+        services.start()
+        work_path = tempfile.mkdtemp(prefix='diko-benchmark-')
+        shutil.copytree(REPO_PATH + '/src', work_path + '/src',
+                        ignore=shutil.ignore_patterns('__pycache__'))
+        write_config(work_path, services, args.overrides)
+
+        for run in range(1, args.runs + 1):
+            services.calls.clear()
+            services.rejected.clear()
+            log_path = work_path + '/run-' + str(run) + '.log'
+            stats = run_script(work_path, ['--engine', args.engine],
+                               log_path)
+            results = get_results(size, run, stats, services, log_path)
+            if args.json:
+                print(json.dumps(results))
+            else:
+                print_results(results, args.by_api)
+            time.sleep(0.01)
+
+        services.shutdown()
+        services.server_close()
+        if not args.keep:
+            shutil.rmtree(work_path, ignore_errors=True)
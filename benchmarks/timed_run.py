@@ -0,0 +1,104 @@
+import json
+import runpy
+import sys
+import time
+
+import requests
+
+from mock_services import get_api_name
+
+# httpx is only needed by the asyncio engine.
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# resource is only there on Unix, so peak memory isn't measured elsewhere.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Runs the script once in this process with every HTTP request timed, then
+# saves the run time, the request latencies by API, the peak memory and the
+# exit code to a JSON stats file for run_benchmark.py.
+#
+# Usage: python timed_run.py <stats file> <script> [script arguments...]
+
+# Request latencies in seconds, by API.
+LATENCIES = {}
+
+
+# Record the latency of a request with the given method and URL path that
+# started at the given time.
+def record_latency(method: str, path: str, started: float):
+    LATENCIES.setdefault(get_api_name(method, path), []).append(
+        time.perf_counter() - started)
+
+
+# Time every request sent through a requests session, as the script's
+# ServiceNow, OAuth and vendor sessions are.
+def time_requests():
+    send = requests.adapters.HTTPAdapter.send
+
+    def timed_send(adapter, request, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return send(adapter, request, *args, **kwargs)
+        finally:
+            record_latency(request.method,
+                           requests.utils.urlparse(request.url).path,
+                           started)
+
+    requests.adapters.HTTPAdapter.send = timed_send
+
+
+# Time every request sent through an httpx client, as the asyncio engine's
+# are.
+def time_httpx():
+    if httpx is None:
+        return
+    handle = httpx.AsyncHTTPTransport.handle_async_request
+
+    async def timed_handle(transport, request):
+        started = time.perf_counter()
+        try:
+            return await handle(transport, request)
+        finally:
+            record_latency(request.method, request.url.path, started)
+
+    httpx.AsyncHTTPTransport.handle_async_request = timed_handle
+
+
+# Return the peak resident memory of this process in bytes, or None if it
+# can't be measured here.
+def get_peak_memory() -> int:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Main method to run the script.
+if __name__ == '__main__':
+    stats_path, script_path = sys.argv[1:3]
+    sys.argv = [script_path] + sys.argv[3:]
+    time_requests()
+    time_httpx()
+
+    exit_code = 1
+    started = time.perf_counter()
+    try:
+        runpy.run_path(script_path, run_name='__main__')
+        exit_code = 0
+    except SystemExit as error:
+        if error.code is None or isinstance(error.code, int):
+            exit_code = error.code or 0
+    finally:
+        run_time = time.perf_counter() - started
+        with open(stats_path, 'w') as stats_file:
+            json.dump({'run_time': run_time, 'latencies': LATENCIES,
+                       'peak_memory': get_peak_memory(),
+                       'exit_code': exit_code}, stats_file)
+    sys.exit(exit_code)
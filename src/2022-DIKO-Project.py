@@ -1,13 +1,39 @@
+import abc
+import argparse
+import asyncio
+import base64
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import email.utils
+import functools
 import itertools
+import json
+import logging
+import operator
 import os
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
 import unicodedata
+from typing import AsyncIterator, Callable, Iterable, Iterator
 
 import pysnow
-from pysnow import exceptions
+import requests
 from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
 
+# httpx is only needed by the asyncio engine.
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
 
 # Module information.
 __author__ = 'Anthony Farina'
@@ -31,9 +57,55 @@ SNOW_INSTANCE = CONFIG['ServiceNow Info']['instance']
 SNOW_USERNAME = CONFIG['ServiceNow Info']['username']
 SNOW_PASSWORD = CONFIG['ServiceNow Info']['password']
 SNOW_CMDB_PATH = CONFIG['ServiceNow Info']['cmdb-table']
-SNOW_CLIENT = pysnow.Client(instance=SNOW_INSTANCE,
-                            user=SNOW_USERNAME,
-                            password=SNOW_PASSWORD)
+
+# A full host name (and port) to reach ServiceNow at instead of an instance
+# name, such as a proxy or a local test server, and whether to use HTTPS.
+SNOW_HOST = CONFIG.get('ServiceNow Info', 'host', fallback='')
+SNOW_USE_SSL = CONFIG.getboolean('ServiceNow Info', 'use-ssl', fallback=True)
+
+# ServiceNow CMDB paging settings. Records are read one page at a time, by
+# offset or by sys_id ('keyset'), and each vendor pipeline can have this many
+# pages downloaded ahead of the page it is working on.
+SNOW_PAGE_SIZE = CONFIG.getint('ServiceNow Info', 'page-size', fallback=1000)
+SNOW_PAGINATION = CONFIG.get('ServiceNow Info', 'pagination',
+                             fallback='keyset')
+SNOW_PAGES_AHEAD = CONFIG.getint('ServiceNow Info', 'pages-ahead',
+                                 fallback=2)
+SNOW_RECORD_FIELDS = ['sys_id', 'name', 'serial_number', 'asset_tag',
+                      'manufacturer.name', 'sys_updated_on',
+                      'u_active_support_contract', 'warranty_expiration',
+                      'u_end_of_life', 'u_valid_warranty_data']
+
+# Records are written back directly by sys_id with the Table API, asking only
+# for the sys_id back so ServiceNow doesn't send the whole record.
+SNOW_API_PATH = '/api/now'
+SNOW_WRITE_PARAMS = {'sysparm_fields': 'sys_id'}
+
+# ServiceNow bulk write-back settings. Updates are buffered and written
+# through the ServiceNow Batch API once the buffer holds this many records or
+# every flush interval (in seconds). A flush size of 0 writes each record as
+# soon as it changes instead.
+SNOW_BATCH_API_PATH = '/api/now/v1/batch'
+SNOW_FLUSH_SIZE = CONFIG.getint('ServiceNow Info', 'bulk-flush-size',
+                                fallback=100)
+SNOW_FLUSH_INTERVAL = CONFIG.getfloat('ServiceNow Info',
+                                      'bulk-flush-interval', fallback=5)
+
+# ServiceNow request pacing, in requests per second (0 means no limit).
+SNOW_RATE_LIMIT = CONFIG.getfloat('ServiceNow Info', 'rate-limit',
+                                  fallback=0)
+
+# Other ServiceNow instances to update in the same run, such as one for each
+# customer. Each has a section named with this prefix and the instance's name,
+# holding its own instance, credentials, CMDB table, rate limit and run state
+# path. Settings it leaves out are taken from [ServiceNow Info]. The
+# [ServiceNow Info] instance is only updated if its instance is filled in.
+SNOW_PROFILE_PREFIX = 'ServiceNow Info: '
+
+# Cisco devices, as found in the CMDB 'manufacturer' field, and what a valid
+# Cisco S/N looks like once spaces are removed: no slashes.
+CISCO_MANUFACTURERS = ['Cisco', 'Meraki']
+CISCO_SERIAL_PATTERN = re.compile(r'[^/\\]+')
 
 # Cisco Support API credentials.
 CISCO_CLIENT_ID = CONFIG['Cisco Info']['client-id']
@@ -42,282 +114,2293 @@ CISCO_TOKEN_URL = CONFIG['Cisco Info']['token-url']
 CISCO_BASE_WARRANTY_URL = CONFIG['Cisco Info']['base-warranty-url']
 CISCO_BASE_EOX_URL = CONFIG['Cisco Info']['base-eox-url']
 
+# How EOX information is looked up: by each device's S/N ('serial'), or once
+# per product ID ('product-id') with the product IDs found in the warranty
+# summaries. Devices without a product ID are still looked up by S/N.
+CISCO_EOX_LOOKUP = CONFIG.get('Cisco Info', 'eox-lookup', fallback='serial')
+CISCO_BASE_EOX_PID_URL = CONFIG.get('Cisco Info', 'base-eox-pid-url',
+                                    fallback='')
+
+# Cisco API request pacing. Rate limits are in requests per second, where 0
+# means no limit. Batches in flight is how many batches each API has
+# requested ahead of the batch currently being written back to ServiceNow.
+CISCO_WARRANTY_RATE_LIMIT = CONFIG.getfloat('Cisco Info',
+                                            'warranty-rate-limit',
+                                            fallback=5)
+CISCO_EOX_RATE_LIMIT = CONFIG.getfloat('Cisco Info', 'eox-rate-limit',
+                                       fallback=5)
+CISCO_BATCHES_IN_FLIGHT = CONFIG.getint('Cisco Info', 'batches-in-flight',
+                                        fallback=4)
+
+# Most S/Ns (or product IDs) the Cisco Support (warranty) and EOX APIs take in
+# one request, and the longest request URL we send them. Each API's batches
+# are packed up to whichever limit is hit first.
+CISCO_WARRANTY_BATCH_SIZE = 50
+CISCO_EOX_BATCH_SIZE = 20
+CISCO_MAX_URL_LENGTH = 2000
+
+# Dell devices, as found in the CMDB 'manufacturer' field, and what a valid
+# Dell service tag looks like once spaces are removed: 5 to 7 characters with
+# no '/'.
+DELL_MANUFACTURERS = ['Dell']
+DELL_SERIAL_PATTERN = re.compile(r'[^/]{5,7}')
+
 # Dell TechDirect (Warranty) API credentials.
 DELL_CLIENT_ID = CONFIG['Dell Info']['client-id']
 DELL_CLIENT_SECRET = CONFIG['Dell Info']['client-secret']
 DELL_TOKEN_URL = CONFIG['Dell Info']['token-url']
 DELL_BASE_WARRANTY_URL = CONFIG['Dell Info']['base-warranty-url']
-
-
-# Get all Cisco records from ServiceNow and return it as a dictionary. The
-# key is the Cisco device's serial number and the value is the record.
-def get_snow_cisco_records() -> dict[str, dict[str, str]]:
-    print('Getting all Cisco records from ServiceNow...')
-
-    # Get all Cisco records from ServiceNow.
-    snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
-    snow_cisco_query = (pysnow.QueryBuilder().
-                        field('name').order_ascending().
-                        AND().
-                        field('manufacturer').contains('Cisco').
-                        OR().
-                        field('manufacturer').contains('Meraki')
-                        )
-    snow_cisco_resp = snow_cmdb_table.get(
-        query=snow_cisco_query,
-        fields=['sys_id', 'name', 'serial_number', 'asset_tag',
-                'u_active_support_contract', 'warranty_expiration',
-                'u_end_of_life', 'u_valid_warranty_data']
-    )
-    snow_cisco_devs = snow_cisco_resp.all()
-
-    # Go through all Cisco records and extract valid records.
-    snow_cisco_dict = dict()
-    no_sn = 0
+DELL_WARRANTY_RATE_LIMIT = CONFIG.getfloat('Dell Info', 'warranty-rate-limit',
+                                           fallback=2)
+
+# Most service tags the Dell TechDirect API takes in one request.
+DELL_WARRANTY_BATCH_SIZE = 100
+
+# Retry settings for every API request. Throttled (429), unavailable (5xx)
+# and failed connections are retried with exponential backoff and jitter,
+# or after the 'Retry-After' time the API asks for. Timeouts are in seconds.
+RETRY_MAX_RETRIES = CONFIG.getint('Retry Info', 'max-retries', fallback=5)
+RETRY_BASE_DELAY = CONFIG.getfloat('Retry Info', 'base-delay', fallback=1)
+RETRY_MAX_DELAY = CONFIG.getfloat('Retry Info', 'max-delay', fallback=60)
+REQUEST_TIMEOUT = CONFIG.getfloat('Retry Info', 'timeout', fallback=60)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+
+# Local vendor data cache settings. Vendor API responses are kept for each
+# S/N and reused until they are older than their time to live (in hours). A
+# time to live of 0 always asks the vendor.
+CACHE_PATH = CONFIG.get('Cache Info', 'path', fallback='') or \
+    SCRIPT_PATH + '/../cache/2022-DIKO-Project-cache.sqlite3'
+CISCO_WARRANTY_TTL = CONFIG.getfloat('Cache Info', 'cisco-warranty-ttl',
+                                     fallback=24) * 3600
+CISCO_EOX_TTL = CONFIG.getfloat('Cache Info', 'cisco-eox-ttl',
+                                fallback=168) * 3600
+DELL_WARRANTY_TTL = CONFIG.getfloat('Cache Info', 'dell-warranty-ttl',
+                                    fallback=24) * 3600
+
+# Vendor OAuth2 token settings. Tokens are kept between runs until they
+# expire, and are refreshed this many seconds before they do.
+TOKEN_PATH = CONFIG.get('Cache Info', 'token-path', fallback='') or \
+    SCRIPT_PATH + '/../cache/2022-DIKO-Project-tokens.json'
+TOKEN_REFRESH_MARGIN = CONFIG.getfloat('Cache Info', 'token-refresh-margin',
+                                       fallback=300)
+
+# Run mode settings. A 'full' run goes through every supported CMDB record. An
+# 'incremental' run only goes through records changed since the last
+# successful run, plus records whose cached vendor data has expired. The
+# state file keeps where the last successful run left off.
+RUN_MODE = CONFIG.get('Run Info', 'mode', fallback='full')
+RUN_STATE_PATH = CONFIG.get('Run Info', 'state-path', fallback='') or \
+    SCRIPT_PATH + '/../cache/2022-DIKO-Project-state.json'
+RUN_STALE_QUERY_SIZE = 100
+
+# The next incremental run asks for records updated since this run started,
+# by the ServiceNow server's clock, less this many seconds for records whose
+# update was still being saved as the run started.
+RUN_WATERMARK_MARGIN = CONFIG.getfloat('Run Info', 'watermark-margin',
+                                       fallback=60)
+
+# Snapshot settings. The snapshot keeps what every record held after the last
+# successful run. An incremental run takes the records whose vendor data has
+# expired from it instead of reading them from the CMDB again, since nothing
+# else changed them since (or they would be past the watermark). Records the
+# snapshot doesn't have are still read from the CMDB.
+RUN_SNAPSHOT = CONFIG.getboolean('Run Info', 'snapshot', fallback=True)
+RUN_SNAPSHOT_PATH = CONFIG.get('Run Info', 'snapshot-path', fallback='') or \
+    SCRIPT_PATH + '/../cache/2022-DIKO-Project-snapshot.sqlite3'
+
+# Where each run journals the records it finished and the updates it still
+# has to write, so a failed run can be picked up again with --resume.
+RUN_JOURNAL_PATH = CONFIG.get('Run Info', 'journal-path', fallback='') or \
+    SCRIPT_PATH + '/../cache/2022-DIKO-Project-journal.sqlite3'
+
+# Pipeline concurrency settings. Each vendor runs its own enrich / write-back
+# pipeline, and each pipeline writes back with its own pool.
+CISCO_MAX_WORKERS = CONFIG.getint('Pipeline Info', 'cisco-max-workers',
+                                  fallback=4)
+DELL_MAX_WORKERS = CONFIG.getint('Pipeline Info', 'dell-max-workers',
+                                 fallback=4)
+
+# How many ServiceNow instances are updated at once. Every instance has its
+# own vendor pipelines, but they all share the vendor API limits.
+SNOW_INSTANCE_WORKERS = CONFIG.getint('Pipeline Info', 'instance-workers',
+                                      fallback=4)
+
+# Engine settings. The 'threads' engine runs each pipeline with the pools
+# above. The 'asyncio' engine runs the whole run on one event loop instead,
+# and can keep this many requests in flight to each ServiceNow instance.
+# Vendor APIs keep to their vendor's batches in flight on either engine.
+PIPELINE_ENGINE = CONFIG.get('Pipeline Info', 'engine', fallback='threads')
+ASYNC_MAX_IN_FLIGHT = CONFIG.getint('Pipeline Info', 'async-max-in-flight',
+                                    fallback=200)
+
+# Logging settings: the lowest level logged (per-record messages are DEBUG),
+# whether lines are plain 'text' or one JSON object each ('json'), and the
+# file they go to (standard output if blank).
+LOG_LEVEL = CONFIG.get('Log Info', 'level', fallback='INFO').upper()
+LOG_FORMAT = CONFIG.get('Log Info', 'format', fallback='text')
+LOG_PATH = CONFIG.get('Log Info', 'path', fallback='')
+
+# Where each run's metrics are exported once it ends (not exported if blank),
+# as Prometheus text ('prometheus') or a JSON summary ('json').
+METRICS_PATH = CONFIG.get('Metrics Info', 'path', fallback='')
+METRICS_FORMAT = CONFIG.get('Metrics Info', 'format', fallback='prometheus')
+
+
+# Given pages of the given vendor's records from the given ServiceNow
+# instance, hand out each valid record as soon as its page has been checked.
+# The record's 'serial_number' field holds the device's cleaned up S/N.
+def get_snow_vendor_records(provider: 'VendorProvider',
+                            snow_instance: 'SnowInstance',
+                            snow_pages: Iterable[list['SnowRecord']]) \
+        -> Iterator['SnowRecord']:
+    LOGGER.info('Getting all %s records from ServiceNow...', provider.name)
+
+    # Go through all of this vendor's records and extract valid records. The
+    # S/Ns of records a resumed run skips still count for duplicates.
+    seen_sns = RUN_JOURNAL.get_serials(snow_instance, provider.name)
+    counts = collections.Counter()
+    for snow_devs in snow_pages:
+        valid_devs, invalid_devs = check_snow_records(snow_devs, provider,
+                                                      seen_sns, counts)
+        SNOW_CHANGE_SET.commit(invalid_devs)
+        yield from valid_devs
+
+    log_snow_vendor_counts(provider, counts)
+
+
+# Log information found while iterating through the given vendor's records.
+def log_snow_vendor_counts(provider: 'VendorProvider',
+                           counts: collections.Counter):
+    LOGGER.info('I found %d valid %s records in ServiceNow', counts['valid'],
+                provider.name)
+    LOGGER.info('I could not find a valid %s for %d %s records in '
+                'ServiceNow', provider.serial_label, counts['no_sn'],
+                provider.name)
+    LOGGER.info('I found %d duplicate %s records in ServiceNow',
+                counts['collisions'], provider.name)
+    LOGGER.info('All valid %s records retrieved from ServiceNow!',
+                provider.name)
+
+
+# Check the given page of the given vendor's records from ServiceNow and
+# return the valid ones and the ones with no valid S/N, which are staged as
+# invalid. A valid S/N found in the 'asset_tag' field is staged as the
+# record's S/N. S/Ns already in 'seen_sns' are skipped as duplicates, and what
+# was found is added to the given counts. Each valid record's 'serial_number'
+# field holds its cleaned up S/N, and is journaled as the record's S/N.
+def check_snow_records(snow_devs: list['SnowRecord'],
+                       provider: 'VendorProvider', seen_sns: set[str],
+                       counts: collections.Counter) \
+        -> tuple[list['SnowRecord'], list['SnowRecord']]:
+    started = time.perf_counter()
+    vendor = provider.name
+    snow_sns, asset_tag_indexes = get_snow_serials(snow_devs, provider)
+
+    # Update the 'serial_number' field in ServiceNow for the records whose
+    # valid S/N was found in the 'asset_tag' field.
+    for index in asset_tag_indexes:
+        update_snow_sn(snow_devs[index], vendor, snow_sns[index])
+
+    valid_devs = []
+    invalid_devs = []
     collisions = 0
-    for cisco_dev in snow_cisco_devs:
-        # Check if there is no S/N or an invalid character(s) in the S/N field.
-        cis_dev_sn = unicodedata.normalize('NFKD', cisco_dev[
-            'serial_number']).replace(' ', '')
-        if cis_dev_sn == '' or '/' in cis_dev_sn or '\\' in cis_dev_sn:
-            # Check the 'asset_tag' field for a valid S/N.
-            cis_dev_sn = unicodedata.normalize('NFKD', cisco_dev[
-                'asset_tag']).replace(' ', '')
-            if cis_dev_sn == '' or '/' in cis_dev_sn or '\\' in cis_dev_sn:
-                # Invalid S/N found in the asset tag field too.
-                update_snow_cisco_invalid_data(cisco_dev, 'Invalid S/N')
-                no_sn += 1
-                continue
-
-            # Update the 'serial_number' field in ServiceNow from the
-            # 'asset_tag' field.
-            update_snow_cisco_sn(cisco_dev, cis_dev_sn)
+    for snow_dev, snow_sn in zip(snow_devs, snow_sns):
+        # Check if neither field holds a valid S/N.
+        if snow_sn is None:
+            update_snow_invalid_data(snow_dev, vendor, 'Invalid S/N')
+            invalid_devs.append(snow_dev)
 
         # Check if this record is a duplicate. Skip if so.
-        if cis_dev_sn in snow_cisco_dict.keys():
+        elif snow_sn in seen_sns:
             collisions += 1
+
+        # Keep this record.
+        else:
+            seen_sns.add(snow_sn)
+            snow_dev['serial_number'] = snow_sn
+            valid_devs.append(snow_dev)
+
+    if valid_devs:
+        RUN_JOURNAL.add_serials(vendor, valid_devs)
+    counts['valid'] += len(valid_devs)
+    counts['no_sn'] += len(invalid_devs)
+    counts['collisions'] += collisions
+    METRICS.observe('normalize_seconds', time.perf_counter() - started,
+                    vendor=vendor)
+    METRICS.count('records_checked', len(valid_devs), vendor=vendor,
+                  result='valid')
+    METRICS.count('records_checked', len(invalid_devs), vendor=vendor,
+                  result='no_sn')
+    METRICS.count('records_checked', collisions, vendor=vendor,
+                  result='duplicate')
+    return valid_devs, invalid_devs
+
+
+# Return the cleaned up S/N of each of the given records of the given vendor,
+# checked against the vendor's S/N pattern a whole page at a time. Records
+# without a valid S/N fall back to their 'asset_tag' field. The S/N is None if
+# neither field holds a valid one. Also return the indexes of the records
+# whose S/N came from the 'asset_tag' field.
+def get_snow_serials(snow_devs: list['SnowRecord'],
+                     provider: 'VendorProvider') \
+        -> tuple[list[str], list[int]]:
+    sn_matches = provider.serial_pattern.fullmatch
+    snow_sns = normalize_snow_serials([snow_dev['serial_number']
+                                       for snow_dev in snow_devs])
+
+    # Check the 'asset_tag' field of every record without a valid S/N.
+    fallback_indexes = list(itertools.compress(
+        itertools.count(), map(operator.not_, map(sn_matches, snow_sns))))
+    asset_tags = normalize_snow_serials([snow_devs[index]['asset_tag']
+                                         for index in fallback_indexes])
+    asset_tag_indexes = []
+    for index, asset_tag in zip(fallback_indexes, asset_tags):
+        if sn_matches(asset_tag) is None:
+            snow_sns[index] = None
             continue
+        snow_sns[index] = asset_tag
+        asset_tag_indexes.append(index)
+
+    return snow_sns, asset_tag_indexes
+
+
+# Clean up the given S/N field values: decompose compatibility characters
+# (NFKD) and remove spaces. All values are cleaned up as one string, and an
+# all ASCII string (nearly every page) is already decomposed.
+def normalize_snow_serials(values: list[str]) -> list[str]:
+    if not values:
+        return []
+    joined_values = '\0'.join(values)
+    if not joined_values.isascii():
+        joined_values = unicodedata.normalize('NFKD', joined_values)
+    clean_values = joined_values.replace(' ', '').split('\0')
+
+    # A value holding the separator itself is cleaned up on its own.
+    if len(clean_values) != len(values):
+        clean_values = [unicodedata.normalize('NFKD', value).replace(' ', '')
+                        for value in values]
+    return clean_values
+
+
+# Get all records of every supported manufacturer from ServiceNow in a single
+# pass from the given instance, and hand each page's records to their
+# vendor's queue as the page arrives. Each queue gets None once all records
+# have been read, or the error that stopped the read. The run state's
+# watermark is moved up to when the run started, so records updated while it
+# ran are read again by the next run.
+def route_snow_records(snow_instance: 'SnowInstance',
+                       vendor_queues: dict[str, queue.Queue],
+                       run_state: dict[str, str]):
+    LOGGER.info('Getting all supported records from ServiceNow instance '
+                '%s...', snow_instance.name,
+                extra={'instance': snow_instance.name})
+    run_start = time.time()
+    server_dates = []
+    try:
+        seen_sys_ids = get_snow_finished_sys_ids(snow_instance)
+        for snow_page in get_snow_run_pages(snow_instance, run_state,
+                                            server_dates):
+            vendor_pages = split_snow_page(snow_instance, snow_page,
+                                           vendor_queues.keys(), seen_sys_ids)
+            for vendor, vendor_page in vendor_pages.items():
+                if vendor_page:
+                    vendor_queues[vendor].put(vendor_page)
+    except Exception as error:
+        for vendor_queue in vendor_queues.values():
+            vendor_queue.put(error)
+        raise
+
+    run_state['watermark'] = get_next_watermark(server_dates, run_start)
+    for vendor_queue in vendor_queues.values():
+        vendor_queue.put(None)
+    LOGGER.info('All supported records retrieved from ServiceNow instance '
+                '%s!', snow_instance.name,
+                extra={'instance': snow_instance.name})
+
+
+# Return a query for the records of every supported manufacturer.
+def get_snow_supported_query() -> pysnow.QueryBuilder:
+    snow_query = pysnow.QueryBuilder()
+    manufacturers = [manufacturer for provider in VENDOR_PROVIDERS
+                     for manufacturer in provider.manufacturers]
+    for index, manufacturer in enumerate(manufacturers):
+        if index > 0:
+            snow_query = snow_query.OR()
+        snow_query = snow_query.field('manufacturer').contains(manufacturer)
+    return snow_query
+
+
+# Split the given page of CMDB records from the given instance up by the given
+# vendors, as compact records. A record whose sys_id is already in
+# 'seen_sys_ids' (such as one found by more than one query) is left out, so it
+# is only handed out once. The records handed out are staged in the snapshot
+# as they are, and the vendor cache keeps the S/Ns of every record on the page
+# as the instance's.
+def split_snow_page(snow_instance: 'SnowInstance',
+                    snow_page: list[dict[str, str]], vendors: Iterable[str],
+                    seen_sys_ids: set[str]) -> dict[str, list]:
+    VENDOR_CACHE.keep_serials(snow_instance.name, normalize_snow_serials(
+        [snow_dev['serial_number'] for snow_dev in snow_page] +
+        [snow_dev['asset_tag'] for snow_dev in snow_page]))
+    vendor_pages = {vendor: [] for vendor in vendors}
+    staged_devs = []
+    for snow_dev in snow_page:
+        if snow_dev['sys_id'] in seen_sys_ids:
+            continue
+        seen_sys_ids.add(snow_dev['sys_id'])
+
+        vendor = get_snow_record_vendor(snow_dev)
+        if vendor in vendor_pages.keys():
+            vendor_pages[vendor].append(SnowRecord(snow_dev, snow_instance))
+            staged_devs.append(snow_dev)
+    SNOW_SNAPSHOT.stage(snow_instance, staged_devs)
+    METRICS.count('cmdb_pages', instance=snow_instance.name)
+    METRICS.count('cmdb_records', len(snow_page), instance=snow_instance.name)
+    return vendor_pages
+
+
+# Return the sys_ids of the given instance's records the run journal has as
+# finished or written by a resumed run, so they are skipped.
+def get_snow_finished_sys_ids(snow_instance: 'SnowInstance') -> set[str]:
+    finished_sys_ids = RUN_JOURNAL.get_sys_ids(snow_instance)
+    if finished_sys_ids:
+        LOGGER.info('Skipping %d records the last run finished...',
+                    len(finished_sys_ids),
+                    extra={'instance': snow_instance.name})
+    return finished_sys_ids
+
+
+# Return whether a run with the given run state reads every supported record
+# from the CMDB: a full run, or the first incremental run.
+def is_full_run(run_state: dict[str, str]) -> bool:
+    return RUN_MODE != 'incremental' or not run_state.get('watermark')
+
+
+# Return the CMDB queries the given instance's run has to go through, given
+# the query for every supported record. A full run has one query for all
+# records. An incremental run asks for records updated since the watermark,
+# plus records whose cached vendor data has expired. Those are handed out as
+# pages of records from the snapshot instead of queries where the snapshot
+# has them.
+def get_snow_run_queries(snow_instance: 'SnowInstance',
+                         snow_query: pysnow.QueryBuilder,
+                         run_state: dict[str, str]) -> Iterator:
+    snow_query_str = str(snow_query)
+    if is_full_run(run_state):
+        yield snow_query_str
+        return
 
-        # Add this record to the Cisco devices dictionary.
-        cisco_dev['serial_number'] = cis_dev_sn
-        snow_cisco_dict[cis_dev_sn] = cisco_dev
-
-    # Output information found while iterating through the Cisco records.
-    print('I found ' + str(len(snow_cisco_dict.keys())) +
-          ' valid Cisco records in ServiceNow')
-    print('I could not find a valid S/N for ' + str(no_sn) +
-          ' Cisco records in ServiceNow')
-    print('I found ' + str(collisions) +
-          ' duplicate Cisco records in ServiceNow')
-    print('All valid Cisco records retrieved from ServiceNow!')
-
-    return snow_cisco_dict
-
-
-# Get all Dell records from ServiceNow and return it as a dictionary. The
-# key is the Dell device's service tag and the value is the record.
-def get_snow_dell_records() -> dict[str, dict[str, str]]:
-    print('Getting all Dell records from ServiceNow...')
-
-    # Get all Dell devices from ServiceNow.
-    snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
-    snow_dell_query = (pysnow.QueryBuilder().
-                       field('name').order_ascending().
-                       AND().
-                       field('manufacturer').contains('Dell')
-                       )
-    snow_dell_resp = snow_cmdb_table.get(
-        query=snow_dell_query,
-        fields=['sys_id', 'name', 'serial_number', 'asset_tag',
-                'u_active_support_contract', 'warranty_expiration',
-                'u_end_of_life', 'u_valid_warranty_data']
-    )
-    snow_dell_devs = snow_dell_resp.all()
-
-    # Go through all Dell records and extract valid records.
-    snow_dell_dict = dict()
-    no_sn = 0
-    collisions = 0
-    for dell_dev in snow_dell_devs:
-        # Check if this device has a valid service tag in the S/N field.
-        dell_dev_service_tag = unicodedata.normalize('NFKD', dell_dev[
-            'serial_number']).replace(' ', '')
-        if dell_dev_service_tag == '' or '/' in dell_dev_service_tag or \
-           len(dell_dev_service_tag) > 7 or len(dell_dev_service_tag) < 5:
-            # Invalid service tag in the 'serial_number' field. Let's check
-            # the 'asset_tag' field for a valid service tag.
-            dell_dev_service_tag = unicodedata.normalize('NFKD', dell_dev[
-                'asset_tag']).replace(' ', '')
-            if dell_dev_service_tag == '' or '/' in dell_dev_service_tag or \
-               len(dell_dev_service_tag) > 7 or len(dell_dev_service_tag) < 5:
-                # Invalid service tag found in the asset_tag field too.
-                update_snow_dell_invalid_data(dell_dev, 'Invalid S/N')
-                no_sn += 1
-                continue
+    # Our own write-backs move 'sys_updated_on' too, so the next run sees
+    # those records again. Their vendor data is cached by then and nothing
+    # has changed, so they are not written again.
+    LOGGER.info('Getting records updated since %s...',
+                run_state['watermark'])
+    yield snow_query_str + '^sys_updated_on>=' + run_state['watermark']
+
+    # Ask for this instance's records with expired vendor data a few S/Ns at
+    # a time. Only the lookups each vendor keeps by S/N count. EOX
+    # information looked up by product ID isn't kept by S/N, so those
+    # records come back with their warranty summaries instead.
+    stale_ttls = dict()
+    for provider in VENDOR_PROVIDERS:
+        stale_ttls.update(provider.stale_ttls)
+    stale_sns = VENDOR_CACHE.get_stale_serials(snow_instance.name,
+                                               stale_ttls)
+    LOGGER.info('Getting %d records with expired vendor data...',
+                len(stale_sns))
+    for snow_page in SNOW_SNAPSHOT.get_pages(snow_instance, stale_sns):
+        stale_sns.difference_update(snow_dev['serial_number']
+                                    for snow_dev in snow_page)
+        yield snow_page
+
+    LOGGER.info('Reading %d records with expired vendor data from the '
+                'CMDB...', len(stale_sns))
+    queried_at = time.time()
+    for stale_sn_batch in batcher(sorted(stale_sns), RUN_STALE_QUERY_SIZE):
+        yield snow_query_str + '^serial_numberIN' + ','.join(stale_sn_batch)
+
+    # Every page read is split up before the next query is asked for, so
+    # the S/Ns the CMDB still has were kept again by now. The rest (such as
+    # the S/N of a deleted record) are no longer asked for.
+    VENDOR_CACHE.forget_serials(snow_instance.name, stale_sns, queried_at)
+
+
+# Return the pages of records the given instance's run goes through, read
+# from the CMDB or taken from the snapshot. The 'Date' header of each CMDB
+# response is added to the given list.
+def get_snow_run_pages(snow_instance: 'SnowInstance',
+                       run_state: dict[str, str],
+                       server_dates: list[str]) -> Iterator[list[dict]]:
+    for snow_run_query in get_snow_run_queries(
+            snow_instance, get_snow_supported_query(), run_state):
+        if isinstance(snow_run_query, list):
+            yield snow_run_query
+            continue
+        yield from get_snow_record_pages(snow_instance, snow_run_query,
+                                         SNOW_RECORD_FIELDS, server_dates)
 
-            # Update the 'serial_number' field from the 'asset_tag' field in
-            # ServiceNow.
-            update_snow_dell_sn(dell_dev, dell_dev_service_tag)
 
-        # Check if this record is a duplicate. Skip if so.
-        if dell_dev_service_tag in snow_dell_dict.keys():
-            collisions += 1
-            continue
+# Return the watermark for the next run of an instance: when the run
+# started, less RUN_WATERMARK_MARGIN, as a 'sys_updated_on' value (in UTC).
+# The start is the 'Date' header of the run's first CMDB response, as the
+# server's clock is the one 'sys_updated_on' is set by. If there is no usable
+# header, the given local start time is used instead.
+def get_next_watermark(server_dates: list[str], run_start: float) -> str:
+    try:
+        run_start = email.utils.parsedate_to_datetime(
+            server_dates[0]).timestamp()
+    except (IndexError, TypeError, ValueError):
+        pass
+    return time.strftime('%Y-%m-%d %H:%M:%S',
+                         time.gmtime(run_start - RUN_WATERMARK_MARGIN))
+
+
+# Return the state left by the last successful run on the given instance, or
+# an empty state if there was none.
+def load_run_state(snow_instance: 'SnowInstance') -> dict[str, str]:
+    if not os.path.exists(snow_instance.run_state_path):
+        return dict()
+    with open(snow_instance.run_state_path) as run_state_file:
+        return json.load(run_state_file)
+
+
+# Save the given run state of the given instance for the next run. The file
+# is replaced in one step so a crash never leaves a half written state behind.
+def save_run_state(snow_instance: 'SnowInstance', run_state: dict[str, str]):
+    run_state_path = snow_instance.run_state_path
+    os.makedirs(os.path.dirname(run_state_path), exist_ok=True)
+    with open(run_state_path + '.tmp', 'w') as run_state_file:
+        json.dump(run_state, run_state_file)
+    os.replace(run_state_path + '.tmp', run_state_path)
+
+
+# Return the name of the vendor whose pipeline handles the given ServiceNow
+# record, or None if its manufacturer isn't supported.
+def get_snow_record_vendor(snow_dev: dict[str, str]) -> str:
+    manufacturer = snow_dev['manufacturer.name'].lower()
+    for provider in VENDOR_PROVIDERS:
+        for manufacturer_name in provider.manufacturers:
+            if manufacturer_name.lower() in manufacturer:
+                return provider.name
+    return None
+
+
+# A CMDB record as it goes through a vendor pipeline, holding only the fields
+# the pipelines read and write, and the instance it is written back to.
+# Fields are read and set by name like the record's dict from ServiceNow, but
+# each record is a fraction of the size. Warranty fields hold one of a handful
+# of values ('true', 'false', '' or a date), so each value is interned and
+# shared by every record holding it. The first time a pipeline changes a
+# warranty field, the value read from the CMDB is kept in 'original'.
+class SnowRecord:
+    fields = ('sys_id', 'name', 'serial_number', 'asset_tag',
+              'u_active_support_contract', 'warranty_expiration',
+              'u_end_of_life', 'u_valid_warranty_data')
+    shared_fields = frozenset(['u_active_support_contract',
+                               'warranty_expiration', 'u_end_of_life',
+                               'u_valid_warranty_data'])
+    __slots__ = fields + ('instance', 'original')
+
+    # Keep the fields we need from the given record's dict from the given
+    # instance.
+    def __init__(self, snow_dev: dict[str, str],
+                 snow_instance: 'SnowInstance'):
+        for field in self.fields:
+            value = snow_dev[field]
+            if field in self.shared_fields:
+                value = sys.intern(value)
+            setattr(self, field, value)
+        self.instance = snow_instance
+        self.original = None
+
+    # Return the value of the given field.
+    def __getitem__(self, field: str) -> str:
+        return getattr(self, field)
+
+    # Set the given field to the given value.
+    def __setitem__(self, field: str, value: str):
+        if field in self.shared_fields:
+            value = sys.intern(value)
+            if self.original is None:
+                self.original = dict()
+            self.original.setdefault(field, getattr(self, field))
+        setattr(self, field, value)
+
+    # Return the given field updates for this record without the fields
+    # that are back to the value read from the CMDB, such as a field one
+    # stage changed and a later stage changed back.
+    def get_net_update(self, snow_update: dict[str, str]) -> dict[str, str]:
+        if self.original is None:
+            return snow_update
+        return {field: value for field, value in snow_update.items()
+                if self.original.get(field, None) != value}
+
+
+# Get the records matching the given query from the given instance's CMDB
+# table one page at a time. Each page is a list of records with the given
+# fields. Pages are requested by offset, or by sys_id ('keyset') so that deep
+# pages cost the same as the first one. Either way pages are sorted by sys_id
+# only, since sorting on anything else is expensive on big tables. If a list
+# of server dates is given, the 'Date' header of each response is added to it.
+def get_snow_record_pages(snow_instance: 'SnowInstance',
+                          snow_query: pysnow.QueryBuilder,
+                          fields: list[str],
+                          server_dates: list[str] = None) \
+        -> Iterator[list[dict]]:
+    offset = 0
+    last_sys_id = None
+    while True:
+        # Get this page of records.
+        snow_resp = REQUEST_SCHEDULER.send(
+            snow_instance.endpoint, snow_instance.client.session, 'GET',
+            snow_instance.table_url,
+            params=get_snow_page_params(snow_query, fields, offset,
+                                        last_sys_id))
+        snow_resp.raise_for_status()
+        if server_dates is not None:
+            server_dates.append(snow_resp.headers.get('Date'))
+        snow_page = snow_resp.json()['result']
+        if snow_page:
+            yield snow_page
+
+        # Check if this was the last page.
+        if len(snow_page) < SNOW_PAGE_SIZE:
+            return
+        offset += len(snow_page)
+        last_sys_id = snow_page[-1]['sys_id']
+
+
+# Return the Table API parameters for the page of records matching the given
+# query that starts at the given offset, or after the given sys_id when paging
+# by keyset (None for the first page).
+def get_snow_page_params(snow_query: pysnow.QueryBuilder, fields: list[str],
+                         offset: int, last_sys_id: str) -> dict:
+    snow_params = {
+        'sysparm_fields': ','.join(fields),
+        'sysparm_limit': SNOW_PAGE_SIZE,
+        'sysparm_exclude_reference_link': 'true',
+        'sysparm_suppress_pagination_header': 'true'
+    }
+
+    page_query = str(snow_query)
+    if SNOW_PAGINATION == 'keyset':
+        if last_sys_id is not None:
+            page_query += '^sys_id>' + last_sys_id
+    else:
+        snow_params['sysparm_offset'] = offset
+    snow_params['sysparm_query'] = page_query + '^ORDERBYsys_id'
+    return snow_params
+
+
+# A vendor whose devices' CMDB records are kept up to date. Each provider
+# declares which CMDB manufacturers are its, what a valid S/N of its devices
+# looks like, and the kinds of batched lookups its records go through: for
+# each kind, the most keys one request takes, the base URL the keys are
+# joined onto (None if they aren't) and how long its answers are cached. It
+# also declares the request rate of each of its API endpoints, how many
+# batches it can have in flight and how many workers write its records back.
+# The shared vendor pipeline does the batching, caching, lookup packing,
+# concurrency, merging and write-back for every provider on either engine, so
+# a provider only builds each lookup's API request, reads the answers out of
+# the response and turns each answer into record updates. Every record goes
+# through each kind in 'merge_kinds', and is written back once all of them
+# have answered for it. A provider whose lookups lead to other lookups merges
+# them with its own RecordMerge.
+class VendorProvider(abc.ABC):
+    def __init__(self, name: str, serial_label: str, manufacturers: list[str],
+                 serial_pattern: re.Pattern,
+                 lookups: dict[str, tuple[int, str, float]],
+                 rate_limits: dict[str, float], batches_in_flight: int,
+                 max_workers: int, token_url: str, client_id: str,
+                 client_secret: str, max_url_length: int = None):
+        self.name = name
+        self.serial_label = serial_label
+        self.manufacturers = manufacturers
+        self.serial_pattern = serial_pattern
+        self.lookups = lookups
+        self.rate_limits = rate_limits
+        self.batches_in_flight = batches_in_flight
+        self.max_workers = max_workers
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.max_url_length = max_url_length
+        self.merge_kinds = list(lookups.keys())
+        self.lookup_endpoints = {kind: kind for kind in lookups.keys()}
+        self.lookup_limits = {
+            kind: (batch_size, base_url, max_url_length)
+            for kind, (batch_size, base_url, _) in lookups.items()
+        }
+        self.stale_ttls = {kind: ttl
+                           for kind, (_, _, ttl) in lookups.items()}
+        self.session = get_vendor_session(
+            token_url, client_id, client_secret,
+            batches_in_flight * len(rate_limits))
+
+    # Return the method, URL and request arguments (such as 'params') that
+    # look up the given batch of keys with the given kind of lookup.
+    @abc.abstractmethod
+    def get_lookup_request(self, kind: str, batch_keys: list[str]) \
+            -> tuple[str, str, dict]:
+        pass
+
+    # Return the answer for each key in the given response of the given kind
+    # of lookup, keyed by key. Keys the API had no answer for are left out.
+    @abc.abstractmethod
+    def get_answers(self, kind: str, batch_resp) -> dict[str, dict]:
+        pass
+
+    # Return the update jobs for the given answers of the given kind of
+    # lookup for a batch, keyed by the S/N of the record they update. The
+    # batch's records are looked up by S/N in 'batch_devs'. Each job is a
+    # tuple of the update function followed by its arguments.
+    @abc.abstractmethod
+    def get_update_jobs(self, kind: str, answers: list[dict],
+                        batch_devs: dict[str, SnowRecord]) \
+            -> dict[str, list[tuple]]:
+        pass
+
+    # Return what the given kind of lookup asks for the given batch: its
+    # records' S/Ns.
+    def get_batch_keys(self, kind: str, batch: list) -> list[str]:
+        return [snow_dev['serial_number'] for snow_dev in batch]
+
+    # Return a packer for each lookup every record goes through from the
+    # start.
+    def make_packers(self) -> list['VendorBatchPacker']:
+        return [self.make_packer(kind) for kind in self.merge_kinds]
+
+    # Return a packer for the given kind of lookup.
+    def make_packer(self, kind: str) -> 'VendorBatchPacker':
+        batch_size, base_url, ttl = self.lookups[kind]
+        return VendorBatchPacker(kind, batch_size, base_url,
+                                 self.max_url_length, ttl)
+
+    # Return the merge of one run of this vendor's pipeline.
+    def make_merge(self) -> 'RecordMerge':
+        return RecordMerge(self)
+
+    # Request the given batch of keys with the given kind of lookup through
+    # the request scheduler and return the response as JSON.
+    def fetch(self, kind: str, batch_keys: list[str]):
+        method, url, kwargs = self.get_lookup_request(kind, batch_keys)
+        resp = REQUEST_SCHEDULER.send(self.lookup_endpoints[kind],
+                                      self.session, method, url, **kwargs)
+        resp.raise_for_status()
+        return resp.json()
+
+    # Request the given batch of keys with the given kind of lookup through
+    # the given asyncio request scheduler and client, like fetch().
+    async def fetch_async(self, scheduler: 'AsyncRequestScheduler',
+                          client: 'httpx.AsyncClient', kind: str,
+                          batch_keys: list[str]):
+        method, url, kwargs = self.get_lookup_request(kind, batch_keys)
+        resp = await scheduler.send(self.lookup_endpoints[kind], client,
+                                    method, url, **kwargs)
+        resp.raise_for_status()
+        return resp.json()
+
+    # Return an asyncio HTTP client for this vendor's API.
+    def make_async_client(self) -> 'httpx.AsyncClient':
+        return make_async_vendor_client(self.token_url, self.client_id,
+                                        self.client_secret)
+
+    # Given pages of this vendor's records from the given ServiceNow
+    # instance, update them with what the vendor's lookups find.
+    def run_pipeline(self, snow_instance: 'SnowInstance',
+                     snow_pages: Iterable[list[SnowRecord]]):
+        update_snow_vendor_records(self, get_snow_vendor_records(
+            self, snow_instance, snow_pages))
+
+    # Run this vendor's pipeline on the given engine, like run_pipeline().
+    async def run_async_pipeline(self, engine: 'AsyncEngine',
+                                 snow_instance: 'SnowInstance',
+                                 snow_pages: AsyncIterator):
+        await engine.run_provider_pipeline(self, snow_instance, snow_pages)
+
+
+# The Cisco provider. Its records go through two lookups, warranty summaries
+# through the Cisco Support API and EOX information through the Cisco EOX
+# API, by S/N or by product ID. Lookups by product ID start once a record's
+# warranty summary is in, and are merged by a CiscoRecordMerge.
+class CiscoProvider(VendorProvider):
+    def __init__(self):
+        super().__init__(
+            'Cisco', 'S/N', CISCO_MANUFACTURERS, CISCO_SERIAL_PATTERN,
+            {
+                'cisco-warranty': (CISCO_WARRANTY_BATCH_SIZE,
+                                   CISCO_BASE_WARRANTY_URL,
+                                   CISCO_WARRANTY_TTL),
+                'cisco-eox': (CISCO_EOX_BATCH_SIZE, CISCO_BASE_EOX_URL,
+                              CISCO_EOX_TTL),
+                'cisco-eox-pid': (CISCO_EOX_BATCH_SIZE,
+                                  CISCO_BASE_EOX_PID_URL, CISCO_EOX_TTL)
+            },
+            {
+                'cisco-warranty': CISCO_WARRANTY_RATE_LIMIT,
+                'cisco-eox': CISCO_EOX_RATE_LIMIT
+            },
+            CISCO_BATCHES_IN_FLIGHT, CISCO_MAX_WORKERS, CISCO_TOKEN_URL,
+            CISCO_CLIENT_ID, CISCO_CLIENT_SECRET, CISCO_MAX_URL_LENGTH)
+        self.eox_lookup = CISCO_EOX_LOOKUP
+        self.merge_kinds = ['cisco-warranty', 'cisco-eox']
+        self.lookup_endpoints['cisco-eox-pid'] = 'cisco-eox'
+
+        # EOX information looked up by product ID isn't kept by S/N.
+        del self.stale_ttls['cisco-eox-pid']
+        if self.eox_lookup != 'serial':
+            del self.stale_ttls['cisco-eox']
+
+    def get_lookup_request(self, kind: str, batch_keys: list[str]) \
+            -> tuple[str, str, dict]:
+        base_url = self.lookups[kind][1]
+        if kind == 'cisco-warranty':
+            return 'GET', base_url + ','.join(batch_keys), dict()
+        return 'GET', base_url + ','.join(batch_keys), {
+            'params': {
+                'responseencoding': 'json'
+            }
+        }
+
+    def get_answers(self, kind: str, batch_resp: dict) -> dict[str, dict]:
+        if kind == 'cisco-warranty':
+            return get_cisco_warranty_answers(batch_resp)
+        return get_cisco_eox_answers(batch_resp)
+
+    def get_update_jobs(self, kind: str, answers: list[dict],
+                        batch_devs: dict[str, SnowRecord]) \
+            -> dict[str, list[tuple]]:
+        if kind == 'cisco-warranty':
+            return get_cisco_warranty_jobs(answers, batch_devs)
+        return get_cisco_eox_jobs(answers, batch_devs)
+
+    # Lookups by product ID ask for the batch itself.
+    def get_batch_keys(self, kind: str, batch: list) -> list[str]:
+        if kind == 'cisco-eox-pid':
+            return batch
+        return super().get_batch_keys(kind, batch)
+
+    # When EOX information is looked up by product ID, only the warranty
+    # lookup starts right away.
+    def make_packers(self) -> list['VendorBatchPacker']:
+        if self.eox_lookup == 'serial':
+            return super().make_packers()
+        return [self.make_packer('cisco-warranty')]
+
+    def make_merge(self) -> 'RecordMerge':
+        return CiscoRecordMerge(self)
+
+
+# The Dell provider: one warranty lookup per service tag through the Dell
+# TechDirect API.
+class DellProvider(VendorProvider):
+    def __init__(self):
+        super().__init__(
+            'Dell', 'service tag', DELL_MANUFACTURERS, DELL_SERIAL_PATTERN,
+            {
+                'dell-warranty': (DELL_WARRANTY_BATCH_SIZE, None,
+                                  DELL_WARRANTY_TTL)
+            },
+            {'dell-warranty': DELL_WARRANTY_RATE_LIMIT}, 1, DELL_MAX_WORKERS,
+            DELL_TOKEN_URL, DELL_CLIENT_ID, DELL_CLIENT_SECRET)
+        self.warranty_url = DELL_BASE_WARRANTY_URL
+
+    def get_lookup_request(self, kind: str, batch_keys: list[str]) \
+            -> tuple[str, str, dict]:
+        return 'GET', self.warranty_url, {
+            'headers': {
+                'Accept': 'application/json'
+            },
+            'params': {
+                'servicetags': ','.join(batch_keys)
+            }
+        }
+
+    def get_answers(self, kind: str, batch_resp: list[dict]) \
+            -> dict[str, dict]:
+        return {dell_dev['serviceTag']: dell_dev for dell_dev in batch_resp}
 
-        # Add this record to the Dell devices dictionary.
-        dell_dev['serial_number'] = dell_dev_service_tag
-        snow_dell_dict[dell_dev_service_tag] = dell_dev
-
-    # Output information found while iterating through the Dell records.
-    print('I found ' + str(len(snow_dell_dict.keys())) +
-          ' valid Dell records in ServiceNow')
-    print('I could not find a valid service tag for ' + str(no_sn) +
-          ' Dell records in ServiceNow')
-    print('I found ' + str(collisions) +
-          ' duplicate Dell records in ServiceNow')
-    print('All valid Dell records retrieved from ServiceNow!')
-
-    return snow_dell_dict
-
-
-# Given a dictionary of Cisco devices, update their ServiceNow records with
-# warranty and end-of-life information.
-def update_snow_cisco_warranties(snow_cisco_devs: dict[str, dict[str, str]]):
-    print('Updating all Cisco records in ServiceNow...')
-
-    # Get a Cisco Support API token to establish a connection to the API.
-    warranty_client = BackendApplicationClient(client_id=CISCO_CLIENT_ID)
-    warranty_oauth = OAuth2Session(client=warranty_client)
-    warranty_token = warranty_oauth.fetch_token(
-        token_url=CISCO_TOKEN_URL,
-        client_id=CISCO_CLIENT_ID,
-        client_secret=CISCO_CLIENT_SECRET)
-    warranty_client = OAuth2Session(CISCO_CLIENT_ID, token=warranty_token)
-
-    # Get a Cisco EOX API token to establish a connection to the API.
-    eox_client = BackendApplicationClient(client_id=CISCO_CLIENT_ID)
-    eox_oauth = OAuth2Session(client=eox_client)
-    eox_token = eox_oauth.fetch_token(token_url=CISCO_TOKEN_URL,
-                                      client_id=CISCO_CLIENT_ID,
-                                      client_secret=CISCO_CLIENT_SECRET)
-    eox_client = OAuth2Session(CISCO_CLIENT_ID, token=eox_token)
-
-    # Get all provided Cisco device's warranty summaries / End-Of-life
-    # information in batches of 20 (This is the maximum the Cisco EOX API
-    # allows in 1 batch, which is less than the maximum of 50 for the Cisco
-    # Support API in 1 batch)
-    for batch in batcher(list(snow_cisco_devs.keys()), 20):
-        # Prepare the batch request for Cisco warranties.
-        sn_batch = ','.join(batch)
-        warranty_url = CISCO_BASE_WARRANTY_URL + sn_batch
-
-        # Get the warranty summary batch and convert it to JSON.
-        warranty_resp = warranty_client.get(url=warranty_url)
-        warranty_batch_resp = warranty_resp.json()
-
-        # Iterate through this batch and update ServiceNow.
-        for cis_dev in warranty_batch_resp['serial_numbers']:
-            # Check if the API didn't find a device with this S/N.
-            if 'ErrorResponse' in cis_dev.keys():
-                # Check if the Cisco API gave back a weird S/N. Skip if so.
-                if cis_dev['sr_no'] not in snow_cisco_devs.keys():
-                    print('Cisco API error - weird S/N returned: ' +
-                          cis_dev['sr_no'])
+    def get_update_jobs(self, kind: str, answers: list[dict],
+                        batch_devs: dict[str, SnowRecord]) \
+            -> dict[str, list[tuple]]:
+        write_jobs = collections.defaultdict(list)
+        for dell_dev in answers:
+            # Check if the API didn't find a device with this service tag.
+            if dell_dev['id'] is None:
+                # Weird exception...
+                if dell_dev['serviceTag'] == 'AMALONE':
                     continue
 
                 # Update the 'u_valid_warranty_data' field in ServiceNow to
                 # false.
-                update_snow_cisco_invalid_data(
-                    snow_cisco_devs[cis_dev['sr_no']], 'Cisco Support API '
-                                                       'Error Response')
+                write_jobs[dell_dev['serviceTag']].append(
+                    (update_snow_invalid_data,
+                     batch_devs[dell_dev['serviceTag']], 'Dell',
+                     'Dell Warranty API Error Response'))
                 continue
 
             # Update this record.
-            update_snow_cisco_record(cis_dev,
-                                     snow_cisco_devs[cis_dev['sr_no']])
-
-        # Prepare the batch request for Cisco EOX.
-        eox_url = CISCO_BASE_EOX_URL + sn_batch
-
-        # Get the EOX batch and convert it to JSON.
-        eox_resp = eox_client.get(url=eox_url,
-                                  params={
-                                      'responseencoding': 'json'
-                                  })
-        eox_batch_resp = eox_resp.json()
-
-        # Check if this is a valid batch...
-        if 'EOXRecord' not in eox_batch_resp.keys():
-            print('Invalid EOXRecord found')
+            write_jobs[dell_dev['serviceTag']].append(
+                (update_snow_dell_record, dell_dev,
+                 batch_devs[dell_dev['serviceTag']]))
+
+        return write_jobs
+
+
+# Given a vendor's devices' ServiceNow records, update them with what the
+# vendor's lookups find. The records can be handed in as they are fetched.
+# Each lookup is packed as full as its API allows, and batches are looked up
+# ahead of the batch being merged, as many as the vendor can have in flight
+# to each of its API endpoints.
+def update_snow_vendor_records(provider: VendorProvider,
+                               snow_devs: Iterable[SnowRecord]):
+    LOGGER.info('Updating all %s records in ServiceNow...', provider.name)
+    thread_name = provider.name.lower()
+    batches_in_flight = provider.batches_in_flight * len(provider.rate_limits)
+
+    # Make a pool to write this vendor's records back to ServiceNow, and one
+    # to look batches up ahead of the write-back.
+    write_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=provider.max_workers,
+        thread_name_prefix=thread_name + '-write')
+    fetch_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=batches_in_flight,
+        thread_name_prefix=thread_name + '-fetch')
+
+    # Hand a packed batch's keys to the lookup coordinator, unless it was all
+    # cached. The coordinator packs them together with the keys of every
+    # other pipeline, and each batch it fills up is requested right away.
+    # Batches are merged in the order they were handed in.
+    pending = collections.deque()
+
+    def submit_batch(kind, packed_batch):
+        batch, answers = packed_batch
+        lookup = None
+        if answers is None:
+            lookup = VendorLookup(
+                kind, provider.get_batch_keys(kind, batch),
+                functools.partial(fetch_pool.submit, send_lookup_batch, kind,
+                                  functools.partial(provider.fetch, kind),
+                                  functools.partial(provider.get_answers,
+                                                    kind)))
+        pending.append((kind, batch, answers, lookup))
+
+    # Merge the oldest batch, write back every record that is done, and
+    # request the lookups the batch led to. The batch's keys that are still
+    # waiting to be packed with others are requested now.
+    merge = provider.make_merge()
+
+    def merge_next_batch():
+        kind, batch, answers, lookup = pending.popleft()
+        if lookup is not None:
+            answers = lookup.result()
+        ready_devs, next_batches = merge.merge(kind, batch, answers)
+        SNOW_CHANGE_SET.commit(ready_devs, write_pool)
+        for next_kind, packed_batch in next_batches:
+            submit_batch(next_kind, packed_batch)
+
+    # The pools are shut down even if the pipeline fails. Lookups it already
+    # handed to the fetch pool are still sent, since their batches can hold
+    # keys other pipelines are waiting for.
+    try:
+        # Look up every record with each lookup it starts with, in separate
+        # streams.
+        packers = provider.make_packers()
+        page_size = max(packer.batch_size for packer in packers)
+        for snow_page in batcher(snow_devs, page_size):
+            for packer in packers:
+                for packed_batch in packer.add(snow_page):
+                    submit_batch(packer.kind, packed_batch)
+            while len(pending) > batches_in_flight:
+                merge_next_batch()
+
+        # Look up the last partial batches and merge what is left. Merging can
+        # lead to more lookups, so repeat until none are.
+        while True:
+            for packer in packers:
+                for packed_batch in packer.close():
+                    submit_batch(packer.kind, packed_batch)
+            for next_kind, packed_batch in merge.close():
+                submit_batch(next_kind, packed_batch)
+            if not pending:
+                break
+            while pending:
+                merge_next_batch()
+    finally:
+        fetch_pool.shutdown()
+        write_pool.shutdown()
+    LOGGER.info('All %s records updated in ServiceNow!', provider.name)
+
+
+# Return the update jobs for the given Cisco warranty summaries, like
+# VendorProvider.get_update_jobs().
+def get_cisco_warranty_jobs(warranty_answers: list[dict],
+                            batch_devs: dict[str, SnowRecord]) \
+        -> dict[str, list[tuple]]:
+    write_jobs = collections.defaultdict(list)
+    for cis_dev in warranty_answers:
+        # Check if the API didn't find a device with this S/N.
+        if 'ErrorResponse' in cis_dev.keys():
+            # Check if the Cisco API gave back a weird S/N. Skip if so.
+            if cis_dev['sr_no'] not in batch_devs.keys():
+                LOGGER.warning('Cisco API error - weird S/N returned: %s',
+                               cis_dev['sr_no'])
+                continue
+
+            # Update the 'u_valid_warranty_data' field in ServiceNow to
+            # false.
+            write_jobs[cis_dev['sr_no']].append(
+                (update_snow_invalid_data, batch_devs[cis_dev['sr_no']],
+                 'Cisco', 'Cisco Support API Error Response'))
             continue
 
-        # Iterate through this batch and update ServiceNow.
-        for cis_devs in eox_batch_resp['EOXRecord']:
-            eol_str = cis_devs['LastDateOfSupport']['value']
+        # Update this record.
+        write_jobs[cis_dev['sr_no']].append(
+            (update_snow_cisco_record, cis_dev, batch_devs[cis_dev['sr_no']]))
 
-            # There could be multiple records with the same EoL information,
-            # so we need to loop through each one.
-            for cis_dev_sn in cis_devs['EOXInputValue'].split(','):
-                # Check if this device has no End-Of-Life information.
-                if eol_str == '':
-                    update_snow_cisco_no_eol(snow_cisco_devs[cis_dev_sn])
-                    continue
+    return write_jobs
 
-                # Update this record.
-                update_snow_cisco_eol(snow_cisco_devs[cis_dev_sn], eol_str)
-
-    print('All Cisco records updated in ServiceNow!')
-
-
-# Given a dictionary of Dell devices, update their ServiceNow records with
-# warranty information.
-def update_snow_dell_warranties(snow_dell_devs: dict[str, dict[str, str]]):
-    print('Updating all Dell records in ServiceNow...')
-
-    # Get a Dell TechDirect API token to establish a connection to the API.
-    client = BackendApplicationClient(client_id=DELL_CLIENT_ID)
-    oauth = OAuth2Session(client=client)
-    token = oauth.fetch_token(token_url=DELL_TOKEN_URL,
-                              client_id=DELL_CLIENT_ID,
-                              client_secret=DELL_CLIENT_SECRET)
-    client = OAuth2Session(DELL_CLIENT_ID, token=token)
-
-    # Get all provided Dell device's warranty summaries in batches of 100.
-    # This is the maximum the Dell TechDirect API allows.
-    for batch in batcher(list(snow_dell_devs.keys()), 100):
-        # Prepare the batch request for Dell warranties.
-        sn_batch = ','.join(batch)
-
-        # Get the warranty batch and convert it to JSON.
-        warranty_resp = client.get(url=DELL_BASE_WARRANTY_URL,
-                                   headers={
-                                       'Accept': 'application/json'
-                                   },
-                                   params={
-                                       'servicetags': sn_batch
-                                   })
-        batch_resp = warranty_resp.json()
-
-        # Iterate through this batch and update ServiceNow.
-        for dell_dev in batch_resp:
-            # Check if the API didn't find a device with this service tag.
-            if dell_dev['id'] is None:
-                # Weird exception...
-                if dell_dev['serviceTag'] == 'AMALONE':
+
+# Return the update jobs for the given Cisco EOX records, like
+# get_cisco_warranty_jobs(). Each EOX record answers for the one S/N in its
+# 'EOXInputValue'.
+def get_cisco_eox_jobs(eox_answers: list[dict],
+                       batch_devs: dict[str, SnowRecord]) \
+        -> dict[str, list[tuple]]:
+    write_jobs = collections.defaultdict(list)
+    for cis_dev in eox_answers:
+        eol_str = cis_dev['LastDateOfSupport']['value']
+        cis_dev_sn = cis_dev['EOXInputValue']
+
+        # Check if this device has no End-Of-Life information.
+        if eol_str == '':
+            write_jobs[cis_dev_sn].append((update_snow_cisco_no_eol,
+                                           batch_devs[cis_dev_sn]))
+            continue
+
+        # Update this record.
+        write_jobs[cis_dev_sn].append((update_snow_cisco_eol,
+                                       batch_devs[cis_dev_sn], eol_str))
+
+    return write_jobs
+
+
+# Return the warranty summary of each S/N in the given batch, keyed by S/N.
+def get_cisco_warranty_answers(warranty_batch_resp: dict) -> dict[str, dict]:
+    return {
+        cis_dev['sr_no']: cis_dev
+        for cis_dev in warranty_batch_resp['serial_numbers']
+    }
+
+
+# Return the EOX record of each S/N (or product ID) in the given batch on its
+# own, keyed by S/N. One EOX record can answer for several S/Ns. An invalid
+# batch has no answers.
+def get_cisco_eox_answers(eox_batch_resp: dict) -> dict[str, dict]:
+    if 'EOXRecord' not in eox_batch_resp.keys():
+        LOGGER.warning('Invalid EOXRecord found')
+        return dict()
+
+    return {
+        cis_dev_sn: dict(cis_devs, EOXInputValue=cis_dev_sn)
+        for cis_devs in eox_batch_resp['EOXRecord']
+        for cis_dev_sn in cis_devs['EOXInputValue'].split(',')
+    }
+
+
+# Return the product ID of each device in the given Cisco warranty
+# summaries, keyed by S/N. The orderable product ID is what EOX bulletins
+# list, so it is used first. Devices the API didn't find or gave no product
+# ID for are left out.
+def get_cisco_warranty_pids(warranty_answers: list[dict]) -> dict[str, str]:
+    warranty_pids = dict()
+    for cis_dev in warranty_answers:
+        if 'ErrorResponse' in cis_dev.keys():
+            continue
+
+        for pid_list, pid_key in (('orderable_pid_list', 'orderable_pid'),
+                                  ('base_pid_list', 'base_pid')):
+            cis_pids = [cis_pid[pid_key] for cis_pid in
+                        cis_dev.get(pid_list) or [] if cis_pid.get(pid_key)]
+            if cis_pids:
+                warranty_pids[cis_dev['sr_no']] = cis_pids[0]
+                break
+    return warranty_pids
+
+
+# Request the given batch of keys of the given kind of vendor lookup with
+# 'fetch', and hand the answers 'split' finds in its response (keyed by key)
+# to every pipeline waiting for them. The answers are remembered in the
+# vendor cache. If the request fails, every waiting pipeline gets the error.
+def send_lookup_batch(kind: str, fetch: Callable, split: Callable,
+                      batch: list[str]):
+    try:
+        with METRICS.timer('lookup_batch_seconds', kind=kind):
+            answers = split(fetch(batch))
+        VENDOR_CACHE.put_many(kind, answers)
+    except BaseException as error:
+        METRICS.count('lookup_batch_errors', kind=kind,
+                      error=type(error).__name__)
+        LOOKUP_COORDINATOR.land(kind, batch, dict(), error)
+        raise
+    LOOKUP_COORDINATOR.land(kind, batch, answers)
+
+
+# A lookup of some keys of one kind through the lookup coordinator. Each
+# batch the keys fill up is handed to 'send' as soon as the lookup starts.
+# Keys still waiting in a partial batch are only sent once the lookup's
+# answers are needed, so the keys other pipelines claim in the meantime can
+# fill that batch up.
+class VendorLookup:
+    def __init__(self, kind: str, keys: list[str], send: Callable):
+        self.kind = kind
+        self.keys = keys
+        self.send = send
+        batches, self.flights = LOOKUP_COORDINATOR.claim(kind, keys)
+        for batch in batches:
+            send(batch)
+
+    # Send the partial batch holding any of this lookup's keys, if there is
+    # one.
+    def flush(self):
+        for batch in LOOKUP_COORDINATOR.flush(self.kind, self.keys):
+            self.send(batch)
+
+    # Send what is left of this lookup's keys, and wait for their answers.
+    # Keys the API had no answer for are left out.
+    def result(self) -> list[dict]:
+        self.flush()
+        return [answer for answer in
+                (flight.result() for flight in self.flights)
+                if answer is not None]
+
+
+# Return an HTTP session that keeps up to 'pool_size' connections per host
+# open for reuse and asks for compressed responses. Callers past the pool
+# size wait for a free connection instead of opening (and then throwing
+# away) another one, so TLS handshakes only happen while the pool fills up.
+def make_http_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size,
+                                            pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive'
+    })
+    return session
+
+
+# Return a pooled session for a vendor API that signs every request with a
+# token from the shared token manager. The token is only fetched once the
+# first request is made, and only if there is no saved token left to use.
+def get_vendor_session(token_url: str, client_id: str, client_secret: str,
+                       pool_size: int) -> requests.Session:
+    session = make_http_session(pool_size)
+    session.auth = TokenAuth(TOKEN_MANAGER, token_url, client_id,
+                             client_secret)
+    return session
+
+
+# Signs requests with a bearer token from the given token manager. The token
+# is looked up for every request, so a token about to expire is refreshed
+# before it is used instead of failing the request. A request the API turns
+# down as unauthorized (such as with a token revoked before it expired) is
+# sent once more with a new token.
+class TokenAuth(requests.auth.AuthBase):
+    def __init__(self, token_manager: 'TokenManager', token_url: str,
+                 client_id: str, client_secret: str):
+        self.token_manager = token_manager
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+
+    def __call__(self, request):
+        token = self.token_manager.get_token(self.token_url, self.client_id,
+                                             self.client_secret)
+        request.headers['Authorization'] = 'Bearer ' + token['access_token']
+        request.register_hook('response', functools.partial(
+            self.retry_unauthorized, token))
+        return request
+
+    # Send the request of the given response again with a new token if it
+    # was unauthorized, dropping the token it was sent with first. The
+    # request is sent straight through the connection it came from, so its
+    # hooks (this one included) don't run again.
+    def retry_unauthorized(self, token: dict, resp: requests.Response,
+                           **kwargs) -> requests.Response:
+        if resp.status_code != 401:
+            return resp
+
+        LOGGER.warning('API token from %s was turned down, getting a new '
+                       'one...', self.token_url)
+        self.token_manager.invalidate(self.token_url, self.client_id, token)
+        token = self.token_manager.get_token(self.token_url, self.client_id,
+                                             self.client_secret)
+        resp.content
+        resp.close()
+        request = resp.request.copy()
+        request.headers['Authorization'] = 'Bearer ' + token['access_token']
+        retry_resp = resp.connection.send(request, **kwargs)
+        retry_resp.history.append(resp)
+        retry_resp.request = request
+        return retry_resp
+
+
+# Fetches OAuth2 client credentials tokens and shares them between every
+# vendor client with the same token URL and client ID. Tokens are saved to a
+# file so later runs can use them until they expire. Each client's token is
+# fetched under a lock of its own, so a slow token API only holds up the
+# requests that need that token.
+class TokenManager:
+    def __init__(self, path: str, refresh_margin: float):
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.fetch_locks = collections.defaultdict(threading.Lock)
+        self.tokens = dict()
+        if os.path.exists(path):
+            self.load()
+
+    # Load the tokens saved by earlier runs. A token file that can't be read
+    # or isn't a saved set of tokens is ignored, and new tokens are fetched
+    # (and saved over it) as they are needed.
+    def load(self):
+        try:
+            with open(self.path) as token_file:
+                tokens = json.load(token_file)
+            if not isinstance(tokens, dict):
+                raise ValueError('not a JSON object')
+        except (OSError, ValueError) as error:
+            LOGGER.warning('Ignoring unreadable token file %s: %r',
+                           self.path, error)
+            return
+        self.tokens = tokens
+
+    # Return a token for the given client that is good for at least the
+    # refresh margin, fetching a new one if needed. Requests for the same
+    # client wait for the token being fetched instead of fetching their own.
+    def get_token(self, token_url: str, client_id: str,
+                  client_secret: str) -> dict:
+        token_key = token_url + ' ' + client_id
+        with self.lock:
+            fetch_lock = self.fetch_locks[token_key]
+        with fetch_lock:
+            with self.lock:
+                token = self.tokens.get(token_key)
+            if token is not None and \
+               token['expires_at'] - self.refresh_margin > time.time():
+                return token
+
+            # Get a new token to establish a connection to the API.
+            LOGGER.info('Getting a new API token from %s...', token_url)
+            oauth_client = BackendApplicationClient(client_id=client_id)
+            oauth = OAuth2Session(client=oauth_client)
+            token = oauth.fetch_token(token_url=token_url,
+                                      client_id=client_id,
+                                      client_secret=client_secret)
+            token.setdefault('expires_at', time.time() + 3600)
+            with self.lock:
+                self.tokens[token_key] = dict(token)
+                self.save()
+            return token
+
+    # Drop the given client's token if it is still the given one, so the
+    # next request for it fetches a new one. A token some other request has
+    # already replaced is kept.
+    def invalidate(self, token_url: str, client_id: str, token: dict):
+        token_key = token_url + ' ' + client_id
+        with self.lock:
+            saved_token = self.tokens.get(token_key)
+            if saved_token is not None and \
+               saved_token['access_token'] == token['access_token']:
+                del self.tokens[token_key]
+                self.save()
+
+    # Save all tokens to the token file, readable only by this user.
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        token_fd = os.open(self.path + '.tmp',
+                           os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(token_fd, 'w') as token_file:
+            json.dump(self.tokens, token_file)
+        os.replace(self.path + '.tmp', self.path)
+
+
+# Keeps vendor API responses for each S/N in a local SQLite database, so
+# later runs can skip asking the vendor about S/Ns it answered recently.
+# Responses are grouped by kind (such as 'cisco-warranty'), each with its own
+# time to live. Lookups by product ID ('cisco-eox-pid') are kept by product ID
+# the same way. The cache also keeps which ServiceNow instances have records
+# with each S/N, so each instance only refreshes its own expired responses.
+class VendorCache:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS vendor_cache ('
+                            'kind TEXT, serial TEXT, response TEXT, '
+                            'fetched_at REAL, PRIMARY KEY (kind, serial))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS vendor_cache_serials '
+                            '(instance TEXT, serial TEXT, seen_at REAL, '
+                            'PRIMARY KEY (instance, serial))')
+
+    # Return the responses of the given kind for the given S/Ns that are not
+    # older than the given time to live (in seconds), keyed by S/N.
+    def get_many(self, kind: str, serials: list[str],
+                 ttl: float) -> dict[str, dict]:
+        if ttl <= 0 or not serials:
+            return dict()
+
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT serial, response FROM vendor_cache '
+                'WHERE kind = ? AND fetched_at >= ? AND serial IN (' +
+                ','.join('?' * len(serials)) + ')',
+                [kind, time.time() - ttl, *serials]).fetchall()
+        return {serial: json.loads(response) for serial, response in rows}
+
+    # Return the given instance's S/Ns with a response older than its kind's
+    # time to live (in seconds). The key is the kind and the value is its
+    # time to live.
+    def get_stale_serials(self, instance: str,
+                          ttls: dict[str, float]) -> set[str]:
+        stale_serials = set()
+        for kind, ttl in ttls.items():
+            if ttl <= 0:
+                continue
+            with self.lock:
+                rows = self.db.execute(
+                    'SELECT vendor_cache.serial FROM vendor_cache '
+                    'JOIN vendor_cache_serials '
+                    'ON vendor_cache_serials.serial = vendor_cache.serial '
+                    'WHERE instance = ? AND kind = ? AND fetched_at < ?',
+                    [instance, kind, time.time() - ttl]).fetchall()
+            stale_serials.update(serial for serial, in rows)
+        return stale_serials
+
+    # Remember that the given instance has records with the given S/Ns, so
+    # their expired responses are refreshed by its incremental runs.
+    def keep_serials(self, instance: str, serials: list[str]):
+        seen_at = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO vendor_cache_serials '
+                'VALUES (?, ?, ?)',
+                [(instance, serial, seen_at) for serial in serials if serial])
+
+    # Forget the given S/Ns of the given instance that no record was kept
+    # with since the given time.
+    def forget_serials(self, instance: str, serials: set[str],
+                       seen_before: float):
+        with self.lock, self.db:
+            self.db.executemany(
+                'DELETE FROM vendor_cache_serials '
+                'WHERE instance = ? AND serial = ? AND seen_at < ?',
+                [(instance, serial, seen_before) for serial in serials])
+
+    # Remember the given responses of the given kind, keyed by S/N.
+    def put_many(self, kind: str, responses: dict[str, dict]):
+        fetched_at = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO vendor_cache VALUES (?, ?, ?, ?)',
+                [(kind, serial, json.dumps(response), fetched_at)
+                 for serial, response in responses.items()])
+
+
+# Keeps the last known state of every CMDB record a successful run went
+# through, for each ServiceNow instance, in a local SQLite database. Records
+# are staged as they are read and as their updates are written back, and
+# the staged records only replace the instance's snapshot once its run
+# succeeds. A failed run leaves the snapshot as it was.
+class SnowSnapshot:
+    columns = [field.split('.')[0] for field in SNOW_RECORD_FIELDS]
+    query_size = 500
+
+    def __init__(self, path: str, enabled: bool):
+        self.enabled = enabled
+        if not enabled:
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            for table in ('snow_snapshot', 'snow_snapshot_staged'):
+                self.db.execute(
+                    'CREATE TABLE IF NOT EXISTS ' + table +
+                    ' (instance TEXT, ' +
+                    ', '.join(column + ' TEXT' for column in self.columns) +
+                    ', PRIMARY KEY (instance, sys_id))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS snow_snapshot_serial '
+                            'ON snow_snapshot (instance, serial_number)')
+
+    # Throw away whatever an earlier, unfinished run of the given instance
+    # staged, unless this run resumes it.
+    def begin(self, snow_instance: 'SnowInstance', resume: bool):
+        if not self.enabled or resume:
+            return
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM snow_snapshot_staged '
+                            'WHERE instance = ?', [snow_instance.name])
+
+    # Stage the given page of the given instance's records, as read.
+    def stage(self, snow_instance: 'SnowInstance',
+              snow_page: list[dict[str, str]]):
+        if not self.enabled or not snow_page:
+            return
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO snow_snapshot_staged VALUES (?' +
+                ', ?' * len(SNOW_RECORD_FIELDS) + ')',
+                [[snow_instance.name] + [snow_dev[field]
+                                         for field in SNOW_RECORD_FIELDS]
+                 for snow_dev in snow_page])
+
+    # Stage the given (sys_id, field updates) pairs of the given instance's
+    # records once ServiceNow has them. Updates that were never written
+    # leave the record as read, so the next run compares against what
+    # ServiceNow really holds.
+    def stage_updates(self, snow_instance: 'SnowInstance', updates):
+        if not self.enabled or not updates:
+            return
+        with self.lock, self.db:
+            for sys_id, snow_update in updates:
+                fields = [field for field in snow_update.keys()
+                          if field in self.columns]
+                if not fields:
                     continue
+                self.db.execute(
+                    'UPDATE snow_snapshot_staged SET ' +
+                    ', '.join(field + ' = ?' for field in fields) +
+                    ' WHERE instance = ? AND sys_id = ?',
+                    [snow_update[field] for field in fields] +
+                    [snow_instance.name, sys_id])
+
+    # Make what the given instance's run staged its snapshot. After a run
+    # that read every record ('full_read'), records it didn't find are gone
+    # from the CMDB, so they are dropped from the snapshot too.
+    def commit(self, snow_instance: 'SnowInstance', full_read: bool):
+        if not self.enabled:
+            return
+        with self.lock, self.db:
+            if full_read:
+                self.db.execute('DELETE FROM snow_snapshot '
+                                'WHERE instance = ?', [snow_instance.name])
+            self.db.execute('INSERT OR REPLACE INTO snow_snapshot '
+                            'SELECT * FROM snow_snapshot_staged '
+                            'WHERE instance = ?', [snow_instance.name])
+            self.db.execute('DELETE FROM snow_snapshot_staged '
+                            'WHERE instance = ?', [snow_instance.name])
+
+    # Return the given instance's records with the given S/Ns as pages of
+    # records like the ones read from the CMDB, a few S/Ns at a time.
+    def get_pages(self, snow_instance: 'SnowInstance',
+                  serials: set[str]) -> Iterator[list[dict[str, str]]]:
+        if not self.enabled:
+            return
+        for serial_batch in batcher(sorted(serials), self.query_size):
+            with self.lock:
+                rows = self.db.execute(
+                    'SELECT ' + ', '.join(self.columns) +
+                    ' FROM snow_snapshot WHERE instance = ? AND '
+                    'serial_number IN (' + ','.join('?' * len(serial_batch)) +
+                    ')', [snow_instance.name, *serial_batch]).fetchall()
+            if rows:
+                yield [dict(zip(SNOW_RECORD_FIELDS, row)) for row in rows]
+
+
+# Journals each ServiceNow instance's run in a local SQLite database: the
+# records that are finished (written back, or with nothing to write), the
+# updates handed out for writing that aren't known to be written yet, and the
+# S/N each valid record was checked with. A failed run leaves its journal
+# behind, so a run with --resume can skip the finished records (while still
+# skipping their duplicates) and write the pending updates again. Vendor
+# answers are already kept in the vendor cache, so finished lookups aren't
+# journaled.
+class RunJournal:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS journal_finished ('
+                            'instance TEXT, sys_id TEXT, '
+                            'PRIMARY KEY (instance, sys_id))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS journal_pending ('
+                            'instance TEXT, sys_id TEXT, name TEXT, '
+                            'updates TEXT, PRIMARY KEY (instance, sys_id))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS journal_serials ('
+                            'instance TEXT, sys_id TEXT, vendor TEXT, '
+                            'serial TEXT, PRIMARY KEY (instance, sys_id))')
+
+    # Start the given instance's run. Unless it resumes the last run, the
+    # journal that run left behind is thrown away.
+    def begin(self, snow_instance: 'SnowInstance', resume: bool):
+        if not resume:
+            self.clear(snow_instance)
+
+    # Throw away the given instance's journal, such as after a successful
+    # run.
+    def clear(self, snow_instance: 'SnowInstance'):
+        with self.lock, self.db:
+            for table in ('journal_finished', 'journal_pending',
+                          'journal_serials'):
+                self.db.execute('DELETE FROM ' + table + ' WHERE instance = ?',
+                                [snow_instance.name])
+
+    # Return the sys_ids of the given instance's records that are finished
+    # or have pending updates.
+    def get_sys_ids(self, snow_instance: 'SnowInstance') -> set[str]:
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT sys_id FROM journal_finished WHERE instance = ? '
+                'UNION SELECT sys_id FROM journal_pending WHERE instance = ?',
+                [snow_instance.name, snow_instance.name]).fetchall()
+        return {sys_id for sys_id, in rows}
+
+    # Return the S/Ns the given vendor's pipeline found for the given
+    # instance's records that are finished or have pending updates.
+    def get_serials(self, snow_instance: 'SnowInstance',
+                    vendor: str) -> set[str]:
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT serial FROM journal_serials '
+                'WHERE instance = ? AND vendor = ? AND sys_id IN ('
+                'SELECT sys_id FROM journal_finished WHERE instance = ? '
+                'UNION SELECT sys_id FROM journal_pending WHERE instance = ?)',
+                [snow_instance.name, vendor, snow_instance.name,
+                 snow_instance.name]).fetchall()
+        return {serial for serial, in rows}
+
+    # Return the given instance's pending updates as (sys_id, name, field
+    # updates) tuples.
+    def get_pending(self, snow_instance: 'SnowInstance') -> list[tuple]:
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT sys_id, name, updates FROM journal_pending '
+                'WHERE instance = ?', [snow_instance.name]).fetchall()
+        return [(sys_id, name, json.loads(updates))
+                for sys_id, name, updates in rows]
+
+    # Journal the given records, whose stages are all done, given the
+    # (record, field updates) pairs handed out for writing among them.
+    # Records without updates are finished, and the rest are pending.
+    def add(self, snow_devs: Iterable[SnowRecord], changes: list[tuple]):
+        changed_devs = {snow_dev for snow_dev, _ in changes}
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO journal_finished VALUES (?, ?)',
+                [(snow_dev.instance.name, snow_dev['sys_id'])
+                 for snow_dev in snow_devs if snow_dev not in changed_devs])
+            self.db.executemany(
+                'INSERT OR REPLACE INTO journal_pending VALUES (?, ?, ?, ?)',
+                [(snow_dev.instance.name, snow_dev['sys_id'],
+                  snow_dev['name'], json.dumps(snow_update))
+                 for snow_dev, snow_update in changes])
+
+    # Journal the S/N the given vendor's pipeline found for each of the given
+    # valid records. Once a record is finished, a resumed run that skips it
+    # still skips the later records with its S/N as duplicates.
+    def add_serials(self, vendor: str, snow_devs: list[SnowRecord]):
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO journal_serials VALUES (?, ?, ?, ?)',
+                [(snow_dev.instance.name, snow_dev['sys_id'], vendor,
+                  snow_dev['serial_number']) for snow_dev in snow_devs])
+
+    # Journal the pending updates of the given instance's records with the
+    # given sys_ids as written, which finishes the records. Writes that
+    # aren't pending, like serial number fixes made before a record's
+    # lookups, don't finish it.
+    def mark_written(self, snow_instance: 'SnowInstance',
+                     sys_ids: list[str]):
+        rows = [(snow_instance.name, sys_id) for sys_id in sys_ids]
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO journal_finished '
+                'SELECT instance, sys_id FROM journal_pending '
+                'WHERE instance = ? AND sys_id = ?', rows)
+            self.db.executemany('DELETE FROM journal_pending '
+                                'WHERE instance = ? AND sys_id = ?', rows)
+
+
+# Return a record of the given instance with only the given sys_id and name
+# known, to write a pending update from the run journal or a saved plan back
+# with.
+def get_bare_snow_record(snow_instance: 'SnowInstance', sys_id: str,
+                         name: str) -> SnowRecord:
+    return SnowRecord(dict(dict.fromkeys(SnowRecord.fields, ''),
+                           sys_id=sys_id, name=name), snow_instance)
+
+
+# Return the pending updates the run journal has for the given instance as
+# (record, field updates) pairs, to write them again.
+def get_journal_changes(snow_instance: 'SnowInstance') -> list[tuple]:
+    pending = RUN_JOURNAL.get_pending(snow_instance)
+    if pending:
+        LOGGER.info('Writing %d record updates the last run left '
+                    'pending...', len(pending),
+                    extra={'instance': snow_instance.name})
+    return [(get_bare_snow_record(snow_instance, sys_id, name), snow_update)
+            for sys_id, name, snow_update in pending]
+
+
+# Coordinates the vendor lookups of every pipeline of every ServiceNow
+# instance. Each S/N (or product ID) is only looked up once at a time, and
+# the keys all pipelines claim are packed together into batches as full as
+# each API allows. 'batch_limits' holds each kind of lookup's batch size, the
+# base URL the batch's keys are joined onto (None if they aren't) and the
+# longest request URL its API takes.
+class LookupCoordinator:
+    def __init__(self, batch_limits: dict[str, tuple[int, str, int]]):
+        self.batch_limits = batch_limits
+        self.flights = dict()
+        self.pending = collections.defaultdict(dict)
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    # Claim the given keys of the given kind of lookup. New keys join the
+    # pending batch of their kind. Return the batches that filled up, which
+    # the caller has to send, and the flight of every key, whether the caller
+    # or another pipeline claimed it first. Each flight is a future of the
+    # key's answer.
+    def claim(self, kind: str, keys: list[str]) \
+            -> tuple[list[list[str]], list[concurrent.futures.Future]]:
+        batches = []
+        flights = []
+        with self.lock:
+            for key in keys:
+                flight = self.flights.get((kind, key))
+                if flight is None:
+                    flight = concurrent.futures.Future()
+                    self.flights[(kind, key)] = flight
+                    batches += self.pack(kind, key)
+                flights.append(flight)
+        return batches, flights
+
+    # Add the given key to the pending batch of its kind, and return the
+    # batches that filled up. A batch is full once it holds the API's batch
+    # size, or once the next key would make its request URL too long.
+    def pack(self, kind: str, key: str) -> list[list[str]]:
+        batch_size, base_url, max_url_length = self.batch_limits[kind]
+        pending = self.pending[kind]
+        batches = []
+        if pending and base_url is not None:
+            url_length = len(base_url) + len(key)
+            for pending_key in pending.keys():
+                url_length += len(pending_key) + 1
+            if url_length > max_url_length:
+                batches.append(self.take(kind))
+                pending = self.pending[kind]
+
+        pending[key] = None
+        if len(pending) >= batch_size:
+            batches.append(self.take(kind))
+        return batches
+
+    # Take out the pending batch of the given kind of lookup.
+    def take(self, kind: str) -> list[str]:
+        batch = list(self.pending.pop(kind).keys())
+        self.counts[kind, 'batches'] += 1
+        self.counts[kind, 'keys'] += len(batch)
+        METRICS.observe('lookup_batch_fill_ratio',
+                        len(batch) / self.batch_limits[kind][0], kind=kind)
+        return batch
+
+    # Take out the pending batch of the given kind of lookup if it holds any
+    # of the given keys, so a pipeline about to wait for them can send it.
+    # Return the batches the caller has to send.
+    def flush(self, kind: str, keys: list[str]) -> list[list[str]]:
+        with self.lock:
+            pending = self.pending.get(kind)
+            if not pending or not any(key in pending for key in keys):
+                return []
+            return [self.take(kind)]
+
+    # Log how many keys of each kind were looked up in how many batches.
+    def log_counts(self):
+        for kind in self.batch_limits.keys():
+            if self.counts[kind, 'batches']:
+                LOGGER.info('Looked up %d %s keys in %d batches',
+                            self.counts[kind, 'keys'], kind,
+                            self.counts[kind, 'batches'])
+
+    # Hand the given answers (keyed by key) to everyone waiting for the given
+    # claimed keys. A key without an answer gets None, or the given error if
+    # the lookup failed.
+    def land(self, kind: str, keys: list[str], answers: dict[str, dict],
+             error: BaseException = None):
+        with self.lock:
+            flights = [self.flights.pop((kind, key)) for key in keys]
+        for key, flight in zip(keys, flights):
+            if error is not None:
+                flight.set_exception(error)
+            else:
+                flight.set_result(answers.get(key))
+
+
+# Counters and summaries (count, sum and max of observed values, such as
+# timings in seconds) for each stage of the run, keyed by name and labels.
+# They are exported once the run ends, as Prometheus text or a JSON summary.
+class RunMetrics:
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.summaries = dict()
+        self.lock = threading.Lock()
+
+    # Add the given value to the counter with the given name and labels.
+    def count(self, name: str, value: int = 1, **labels: str):
+        with self.lock:
+            self.counters[name, tuple(sorted(labels.items()))] += value
+
+    # Add the given value to the summary with the given name and labels.
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                self.summaries[key] = [1, value, value]
+                return
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    # Time the block run under this context manager into the summary with
+    # the given name and labels.
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    # Count a response with the given status code from the given endpoint,
+    # which took the given number of seconds. Error responses are counted
+    # by status code too.
+    def observe_request(self, endpoint: str, method: str, status_code: int,
+                        seconds: float):
+        self.observe('request_seconds', seconds, endpoint=endpoint,
+                     method=method)
+        self.count('requests', endpoint=endpoint, method=method,
+                   status=str(status_code))
+        if status_code >= 400:
+            self.count('request_errors', endpoint=endpoint,
+                       error=str(status_code))
+
+    # Return the metrics in the Prometheus text format. Counters get a
+    # '_total' suffix, and each summary's max is its own gauge.
+    def to_prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            summaries = sorted(self.summaries.items())
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append('# TYPE diko_' + name + '_total counter')
+                last_name = name
+            lines.append('diko_' + name + '_total' +
+                         get_prometheus_labels(labels) + ' ' + str(value))
+        for suffix, kind, index in (('', 'summary', None),
+                                    ('_max', 'gauge', 2)):
+            last_name = None
+            for (name, labels), summary in summaries:
+                if name != last_name:
+                    lines.append('# TYPE diko_' + name + suffix + ' ' + kind)
+                    last_name = name
+                prom_labels = get_prometheus_labels(labels)
+                if index is not None:
+                    lines.append('diko_' + name + suffix + prom_labels + ' ' +
+                                 repr(summary[index]))
+                    continue
+                lines.append('diko_' + name + '_count' + prom_labels + ' ' +
+                             str(summary[0]))
+                lines.append('diko_' + name + '_sum' + prom_labels + ' ' +
+                             repr(summary[1]))
+        return '\n'.join(lines) + '\n'
+
+    # Return the metrics as a JSON summary: every counter and summary by
+    # name, with one entry per set of labels.
+    def to_json(self) -> dict:
+        metrics = {'counters': dict(), 'summaries': dict()}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                metrics['counters'].setdefault(name, []).append(
+                    {'labels': dict(labels), 'value': value})
+            for (name, labels), summary in sorted(self.summaries.items()):
+                count, total, largest = summary
+                metrics['summaries'].setdefault(name, []).append(
+                    {'labels': dict(labels), 'count': count, 'sum': total,
+                     'mean': total / count, 'max': largest})
+        return metrics
+
+    # Write the metrics to the given file in the given format. The file is
+    # replaced in one step, so a collector never reads half of it.
+    def export(self, path: str, metrics_format: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'w') as metrics_file:
+            if metrics_format == 'json':
+                json.dump(self.to_json(), metrics_file, indent=2)
+            else:
+                metrics_file.write(self.to_prometheus())
+        os.replace(path + '.tmp', path)
+
+
+# Return the given (name, value) label pairs in the Prometheus text format.
+def get_prometheus_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped_labels = [
+        (name, value.replace('\\', '\\\\').replace('"', '\\"')
+         .replace('\n', '\\n'))
+        for name, value in labels]
+    return '{' + ','.join(name + '="' + value + '"'
+                          for name, value in escaped_labels) + '}'
+
+
+# Formats each log record as one JSON object, with the fields passed in
+# 'extra' (such as the record, instance or vendor) as keys of their own.
+class JsonLogFormatter(logging.Formatter):
+    standard_fields = frozenset(logging.makeLogRecord({}).__dict__.keys()) | \
+        {'message', 'asctime'}
+
+    def format(self, record: logging.LogRecord) -> str:
+        log_entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        for field, value in record.__dict__.items():
+            if field not in self.standard_fields:
+                log_entry[field] = value
+        if record.exc_info:
+            log_entry['error'] = self.formatException(record.exc_info)
+        return json.dumps(log_entry, default=str)
+
+
+# Return the script's logger, logging at the given level in the given format
+# ('text' or 'json') to the given file, or to standard output if blank.
+def get_logger(level: str, log_format: str, path: str) -> logging.Logger:
+    logger = logging.getLogger('2022-DIKO-Project')
+    logger.setLevel(level)
+    logger.propagate = False
+    if path:
+        handler = logging.FileHandler(path)
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    if log_format == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(message)s'))
+    logger.handlers = [handler]
+    return logger
+
+
+# Sends every API request of the run. Each API endpoint has its own limiter,
+# and requests that are throttled or fail on the way are retried.
+class RequestScheduler:
+    def __init__(self, limiters: dict[str, 'EndpointLimiter']):
+        self.limiters = limiters
+
+    # Send a request to the given endpoint with the given session and return
+    # its response. The last response is returned if every retry failed, so
+    # callers should still check its status.
+    def send(self, endpoint: str, session: requests.Session, method: str,
+             url: str, **kwargs) -> requests.Response:
+        limiter = self.limiters[endpoint]
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        for attempt in range(RETRY_MAX_RETRIES + 1):
+            limiter.acquire()
+            started = time.perf_counter()
+            try:
+                resp = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                limiter.release(throttled=False)
+                METRICS.count('request_errors', endpoint=endpoint,
+                              error=type(error).__name__)
+                if attempt == RETRY_MAX_RETRIES:
+                    raise
+                LOGGER.warning('%s request failed, retrying: %r', endpoint,
+                               error, extra={'endpoint': endpoint})
+                time.sleep(get_retry_delay(attempt))
+                continue
+            except BaseException:
+                # Any other error (such as a failed token fetch) ends the
+                # request, so its slot is freed for the requests after it.
+                limiter.release(throttled=False)
+                raise
+            METRICS.observe_request(endpoint, method, resp.status_code,
+                                    time.perf_counter() - started)
+
+            # Check if this request should be tried again.
+            throttled = resp.status_code in THROTTLE_STATUS_CODES
+            limiter.release(throttled=throttled)
+            if resp.status_code not in RETRY_STATUS_CODES or \
+               attempt == RETRY_MAX_RETRIES:
+                return resp
+
+            # Wait as long as the API asked, or back off. When throttled,
+            # every request to this endpoint waits too.
+            retry_after = get_retry_after(resp)
+            if throttled and retry_after is not None:
+                limiter.pause(retry_after)
+            LOGGER.warning('%s responded %d, retrying...', endpoint,
+                           resp.status_code, extra={'endpoint': endpoint})
+            time.sleep(retry_after if retry_after is not None
+                       else get_retry_delay(attempt))
+
+
+# Limits the requests to one API endpoint. Requests are paced to the rate,
+# with bursts of up to one second of requests allowed, and at most
+# 'max_in_flight' requests run at once. Both limits are cut in half whenever
+# the endpoint throttles us, and creep back up while it doesn't. A rate of 0
+# means requests are not paced.
+class EndpointLimiter:
+    def __init__(self, rate: float, max_in_flight: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.next_at = time.monotonic()
+        self.paused_until = 0.0
+        self.max_in_flight = max_in_flight
+        self.in_flight_limit = max_in_flight
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    # Block until a request to this endpoint may be sent.
+    def acquire(self):
+        with self.condition:
+            # Wait for a free request slot.
+            while self.in_flight >= self.in_flight_limit:
+                self.condition.wait()
+            self.in_flight += 1
+            delay = self.reserve()
+        time.sleep(delay)
+
+    # Free the request slot taken by acquire(), and adjust the limits based on
+    # whether the request was throttled.
+    def release(self, throttled: bool):
+        with self.condition:
+            self.in_flight -= 1
+            self.adjust(throttled)
+            self.condition.notify_all()
+
+    # Reserve the next send time for a request and return how long it has to
+    # wait for it. Each request moves the schedule on by one interval at the
+    # rate it was reserved at, so a rate cut only slows down the requests
+    # after it. The caller holds the condition.
+    def reserve(self) -> float:
+        now = time.monotonic()
+        delay = max(self.paused_until - now, 0)
+        if self.rate > 0:
+            burst = (max(self.rate, 1) - 1) / self.rate
+            self.next_at = max(self.next_at, now)
+            delay = max(delay, self.next_at - burst - now)
+            self.next_at += 1 / self.rate
+        return delay
+
+    # Cut the limits in half if a request was throttled, or raise them a
+    # step once a full window (or about a second's worth) of requests in a
+    # row went through. The caller holds the condition.
+    def adjust(self, throttled: bool):
+        if throttled:
+            self.in_flight_limit = max(self.in_flight_limit // 2, 1)
+            self.rate = max(self.rate / 2, self.max_rate / 10)
+            self.successes = 0
+        else:
+            self.successes += 1
+            if self.successes >= min(self.in_flight_limit,
+                                     max(self.rate, 1)):
+                self.in_flight_limit = min(self.in_flight_limit + 1,
+                                           self.max_in_flight)
+                self.rate = min(self.rate + self.max_rate / 10,
+                                self.max_rate)
+                self.successes = 0
+
+    # Hold every request to this endpoint for the given number of seconds.
+    def pause(self, seconds: float):
+        with self.condition:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+
+
+# An EndpointLimiter for requests sent from an asyncio event loop. Requests
+# wait for their turn without blocking the loop.
+class AsyncEndpointLimiter(EndpointLimiter):
+    def __init__(self, rate: float, max_in_flight: int):
+        super().__init__(rate, max_in_flight)
+        self.condition = asyncio.Condition()
+
+    # Wait until a request to this endpoint may be sent.
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.in_flight < self.in_flight_limit)
+            self.in_flight += 1
+            delay = self.reserve()
+        await asyncio.sleep(delay)
+
+    # Free the request slot taken by acquire(), and adjust the limits based on
+    # whether the request was throttled.
+    async def release(self, throttled: bool):
+        async with self.condition:
+            self.in_flight -= 1
+            self.adjust(throttled)
+            self.condition.notify_all()
+
+    # Hold every request to this endpoint for the given number of seconds.
+    # Only the event loop touches this limiter, so no lock is needed.
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until,
+                                time.monotonic() + seconds)
+
+
+# Sends API requests from an asyncio event loop, like RequestScheduler. Each
+# API endpoint has its own AsyncEndpointLimiter.
+class AsyncRequestScheduler:
+    def __init__(self, limiters: dict[str, AsyncEndpointLimiter]):
+        self.limiters = limiters
+
+    # Send a request to the given endpoint with the given client and return
+    # its response. The last response is returned if every retry failed, so
+    # callers should still check its status.
+    async def send(self, endpoint: str, client: 'httpx.AsyncClient',
+                   method: str, url: str, **kwargs) -> 'httpx.Response':
+        limiter = self.limiters[endpoint]
+        for attempt in range(RETRY_MAX_RETRIES + 1):
+            await limiter.acquire()
+            started = time.perf_counter()
+            try:
+                resp = await client.request(method, url, **kwargs)
+            except httpx.TransportError as error:
+                await limiter.release(throttled=False)
+                METRICS.count('request_errors', endpoint=endpoint,
+                              error=type(error).__name__)
+                if attempt == RETRY_MAX_RETRIES:
+                    raise
+                LOGGER.warning('%s request failed, retrying: %r', endpoint,
+                               error, extra={'endpoint': endpoint})
+                await asyncio.sleep(get_retry_delay(attempt))
+                continue
+            except BaseException:
+                # Any other error (or the task being cancelled) ends the
+                # request, so its slot is freed for the requests after it.
+                await limiter.release(throttled=False)
+                raise
+            METRICS.observe_request(endpoint, method, resp.status_code,
+                                    time.perf_counter() - started)
+
+            # Check if this request should be tried again.
+            throttled = resp.status_code in THROTTLE_STATUS_CODES
+            await limiter.release(throttled=throttled)
+            if resp.status_code not in RETRY_STATUS_CODES or \
+               attempt == RETRY_MAX_RETRIES:
+                return resp
+
+            # Wait as long as the API asked, or back off. When throttled,
+            # every request to this endpoint waits too.
+            retry_after = get_retry_after(resp)
+            if throttled and retry_after is not None:
+                limiter.pause(retry_after)
+            LOGGER.warning('%s responded %d, retrying...', endpoint,
+                           resp.status_code, extra={'endpoint': endpoint})
+            await asyncio.sleep(retry_after if retry_after is not None
+                                else get_retry_delay(attempt))
+
+
+# Return how long to wait before the given retry attempt: exponential
+# backoff with full jitter, so retries from many threads spread out.
+def get_retry_delay(attempt: int) -> float:
+    return random.uniform(0, min(RETRY_BASE_DELAY * 2 ** attempt,
+                                 RETRY_MAX_DELAY))
+
+
+# Return the number of seconds the given response's 'Retry-After' header
+# asks us to wait, or None if there is no usable header.
+def get_retry_after(resp: requests.Response) -> float:
+    retry_after = resp.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return min(max(float(retry_after), 0), RETRY_MAX_DELAY)
+    except ValueError:
+        pass
 
-                # Update the 'u_valid_warranty_data' field in ServiceNow to
-                # false.
-                update_snow_dell_invalid_data(
-                    snow_dell_devs[dell_dev['serviceTag']],
-                    'Dell Warranty API Error Response')
+    # The header can also be an HTTP date.
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return min(max(retry_at.timestamp() - time.time(), 0), RETRY_MAX_DELAY)
+
+
+# A ServiceNow instance whose CMDB records are updated, with its own HTTP
+# session, request limit, bulk write buffer and run state. Its settings come
+# from the given config file section, and the ones the section leaves out
+# from [ServiceNow Info]. The [ServiceNow Info] instance keeps the run state
+# path and request limiter ('snow') it had before there were profiles.
+class SnowInstance:
+    def __init__(self, name: str, section: str):
+        self.name = name
+        self.rate_limit = CONFIG.getfloat(section, 'rate-limit',
+                                          fallback=SNOW_RATE_LIMIT)
+        snow_host = CONFIG.get(section, 'host', fallback='')
+        if snow_host:
+            self.client = pysnow.Client(
+                host=snow_host,
+                use_ssl=CONFIG.getboolean(section, 'use-ssl',
+                                          fallback=SNOW_USE_SSL),
+                session=make_http_session(SNOW_POOL_SIZE))
+        else:
+            self.client = pysnow.Client(
+                instance=CONFIG.get(section, 'instance'),
+                session=make_http_session(SNOW_POOL_SIZE))
+        self.client.session.auth = (
+            CONFIG.get(section, 'username', fallback=SNOW_USERNAME),
+            CONFIG.get(section, 'password', fallback=SNOW_PASSWORD))
+        self.table_api_path = SNOW_API_PATH + CONFIG.get(
+            section, 'cmdb-table', fallback=SNOW_CMDB_PATH)
+        self.table_url = self.client.base_url + self.table_api_path
+        self.batch_url = self.client.base_url + SNOW_BATCH_API_PATH
+        self.write_buffer = SnowWriteBuffer(self, SNOW_FLUSH_SIZE,
+                                            SNOW_FLUSH_INTERVAL)
+        if section == 'ServiceNow Info':
+            self.endpoint = 'snow'
+            self.run_state_path = RUN_STATE_PATH
+        else:
+            self.endpoint = 'snow:' + name
+            run_state_root, run_state_ext = os.path.splitext(RUN_STATE_PATH)
+            self.run_state_path = CONFIG.get(
+                section, 'state-path', fallback='') or \
+                run_state_root + '-' + name + run_state_ext
+
+
+# Return the ServiceNow instances to update: the [ServiceNow Info] instance
+# if it (or its host) is filled in, and the instance of every profile section.
+# A profile without an instance or a host is skipped with an error.
+def get_snow_instances() -> list[SnowInstance]:
+    snow_instances = []
+    if SNOW_INSTANCE or SNOW_HOST:
+        snow_instances.append(SnowInstance(SNOW_INSTANCE or SNOW_HOST,
+                                           'ServiceNow Info'))
+    for section in CONFIG.sections():
+        if not section.startswith(SNOW_PROFILE_PREFIX):
+            continue
+        if not CONFIG.get(section, 'instance', fallback='') and \
+                not CONFIG.get(section, 'host', fallback=''):
+            LOGGER.error('Skipping [%s]: neither instance nor host is set',
+                         section, extra={'section': section})
+            METRICS.count('config_errors', section=section)
+            continue
+        snow_instances.append(SnowInstance(
+            section[len(SNOW_PROFILE_PREFIX):].strip(), section))
+    return snow_instances
+
+
+# The logger and the metrics of the run.
+LOGGER = get_logger(LOG_LEVEL, LOG_FORMAT, LOG_PATH)
+METRICS = RunMetrics()
+
+# Cached vendor API responses, the record snapshot, the run journal, tokens
+# and lookups shared by all vendor pipelines of every ServiceNow instance.
+VENDOR_CACHE = VendorCache(CACHE_PATH)
+SNOW_SNAPSHOT = SnowSnapshot(RUN_SNAPSHOT_PATH, RUN_SNAPSHOT)
+RUN_JOURNAL = RunJournal(RUN_JOURNAL_PATH)
+TOKEN_MANAGER = TokenManager(TOKEN_PATH, TOKEN_REFRESH_MARGIN)
+
+# The vendors whose records are kept up to date, in the order their
+# manufacturers are matched. Each has an HTTP session shared by the whole
+# run, with a connection pool sized for the batches it has in flight.
+VENDOR_PROVIDERS = [CiscoProvider(), DellProvider()]
+LOOKUP_COORDINATOR = LookupCoordinator({
+    kind: lookup_limits
+    for provider in VENDOR_PROVIDERS
+    for kind, lookup_limits in provider.lookup_limits.items()
+})
+
+# Each ServiceNow instance's HTTP session is used by every write-back worker,
+# the CMDB reader and the bulk write flusher of that instance.
+SNOW_POOL_SIZE = sum(provider.max_workers for provider in VENDOR_PROVIDERS) \
+    + 2
+
+# Limits for every vendor API endpoint, each allowed as many requests in
+# flight as its vendor has batches in flight. Every ServiceNow instance adds
+# its own endpoint once it is set up. Vendor limits are shared by all
+# instances.
+REQUEST_SCHEDULER = RequestScheduler({
+    endpoint: EndpointLimiter(rate_limit, provider.batches_in_flight)
+    for provider in VENDOR_PROVIDERS
+    for endpoint, rate_limit in provider.rate_limits.items()
+})
+
+
+# Hand out the items put in the given queue until None is found. If an error
+# is found instead, raise it.
+def iter_queue(items: queue.Queue) -> Iterator:
+    while True:
+        item = items.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+# Run the given write-back jobs in the given pool and wait for all of them to
+# finish. Each job is a tuple of the update function followed by its
+# arguments. The first error raised by a job is raised here.
+def run_write_jobs(write_pool: concurrent.futures.ThreadPoolExecutor,
+                   write_jobs: list[tuple]):
+    futures = [write_pool.submit(*write_job) for write_job in write_jobs]
+    for future in concurrent.futures.as_completed(futures):
+        future.result()
+
+
+# Update every ServiceNow instance, up to 'instance-workers' of them at the
+# same time. Their vendor lookups share the same cache, tokens and vendor API
+# limits, so an S/N found in several instances is only looked up once. One
+# instance failing does not stop the others, but the run is reported as
+# failed at the end.
+def run_snow_instances(snow_instances: list[SnowInstance],
+                       resume: bool) -> bool:
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=SNOW_INSTANCE_WORKERS,
+            thread_name_prefix='instance') as instance_pool:
+        results = list(instance_pool.map(
+            functools.partial(run_snow_instance, resume=resume),
+            snow_instances))
+
+    failed = [snow_instance.name for snow_instance, instance_ok in
+              zip(snow_instances, results) if not instance_ok]
+    if failed:
+        LOGGER.error('Failed ServiceNow instances: %s', ', '.join(failed))
+        return False
+    return True
+
+
+# Get and update the devices of every vendor in the given ServiceNow instance
+# at the same time. Return whether every pipeline and write-back succeeded.
+# Only a successful run moves the instance's watermark for the next run, and
+# clears its run journal. When resuming a failed run, the updates it left
+# pending are written first and the records it finished are skipped.
+def run_snow_instance(snow_instance: SnowInstance, resume: bool) -> bool:
+    LOGGER.info('Updating ServiceNow instance %s...', snow_instance.name,
+                extra={'instance': snow_instance.name})
+    try:
+        run_state = load_run_state(snow_instance)
+        full_read = is_full_run(run_state)
+        SNOW_SNAPSHOT.begin(snow_instance, resume)
+        RUN_JOURNAL.begin(snow_instance, resume)
+        for change in get_journal_changes(snow_instance):
+            write_snow_record(*change)
+        pipelines_ok = run_vendor_pipelines(snow_instance, {
+            provider.name: functools.partial(provider.run_pipeline,
+                                             snow_instance)
+            for provider in VENDOR_PROVIDERS
+        }, run_state)
+
+        # Write any updates still staged (such as from a failed pipeline) or
+        # waiting in the bulk write buffer.
+        SNOW_CHANGE_SET.commit_all(snow_instance)
+        snow_instance.write_buffer.close()
+        if not pipelines_ok or snow_instance.write_buffer.failed:
+            return False
+
+        # A plan isn't written yet, so the next run has to see the same
+        # records again.
+        if not SNOW_PLAN.enabled:
+            save_run_state(snow_instance, run_state)
+            SNOW_SNAPSHOT.commit(snow_instance, full_read)
+        RUN_JOURNAL.clear(snow_instance)
+    except Exception as error:
+        LOGGER.error('ServiceNow instance %s failed: %r', snow_instance.name,
+                     error, extra={'instance': snow_instance.name})
+        METRICS.count('instance_failures', instance=snow_instance.name,
+                      error=type(error).__name__)
+        return False
+
+    LOGGER.info('ServiceNow instance %s updated!', snow_instance.name,
+                extra={'instance': snow_instance.name})
+    return True
+
+
+# Read the given ServiceNow instance's CMDB once and run the given vendor
+# pipelines on its records at the same time. The key is the vendor's name and
+# the value is the pipeline function, which is given the pages of that
+# vendor's records. One vendor failing does not stop the other vendors, but
+# the run is reported as failed at the end. The given run state is updated as
+# records are read.
+def run_vendor_pipelines(snow_instance: SnowInstance,
+                         pipelines: dict[str, Callable],
+                         run_state: dict[str, str]) -> bool:
+    LOGGER.info('Starting %d vendor pipelines...', len(pipelines))
+
+    # Route the CMDB records to each vendor pipeline in the background.
+    vendor_queues = {vendor: queue.Queue(maxsize=SNOW_PAGES_AHEAD)
+                     for vendor in pipelines.keys()}
+    threading.Thread(target=route_snow_records,
+                     args=(snow_instance, vendor_queues, run_state),
+                     name='snow-router', daemon=True).start()
+
+    # Every pipeline has to run at once, since they all share the one pass
+    # through the CMDB.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(pipelines),
+            thread_name_prefix='pipeline') as pipeline_pool:
+        futures = {pipeline_pool.submit(run_vendor_pipeline, pipeline,
+                                        vendor_queues[vendor]):
+                   vendor for vendor, pipeline in pipelines.items()}
+
+        # Report each vendor pipeline as it finishes.
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            vendor = futures[future]
+            try:
+                future.result()
+            except Exception as error:
+                LOGGER.error('%s pipeline failed: %r', vendor, error,
+                             extra={'vendor': vendor})
+                METRICS.count('pipeline_failures', vendor=vendor,
+                              error=type(error).__name__)
+                failed.append(vendor)
                 continue
 
-            # Update this record.
-            update_snow_dell_record(dell_dev,
-                                    snow_dell_devs[dell_dev['serviceTag']])
+            LOGGER.info('%s pipeline finished!', vendor,
+                        extra={'vendor': vendor})
 
-    print('All Dell records updated in ServiceNow!')
+    if failed:
+        LOGGER.error('Failed vendor pipelines: %s', ', '.join(failed))
+        return False
+
+    LOGGER.info('All vendor pipelines finished!')
+    return True
+
+
+# Run the given vendor pipeline on the pages put in the given queue. If the
+# pipeline fails, the rest of its pages are thrown away so the CMDB reader
+# never waits on a full queue nobody reads.
+def run_vendor_pipeline(pipeline: Callable, vendor_queue: queue.Queue):
+    snow_pages = iter_queue(vendor_queue)
+    try:
+        pipeline(snow_pages)
+    except Exception:
+        try:
+            for _ in snow_pages:
+                pass
+        except Exception:
+            pass
+        raise
 
 
 # Return specified batches of an iterable object.
@@ -335,6 +2418,260 @@ def batcher(iterable, batch_size):
         yield batch
 
 
+# Packs records into batches of up to 'batch_size' records as they come in.
+class BatchPacker:
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.pending = []
+
+    # Add the given records and return the batches they filled up.
+    def add(self, snow_devs: list[SnowRecord]) -> list:
+        batches = []
+        for snow_dev in snow_devs:
+            if self.pending and not self.fits(snow_dev):
+                batches.append(self.pending)
+                self.pending = []
+            self.pending.append(snow_dev)
+            if len(self.pending) >= self.batch_size:
+                batches.append(self.pending)
+                self.pending = []
+        return batches
+
+    # Return whether the given record still fits in the pending batch.
+    def fits(self, snow_dev: SnowRecord) -> bool:
+        return True
+
+    # Return the last partial batch, if there is one.
+    def close(self) -> list:
+        batches = [self.pending] if self.pending else []
+        self.pending = []
+        return batches
+
+
+# Packs a vendor's records into batches for one kind of lookup. Records with
+# fresh answers in the vendor cache are handed out right away in a batch of
+# their own, together with their cached answers. The rest are packed into
+# batches of up to 'batch_size' records, and have None for answers. If the
+# lookup joins its keys onto 'base_url', a batch also stays within the
+# longest request URL.
+class VendorBatchPacker(BatchPacker):
+    def __init__(self, kind: str, batch_size: int, base_url: str,
+                 max_url_length: int, ttl: float):
+        super().__init__(batch_size)
+        self.kind = kind
+        self.base_url = base_url
+        self.max_url_length = max_url_length
+        self.ttl = ttl
+
+    # Add the given records and return the batches they filled up, as (batch,
+    # cached answers or None) pairs.
+    def add(self, snow_devs: list[SnowRecord]) -> list[tuple]:
+        cached = VENDOR_CACHE.get_many(self.kind, [
+            snow_dev['serial_number'] for snow_dev in snow_devs], self.ttl)
+        batches = []
+        if cached:
+            batches.append(([snow_dev for snow_dev in snow_devs
+                             if snow_dev['serial_number'] in cached.keys()],
+                            list(cached.values())))
+
+        batches += [(batch, None) for batch in super().add(
+            [snow_dev for snow_dev in snow_devs
+             if snow_dev['serial_number'] not in cached.keys()])]
+        return batches
+
+    # Return whether the given record's S/N still fits in the pending batch's
+    # request URL.
+    def fits(self, snow_dev: SnowRecord) -> bool:
+        if self.base_url is None:
+            return True
+        url_length = len(self.base_url) + len(snow_dev['serial_number'])
+        for pending_dev in self.pending:
+            url_length += len(pending_dev['serial_number']) + 1
+        return url_length <= self.max_url_length
+
+    # Return the last partial batch, if there is one.
+    def close(self) -> list[tuple]:
+        return [(batch, None) for batch in super().close()]
+
+
+# Collects the update jobs each kind of lookup finds for a vendor's records
+# over one run of its pipeline, in any order. Once all of the provider's
+# 'merge_kinds' have answered for a record, its jobs are run in the order of
+# the kinds and the record is handed out to be written back. A provider whose
+# lookups lead to other lookups (follow-up lookups) hands them out from its
+# own subclass, by overriding merge_answers() and close(). Batches can be
+# merged from several threads, one at a time.
+class RecordMerge:
+    def __init__(self, provider: VendorProvider):
+        self.provider = provider
+        self.jobs = dict()
+        self.lock = threading.Lock()
+
+    # Merge the given answers of the given kind of lookup for the given
+    # packed batch, like merge_answers().
+    def merge(self, kind: str, batch: list, answers: list[dict]) \
+            -> tuple[list[SnowRecord], list[tuple]]:
+        with self.lock:
+            return self.merge_answers(kind, batch, answers)
+
+    # Merge the given answers of the given kind of lookup for the given
+    # packed batch. Return the records that are done, and the follow-up
+    # lookups to start as (kind, packed batch) pairs.
+    def merge_answers(self, kind: str, batch: list, answers: list[dict]) \
+            -> tuple[list[SnowRecord], list[tuple]]:
+        return self.add(kind, batch, answers), []
+
+    # Add the update jobs the given answers of the given kind of lookup lead
+    # to for the given batch of records. Run the jobs of every record all
+    # lookups have now answered for, and return those records.
+    def add(self, kind: str, batch: list[SnowRecord],
+            answers: list[dict]) -> list[SnowRecord]:
+        batch_devs = {snow_dev['serial_number']: snow_dev
+                      for snow_dev in batch}
+        write_jobs = self.provider.get_update_jobs(kind, answers, batch_devs)
+        merge_kinds = self.provider.merge_kinds
+        ready_devs = []
+        for snow_dev in batch:
+            record_jobs = self.jobs.setdefault(snow_dev['sys_id'], dict())
+            record_jobs[kind] = write_jobs.get(snow_dev['serial_number'], [])
+            if len(record_jobs) < len(merge_kinds):
+                continue
+
+            del self.jobs[snow_dev['sys_id']]
+            for record_kind in merge_kinds:
+                for write_job in record_jobs[record_kind]:
+                    write_job[0](*write_job[1:])
+            ready_devs.append(snow_dev)
+        return ready_devs
+
+    # Return the last partial batches of follow-up lookups, like
+    # merge_answers(). This is only called while no batch is being merged.
+    def close(self) -> list[tuple]:
+        return []
+
+
+# Merges the Cisco lookups. Warranty updates always run before EOX updates,
+# since both touch the 'u_valid_warranty_data' field. With EOX lookups by
+# product ID, a warranty batch's records go on to their EOX lookups, and each
+# product ID's EOX information is handed to its records.
+class CiscoRecordMerge(RecordMerge):
+    def __init__(self, provider: CiscoProvider):
+        super().__init__(provider)
+        self.eox_pids = None
+        if provider.eox_lookup != 'serial':
+            self.eox_pids = CiscoEoxPidPacker(provider)
+
+    def merge_answers(self, kind: str, batch: list, answers: list[dict]) \
+            -> tuple[list[SnowRecord], list[tuple]]:
+        if kind == 'cisco-eox-pid':
+            kind = 'cisco-eox'
+            batch, answers = self.eox_pids.resolve(batch, answers)
+
+        ready_devs = self.add(kind, batch, answers)
+        next_batches = []
+        if kind == 'cisco-warranty' and self.eox_pids is not None:
+            next_batches = self.eox_pids.add(batch, answers)
+        return ready_devs, next_batches
+
+    def close(self) -> list[tuple]:
+        if self.eox_pids is None:
+            return []
+        return self.eox_pids.close()
+
+
+# Packs EOX lookups by product ID for Cisco records whose warranty summaries
+# are in. Each product ID is looked up once per run (or not at all if it is in
+# the vendor cache), in batches of product IDs, and its EOX record is then
+# handed to every record with that product ID as if it had been looked up by
+# S/N. Records whose product ID was already answered don't wait for a lookup.
+# Records without a product ID are looked up by S/N instead.
+class CiscoEoxPidPacker:
+    def __init__(self, provider: CiscoProvider):
+        self.pid_packer = BatchPacker(provider.lookups['cisco-eox-pid'][0])
+        self.pid_ttl = provider.lookups['cisco-eox-pid'][2]
+        self.serial_packer = provider.make_packer('cisco-eox')
+        self.eox_records = dict()
+        self.waiting = dict()
+
+    # Add the given records with the given warranty summaries for them.
+    # Return the lookups they led to as (kind, packed batch) pairs: batches
+    # of product IDs to look up ('cisco-eox-pid'), and batches of records
+    # with their EOX records ('cisco-eox'), either already answered or to
+    # look up by S/N.
+    def add(self, cisco_devs: list[SnowRecord],
+            warranty_answers: list[dict]) -> list[tuple]:
+        warranty_pids = get_cisco_warranty_pids(warranty_answers)
+
+        # Hand the records with an answered product ID their EOX records,
+        # and make the rest wait for their product ID's lookup.
+        answered = []
+        new_pids = []
+        for cisco_dev in cisco_devs:
+            cis_pid = warranty_pids.get(cisco_dev['serial_number'])
+            if cis_pid is None:
+                continue
+            if cis_pid in self.eox_records.keys():
+                answered.append((cisco_dev, cis_pid))
+                continue
+            if cis_pid not in self.waiting.keys():
+                self.waiting[cis_pid] = []
+                new_pids.append(cis_pid)
+            self.waiting[cis_pid].append(cisco_dev)
+
+        # Product IDs in the vendor cache don't need a lookup either.
+        cached = VENDOR_CACHE.get_many('cisco-eox-pid', new_pids,
+                                       self.pid_ttl)
+        for cis_pid, eox_record in cached.items():
+            self.eox_records[cis_pid] = eox_record
+            answered += [(cisco_dev, cis_pid)
+                         for cisco_dev in self.waiting.pop(cis_pid)]
+
+        batches = []
+        if answered:
+            batches.append(('cisco-eox', self.get_answer(answered)))
+        batches += [('cisco-eox', packed_batch)
+                    for packed_batch in self.serial_packer.add([
+                        cisco_dev for cisco_dev in cisco_devs
+                        if cisco_dev['serial_number'] not in
+                        warranty_pids.keys()])]
+        batches += [('cisco-eox-pid', (batch, None))
+                    for batch in self.pid_packer.add([
+                        cis_pid for cis_pid in new_pids
+                        if cis_pid not in cached.keys()])]
+        return batches
+
+    # Remember the given EOX records for the given product IDs, and return
+    # the records that were waiting for them along with their EOX records.
+    def resolve(self, batch_pids: list[str],
+                eox_answers: list[dict]) -> tuple[list[SnowRecord], list]:
+        # A product ID the API left out has no EOX record.
+        eox_records = {eox_record['EOXInputValue']: eox_record
+                       for eox_record in eox_answers}
+        answered = []
+        for cis_pid in batch_pids:
+            self.eox_records[cis_pid] = eox_records.get(cis_pid)
+            answered += [(cisco_dev, cis_pid)
+                         for cisco_dev in self.waiting.pop(cis_pid)]
+        return self.get_answer(answered)
+
+    # Return the given (record, product ID) pairs' records and the EOX
+    # records answering for them by S/N.
+    def get_answer(self, answered: list[tuple[SnowRecord, str]]) \
+            -> tuple[list[SnowRecord], list[dict]]:
+        return [cisco_dev for cisco_dev, _ in answered], [
+            dict(self.eox_records[cis_pid],
+                 EOXInputValue=cisco_dev['serial_number'])
+            for cisco_dev, cis_pid in answered
+            if self.eox_records[cis_pid] is not None]
+
+    # Return the last partial batches, like add().
+    def close(self) -> list[tuple]:
+        return [('cisco-eox', packed_batch)
+                for packed_batch in self.serial_packer.close()] + \
+            [('cisco-eox-pid', (batch, None))
+             for batch in self.pid_packer.close()]
+
+
 # Given a Cisco device and the related ServiceNow record, update ServiceNow
 # if the records don't match.
 def update_snow_cisco_record(cis_dev, snow_cis_dev):
@@ -367,34 +2704,9 @@ def update_snow_cisco_record(cis_dev, snow_cis_dev):
             snow_cis_dev['u_active_support_contract'] = 'true'
             snow_update['u_active_support_contract'] = 'true'
 
-    # Update ServiceNow if needed.
+    # Stage this update until the record's other stages are done.
     if snow_update:
-        snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
-        print('Updating Cisco record: ' + snow_cis_dev['name'])
-
-        # Try to update this record.
-        try:
-            snow_cmdb_table.update(
-                query={
-                    'name': snow_cis_dev['name'],
-                    'serial_number': snow_cis_dev['serial_number']
-                },
-                payload=snow_update
-            )
-        except exceptions.MultipleResults:
-            # We got multiple results. Must be a duplicate.
-            print('Cisco record has a duplicate(s) and can not be updated!')
-            print('  Name: ' + snow_cis_dev['name'])
-            print('  S/N: ' + snow_cis_dev['serial_number'])
-            return
-        except exceptions.NoResults:
-            # We didn't get any results. We can't update this record.
-            print('Cisco record could not be found!')
-            print('  Name: ' + snow_cis_dev['name'])
-            print('  S/N: ' + snow_cis_dev['serial_number'])
-            return
-
-        print('Finished updating Cisco record: ' + snow_cis_dev['name'])
+        SNOW_CHANGE_SET.stage(snow_cis_dev, snow_update)
 
 
 # Given a Dell device and the related ServiceNow record, update ServiceNow
@@ -423,40 +2735,15 @@ def update_snow_dell_record(dell_dev, snow_dell_dev):
         snow_dell_dev['u_valid_warranty_data'] = 'true'
         snow_update['u_valid_warranty_data'] = 'true'
 
-    # Update ServiceNow if needed.
+    # Stage this update until the record's other stages are done.
     if snow_update:
-        snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
-        print('Updating Dell record: ' + snow_dell_dev['name'])
-
-        # Try to update this record.
-        try:
-            snow_cmdb_table.update(
-                query={
-                    'name': snow_dell_dev['name'],
-                    'serial_number': snow_dell_dev['serial_number']
-                },
-                payload=snow_update
-            )
-        except exceptions.MultipleResults:
-            # We got multiple results. Must be a duplicate.
-            print('Dell record has duplicate and can not be updated!')
-            print('  Name: ' + snow_dell_dev['name'])
-            print('  S/N: ' + snow_dell_dev['serial_number'])
-            print('  Asset Tag: ' + snow_dell_dev['asset_tag'])
-        except exceptions.NoResults:
-            # We didn't get any results. We can't update this record.
-            print('Dell record could not be found!')
-            print('  Name: ' + snow_dell_dev['name'])
-            print('  S/N: ' + snow_dell_dev['serial_number'])
-            print('  Asset Tag: ' + snow_dell_dev['asset_tag'])
-
-        print('Finished updating Dell record: ' + snow_dell_dev['name'])
+        SNOW_CHANGE_SET.stage(snow_dell_dev, snow_update)
 
 
 # Given a Dell device with no warranty and the related ServiceNow record,
 # update ServiceNow if the records don't match.
 def update_snow_dell_no_warranty(dell_dev, snow_dell_dev):
-    print('No warranty detected: ' + dell_dev['serviceTag'])
+    LOGGER.debug('No warranty detected: %s', dell_dev['serviceTag'])
     snow_update = {}
 
     # Check if the warranty end date is not in ServiceNow.
@@ -469,198 +2756,44 @@ def update_snow_dell_no_warranty(dell_dev, snow_dell_dev):
         snow_dell_dev['u_valid_warranty_data'] = 'false'
         snow_update['u_valid_warranty_data'] = 'false'
 
-    # Update ServiceNow if needed.
+    # Stage this update until the record's other stages are done.
     if snow_update:
-        snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
-        print('Updating Dell record: ' + snow_dell_dev['name'])
-
-        # Try to update this record.
-        try:
-            snow_cmdb_table.update(
-                query={
-                    'name': snow_dell_dev['name'],
-                    'serial_number': snow_dell_dev['serial_number']
-                },
-                payload=snow_update
-            )
-        except exceptions.MultipleResults:
-            # We got multiple results. Must be a duplicate.
-            print('Dell record has duplicate and can not be updated!')
-            print('  Name: ' + snow_dell_dev['name'])
-            print('  S/N: ' + snow_dell_dev['serial_number'])
-            print('  Asset Tag: ' + snow_dell_dev['asset_tag'])
-        except exceptions.NoResults:
-            # We didn't get any results. We can't update this record.
-            print('Dell record could not be found!')
-            print('  Name: ' + snow_dell_dev['name'])
-            print('  S/N: ' + snow_dell_dev['serial_number'])
-            print('  Asset Tag: ' + snow_dell_dev['asset_tag'])
-
-        print('Finished updating Dell record: ' + snow_dell_dev['name'])
+        SNOW_CHANGE_SET.stage(snow_dell_dev, snow_update)
 
 
 # Update the 'serial_number' field to a valid serial number in ServiceNow
-# for a given Cisco device.
-def update_snow_cisco_sn(snow_cis_dev, new_sn):
-    snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
-    print('S/N found in the asset tag field! Updating S/N field for Cisco '
-          'record: ' + snow_cis_dev['name'])
-
-    # Try to update this record.
-    try:
-        snow_cmdb_table.update(
-            query={
-                'name': snow_cis_dev['name'],
-                'asset_tag': snow_cis_dev['asset_tag']
-            },
-            payload={
-                'serial_number': new_sn
-            }
-        )
-    except exceptions.MultipleResults:
-        # We got multiple results. Must be a duplicate.
-        print('Cisco record has a duplicate and the S/N can not be updated!')
-        print('  Name: ' + snow_cis_dev['name'])
-        print('  S/N: ' + snow_cis_dev['serial_number'])
-        print('  Asset Tag: ' + snow_cis_dev['asset_tag'])
-        return
-    except exceptions.NoResults:
-        # We didn't get any results. We can't update this record.
-        print('Cisco record could not be found!')
-        print('  Name: ' + snow_cis_dev['name'])
-        print('  S/N: ' + snow_cis_dev['serial_number'])
-        print('  Asset Tag: ' + snow_cis_dev['asset_tag'])
-        return
-
-    print('S/N field for Cisco record ' + snow_cis_dev['name'] +
-          ' has been updated successfully!')
-
-
-# Update the 'serial_number' field to a valid serial number in ServiceNow
-# for a given Dell device.
-def update_snow_dell_sn(snow_dell_dev, new_sn):
-    snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
-    print('S/N found in the asset tag field! Updating S/N field for Dell '
-          'record: ' + snow_dell_dev['name'])
-
-    # Try to update this record.
-    try:
-        snow_cmdb_table.update(
-            query={
-                'name': snow_dell_dev['name'],
-                'asset_tag': snow_dell_dev['asset_tag']
-            },
-            payload={
-                'serial_number': new_sn
-            }
-        )
-    except exceptions.MultipleResults:
-        # We got multiple results. Must be a duplicate.
-        print('Dell record has a duplicate and the S/N can not be updated!')
-        print('  Name: ' + snow_dell_dev['name'])
-        print('  S/N: ' + snow_dell_dev['serial_number'])
-        print('  Asset Tag: ' + snow_dell_dev['asset_tag'])
-        return
-    except exceptions.NoResults:
-        # We didn't get any results. We can't update this record.
-        print('Dell record could not be found!')
-        print('  Name: ' + snow_dell_dev['name'])
-        print('  S/N: ' + snow_dell_dev['serial_number'])
-        print('  Asset Tag: ' + snow_dell_dev['asset_tag'])
-        return
-
-    print('S/N field for Dell record ' + snow_dell_dev['name'] +
-          ' has been updated successfully!')
-
-
-# Update the invalid warranty field for the given Cisco device in ServiceNow.
-def update_snow_cisco_invalid_data(snow_cis_dev, invalid_reason):
-    print('Invalid data for Cisco device: ' + snow_cis_dev['name'])
-    print('  Reason: ' + invalid_reason)
-    snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
-    snow_update = {}
-
-    # Check if this field is set correctly.
-    if snow_cis_dev['u_valid_warranty_data'] != 'false':
-        snow_cis_dev['u_valid_warranty_data'] = 'false'
-        snow_update['u_valid_warranty_data'] = 'false'
-
-    # Check if this ServiceNow record needs to be updated.
-    if snow_update:
-        # Try to update this record.
-        try:
-            snow_cmdb_table.update(
-                query={
-                    'sys_id': snow_cis_dev['sys_id']
-                },
-                payload=snow_update
-            )
-        except exceptions.MultipleResults:
-            # We got multiple results. Must be a duplicate.
-            print('Cisco record has duplicate and the valid data '
-                  'field can not be updated to false!')
-            print('  Name: ' + snow_cis_dev['name'])
-            print('  S/N: ' + snow_cis_dev['serial_number'])
-            print('  Asset Tag: ' + snow_cis_dev['asset_tag'])
-            return
-        except exceptions.NoResults:
-            # We didn't get any results. We can't update this record.
-            print('Cisco record could not be found!')
-            print('  Name: ' + snow_cis_dev['name'])
-            print('  S/N: ' + snow_cis_dev['serial_number'])
-            print('  Asset Tag: ' + snow_cis_dev['asset_tag'])
-            return
-
-        print('Valid data field for Cisco record ' + snow_cis_dev['name']
-              + ' has been updated to false!')
-
-
-# Update the invalid warranty field for the given Dell device in ServiceNow.
-def update_snow_dell_invalid_data(snow_dell_dev, invalid_reason):
-    print('Invalid data for Dell device: ' + snow_dell_dev['name'])
-    print('  Reason: ' + invalid_reason)
-    snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
+# for a given device of the given vendor.
+def update_snow_sn(snow_dev, vendor, new_sn):
+    LOGGER.debug('S/N found in the asset tag field! Updating S/N field for '
+                 '%s record: %s', vendor, snow_dev['name'],
+                 extra={'record': snow_dev['name'], 'vendor': vendor})
+
+    # Stage this update until the record's other stages are done.
+    SNOW_CHANGE_SET.stage(snow_dev, {'serial_number': new_sn})
+
+
+# Update the invalid warranty field for the given device of the given vendor
+# in ServiceNow.
+def update_snow_invalid_data(snow_dev, vendor, invalid_reason):
+    LOGGER.debug('Invalid data for %s device: %s (reason: %s)', vendor,
+                 snow_dev['name'], invalid_reason,
+                 extra={'record': snow_dev['name'], 'vendor': vendor,
+                        'reason': invalid_reason})
     snow_update = {}
 
     # Check if this field is set correctly.
-    if snow_dell_dev['u_valid_warranty_data'] != 'false':
-        snow_dell_dev['u_valid_warranty_data'] = 'false'
+    if snow_dev['u_valid_warranty_data'] != 'false':
+        snow_dev['u_valid_warranty_data'] = 'false'
         snow_update['u_valid_warranty_data'] = 'false'
 
-    # Check if this ServiceNow record needs to be updated.
+    # Stage this update until the record's other stages are done.
     if snow_update:
-        # Try to update this record.
-        try:
-            snow_cmdb_table.update(
-                query={
-                    'sys_id': snow_dell_dev['sys_id']
-                },
-                payload=snow_update
-            )
-        except exceptions.MultipleResults:
-            # We got multiple results. Must be a duplicate.
-            print('Dell record has duplicate and the valid data '
-                  'field can not be updated!')
-            print('  Name: ' + snow_dell_dev['name'])
-            print('  S/N: ' + snow_dell_dev['serial_number'])
-            print('  Asset Tag: ' + snow_dell_dev['asset_tag'])
-            return
-        except exceptions.NoResults:
-            # We didn't get any results. We can't update this record.
-            print('Dell record could not be found!')
-            print('  Name: ' + snow_dell_dev['name'])
-            print('  S/N: ' + snow_dell_dev['serial_number'])
-            print('  Asset Tag: ' + snow_dell_dev['asset_tag'])
-            return
-
-        print('Valid data field for Dell record ' + snow_dell_dev[
-            'name'] + ' has been updated to false!')
+        SNOW_CHANGE_SET.stage(snow_dev, snow_update)
 
 
 # This function will update the provided record into ServiceNow with
 # the provided end-of-life string.
 def update_snow_cisco_eol(snow_cis_dev, eol_str):
-    snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
     snow_update = {}
 
     # Check if this field is set correctly.
@@ -672,44 +2805,16 @@ def update_snow_cisco_eol(snow_cis_dev, eol_str):
         snow_cis_dev['u_valid_warranty_data'] = 'true'
         snow_update['u_valid_warranty_data'] = 'true'
 
-    # Check if this ServiceNow record needs to be updated.
+    # Stage this update until the record's other stages are done.
     if snow_update:
-        print('Updating EoL for Cisco device: ' + snow_cis_dev['name'])
-
-        # Try to update this record.
-        try:
-            snow_cmdb_table.update(
-                query={
-                    'name': snow_cis_dev['name'],
-                    'serial_number': snow_cis_dev['serial_number']
-                },
-                payload=snow_update
-            )
-        except exceptions.MultipleResults:
-            # We got multiple results. Must be a duplicate.
-            print('Cisco record has duplicate and the EoL field can not be '
-                  'updated!')
-            print('  Name: ' + snow_cis_dev['name'])
-            print('  S/N: ' + snow_cis_dev['serial_number'])
-            print('  Asset Tag: ' + snow_cis_dev['asset_tag'])
-            return
-        except exceptions.NoResults:
-            # We didn't get any results. We can't update this record.
-            print('Cisco record could not be found!')
-            print('  Name: ' + snow_cis_dev['name'])
-            print('  S/N: ' + snow_cis_dev['serial_number'])
-            print('  Asset Tag: ' + snow_cis_dev['asset_tag'])
-            return
-
-        print('EoL was updated for Cisco device: ' + snow_cis_dev['name'] +
-              '!')
+        SNOW_CHANGE_SET.stage(snow_cis_dev, snow_update)
 
 
 # This function will update the provided record into ServiceNow with no
 # end-of-life information.
 def update_snow_cisco_no_eol(snow_cis_dev):
-    print('No EOL information found for Cisco device: ' + snow_cis_dev['name'])
-    snow_cmdb_table = SNOW_CLIENT.resource(api_path=SNOW_CMDB_PATH)
+    LOGGER.debug('No EOL information found for Cisco device: %s',
+                 snow_cis_dev['name'])
     snow_update = {}
 
     # Check if this field is set correctly.
@@ -717,49 +2822,1153 @@ def update_snow_cisco_no_eol(snow_cis_dev):
         snow_cis_dev['u_end_of_life'] = ''
         snow_update['u_end_of_life'] = ''
 
-    # Check if this ServiceNow record needs to be updated.
+    # Stage this update until the record's other stages are done.
     if snow_update:
-        print('Updating EoL for Cisco device: ' + snow_cis_dev['name'])
+        SNOW_CHANGE_SET.stage(snow_cis_dev, snow_update)
+
+
+# Collects the field updates each stage of a vendor pipeline wants for a
+# ServiceNow record, and writes the record back only once all of its stages
+# are done. Each record is then written at most once per run, with the final
+# state of all its fields. Updates are kept by record rather than by sys_id,
+# since the same sys_id can be in more than one instance (such as a clone).
+class SnowChangeSet:
+    def __init__(self):
+        self.changes = dict()
+        self.lock = threading.Lock()
+
+    # Merge the given field updates into the staged updates for this record.
+    def stage(self, snow_dev: SnowRecord, snow_update: dict[str, str]):
+        with self.lock:
+            self.changes.setdefault(snow_dev, (snow_dev, {}))[1].update(
+                snow_update)
+
+    # Remove and return the staged (record, field updates) pairs for the given
+    # records, which must have no stages left to run. Fields that end up
+    # back at the value read from the CMDB are left out, and so are records
+    # with no fields left.
+    def pop(self, snow_devs) -> list[tuple]:
+        with self.lock:
+            changes = [self.changes.pop(snow_dev, None)
+                       for snow_dev in snow_devs]
+        changes = get_net_changes(changes)
+        RUN_JOURNAL.add(snow_devs, changes)
+        METRICS.count('records_changed', len(changes))
+        METRICS.count('records_unchanged', len(snow_devs) - len(changes))
+        return changes
+
+    # Remove and return every staged (record, field updates) pair of the
+    # given instance's records. Their records may still have stages left, so
+    # they aren't journaled and a resumed run does them again.
+    def pop_all(self, snow_instance: SnowInstance) -> list[tuple]:
+        with self.lock:
+            snow_devs = [snow_dev for snow_dev in self.changes.keys()
+                         if snow_dev.instance is snow_instance]
+            changes = [self.changes.pop(snow_dev) for snow_dev in snow_devs]
+        return get_net_changes(changes)
+
+    # Write back the staged updates for the given records, which must have
+    # no stages left to run. The writes run in the given pool if there is one.
+    def commit(self, snow_devs,
+               write_pool: concurrent.futures.ThreadPoolExecutor = None):
+        write_jobs = [(write_snow_record, *change)
+                      for change in self.pop(snow_devs)]
+        if write_pool is not None:
+            run_write_jobs(write_pool, write_jobs)
+            return
+        for write_job in write_jobs:
+            write_job[0](*write_job[1:])
+
+    # Write back the staged updates for every record of the given instance
+    # left in the change set.
+    def commit_all(self, snow_instance: SnowInstance):
+        for change in self.pop_all(snow_instance):
+            write_snow_record(*change)
+
+
+# Return the given staged (record, field updates) pairs with only the fields
+# each record really changes, leaving out missing pairs and records with
+# nothing left to write.
+def get_net_changes(changes: list[tuple]) -> list[tuple]:
+    net_changes = []
+    for change in changes:
+        if change is None:
+            continue
+        snow_dev, snow_update = change
+        snow_update = snow_dev.get_net_update(snow_update)
+        if snow_update:
+            net_changes.append((snow_dev, snow_update))
+    return net_changes
+
+
+# Write the given field updates for a record back to its ServiceNow instance,
+# either through the instance's bulk write buffer or right away.
+def write_snow_record(snow_dev: SnowRecord, snow_update: dict[str, str]):
+    snow_instance = snow_dev.instance
+
+    # Save this update to the plan instead when only planning.
+    if SNOW_PLAN.enabled:
+        SNOW_PLAN.add([(snow_dev, snow_update)])
+        return
+
+    # Queue this update for the next bulk write if enabled.
+    if SNOW_FLUSH_SIZE:
+        snow_instance.write_buffer.add(snow_dev, snow_update)
+        return
 
-        # Try to update this record.
+    LOGGER.debug('Updating record: %s', snow_dev['name'],
+                 extra={'record': snow_dev['name']})
+
+    # Update this record directly by its sys_id. There is no lookup first, so
+    # this is a single request.
+    snow_resp = REQUEST_SCHEDULER.send(
+        snow_instance.endpoint, snow_instance.client.session, 'PATCH',
+        snow_instance.table_url + '/' + snow_dev['sys_id'],
+        params=SNOW_WRITE_PARAMS,
+        json=snow_update)
+
+    # Check if this record is gone. We can't update it.
+    if snow_resp.status_code == 404:
+        log_missing_snow_record(snow_dev)
+        RUN_JOURNAL.mark_written(snow_instance, [snow_dev['sys_id']])
+        return
+    snow_resp.raise_for_status()
+    RUN_JOURNAL.mark_written(snow_instance, [snow_dev['sys_id']])
+    SNOW_SNAPSHOT.stage_updates(snow_instance,
+                                [(snow_dev['sys_id'], snow_update)])
+    METRICS.count('records_written', instance=snow_instance.name)
+
+    LOGGER.debug('Finished updating record: %s', snow_dev['name'],
+                 extra={'record': snow_dev['name']})
+
+
+# Report a record that could not be found when writing it back.
+def log_missing_snow_record(snow_dev: SnowRecord):
+    LOGGER.warning('Record could not be found! Name: %s, S/N: %s, Asset '
+                   'Tag: %s', snow_dev['name'], snow_dev['serial_number'],
+                   snow_dev['asset_tag'],
+                   extra={'record': snow_dev['name'],
+                          'sys_id': snow_dev['sys_id']})
+    METRICS.count('records_missing', instance=snow_dev.instance.name)
+
+
+# A plan of record updates: when planning, every update a run would write
+# back is saved to a JSON Lines file instead, one record update per line with
+# its instance, sys_id and name. A saved plan is written back later with
+# apply_snow_plan(), so the lookups can run ahead of a short write window.
+class SnowPlan:
+    def __init__(self):
+        self.plan_file = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # Whether updates go to a plan instead of ServiceNow.
+    @property
+    def enabled(self) -> bool:
+        return self.plan_file is not None
+
+    # Start saving every update to a new plan at the given path.
+    def open(self, path: str):
+        self.plan_file = open(path, 'w')
+
+    # Save the given (record, field updates) pairs to the plan.
+    def add(self, changes: list[tuple]):
+        lines = [json.dumps({'instance': snow_dev.instance.name,
+                             'sys_id': snow_dev['sys_id'],
+                             'name': snow_dev['name'],
+                             'updates': snow_update},
+                            separators=(',', ':')) + '\n'
+                 for snow_dev, snow_update in changes]
+        with self.lock:
+            self.plan_file.writelines(lines)
+            self.count += len(lines)
+
+    # Finish the plan.
+    def close(self):
+        self.plan_file.close()
+        self.plan_file = None
+        LOGGER.info('Planned %d record updates', self.count)
+
+
+# Return the updates of the saved plan at the given path for each of the
+# given instances, as (record, field updates) pairs. Updates for the same
+# record are merged in the order they were planned. Updates for an instance
+# that isn't configured are left out. A line that isn't a planned update
+# raises a ValueError, so a damaged plan is turned down as a whole instead
+# of being written back in part.
+def load_snow_plan(path: str, snow_instances: list[SnowInstance]) \
+        -> dict[SnowInstance, list[tuple]]:
+    instances_by_name = {snow_instance.name: snow_instance
+                         for snow_instance in snow_instances}
+    plan = {snow_instance: dict() for snow_instance in snow_instances}
+    skipped = collections.Counter()
+    with open(path) as plan_file:
+        for line_number, line in enumerate(plan_file, 1):
+            if not line.strip():
+                continue
+            try:
+                planned = parse_snow_plan_line(line)
+            except ValueError as error:
+                raise ValueError('line %d: %s' % (line_number, error)) \
+                    from None
+            snow_instance = instances_by_name.get(planned['instance'])
+            if snow_instance is None:
+                skipped[planned['instance']] += 1
+                continue
+            snow_dev, snow_update = plan[snow_instance].setdefault(
+                planned['sys_id'],
+                (get_bare_snow_record(snow_instance, planned['sys_id'],
+                                      planned['name']), {}))
+            snow_update.update(planned['updates'])
+
+    for name, count in skipped.items():
+        LOGGER.warning('Skipping %d planned updates for unknown ServiceNow '
+                       'instance %s', count, name)
+    return {snow_instance: list(changes.values())
+            for snow_instance, changes in plan.items()}
+
+
+# Return the planned record update on the given line of a saved plan, as
+# SnowPlan.add() saved it. Raise a ValueError if the line isn't one.
+def parse_snow_plan_line(line: str) -> dict:
+    planned = json.loads(line)
+    if not isinstance(planned, dict):
+        raise ValueError('not a JSON object')
+    for key in ('instance', 'sys_id', 'name'):
+        if not isinstance(planned.get(key), str):
+            raise ValueError('%r is missing or not a string' % key)
+    snow_update = planned.get('updates')
+    if not isinstance(snow_update, dict) or \
+       not all(isinstance(value, str) for value in snow_update.values()):
+        raise ValueError("'updates' is missing or not an object of strings")
+    return planned
+
+
+# Write the saved plan at the given path back to the given ServiceNow
+# instances, up to 'instance-workers' of them at the same time. Nothing is
+# read from the CMDB or the vendor APIs. Return whether every update was
+# written. A plan that can't be read is not written at all.
+def apply_snow_plan(path: str, snow_instances: list[SnowInstance]) -> bool:
+    try:
+        plan = load_snow_plan(path, snow_instances)
+    except (OSError, ValueError) as error:
+        LOGGER.error('Can\'t apply the plan %s: %s', path, error)
+        return False
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=SNOW_INSTANCE_WORKERS,
+            thread_name_prefix='instance') as instance_pool:
+        results = list(instance_pool.map(
+            apply_snow_instance_plan, snow_instances,
+            [plan[snow_instance] for snow_instance in snow_instances]))
+
+    failed = [snow_instance.name for snow_instance, instance_ok in
+              zip(snow_instances, results) if not instance_ok]
+    if failed:
+        LOGGER.error('Failed ServiceNow instances: %s', ', '.join(failed))
+        return False
+    return True
+
+
+# Write the given planned (record, field updates) pairs back to the given
+# ServiceNow instance. Bulk writes send as many batches at once as the
+# instance's connection pool holds, instead of one at a time. Return whether
+# every update was written.
+def apply_snow_instance_plan(snow_instance: SnowInstance,
+                             changes: list[tuple]) -> bool:
+    LOGGER.info('Applying %d planned record updates to ServiceNow instance '
+                '%s...', len(changes), snow_instance.name,
+                extra={'instance': snow_instance.name})
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=SNOW_POOL_SIZE,
+                thread_name_prefix='apply') as write_pool:
+            if not SNOW_FLUSH_SIZE:
+                failed = 0
+                run_write_jobs(write_pool, [(write_snow_record, *change)
+                                            for change in changes])
+            else:
+                snow_devs = {snow_dev['sys_id']: snow_dev
+                             for snow_dev, _ in changes}
+                failed = sum(write_pool.map(
+                    functools.partial(post_snow_batch_updates, snow_instance,
+                                      snow_devs=snow_devs),
+                    batcher([(snow_dev['sys_id'], snow_update)
+                             for snow_dev, snow_update in changes],
+                            SNOW_FLUSH_SIZE)))
+    except Exception as error:
+        LOGGER.error('ServiceNow instance %s failed: %r', snow_instance.name,
+                     error, extra={'instance': snow_instance.name})
+        METRICS.count('instance_failures', instance=snow_instance.name,
+                      error=type(error).__name__)
+        return False
+    if failed:
+        return False
+
+    LOGGER.info('ServiceNow instance %s updated!', snow_instance.name,
+                extra={'instance': snow_instance.name})
+    return True
+
+
+# Collects field updates for the given ServiceNow instance and writes them in
+# bulk through its Batch API. Pending updates for the same record are merged,
+# so each record is written once per flush no matter how many fields changed.
+# The buffer is flushed once it holds 'flush_size' records, every
+# 'flush_interval' seconds (if above 0), and when it is closed.
+class SnowWriteBuffer:
+    def __init__(self, snow_instance: 'SnowInstance', flush_size: int,
+                 flush_interval: float):
+        self.snow_instance = snow_instance
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = dict()
+        self.snow_devs = dict()
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = None
+
+    # Merge the given field updates into the pending updates for this record.
+    def add(self, snow_dev: SnowRecord, snow_update: dict[str, str]):
+        with self.lock:
+            self.pending.setdefault(snow_dev['sys_id'], {}).update(snow_update)
+            self.snow_devs[snow_dev['sys_id']] = snow_dev
+            is_full = len(self.pending) >= self.flush_size
+
+            # Start flushing on an interval once there is something to write.
+            if self.flusher is None and self.flush_interval > 0:
+                self.flusher = threading.Thread(target=self.flush_on_interval,
+                                                name='snow-flush',
+                                                daemon=True)
+                self.flusher.start()
+
+        # Write back now if the buffer is full.
+        if is_full:
+            self.flush()
+
+    # Write all pending updates to ServiceNow. Flushes never overlap, so
+    # updates to the same record are always written in order. Every update
+    # of a batch that could not be sent at all counts as failed, so the run
+    # fails and its journal keeps them for --resume.
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, snow_devs = self.pending, self.snow_devs
+                self.pending, self.snow_devs = dict(), dict()
+
+            for batch in batcher(list(pending.items()), self.flush_size):
+                try:
+                    self.failed += post_snow_batch_updates(
+                        self.snow_instance, batch, snow_devs)
+                except Exception as error:
+                    LOGGER.error('Bulk ServiceNow update failed: %r', error,
+                                 extra={'instance': self.snow_instance.name})
+                    self.failed += len(batch)
+
+    # Flush the buffer every flush interval until it is closed.
+    def flush_on_interval(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    # Stop flushing on an interval and write what is left.
+    def close(self):
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+
+
+# Write the given (sys_id, field updates) pairs for the given records (keyed
+# by sys_id) to the given ServiceNow instance in a single Batch API request.
+# Return how many of the updates failed. Updates ServiceNow turned down for
+# good are journaled as done instead, so --resume doesn't send them again.
+def post_snow_batch_updates(snow_instance: SnowInstance, updates,
+                            snow_devs: dict[str, SnowRecord]) -> int:
+    rest_requests = get_snow_batch_requests(snow_instance, updates)
+    LOGGER.info('Writing %d record updates to ServiceNow in bulk...',
+                len(rest_requests), extra={'instance': snow_instance.name})
+    started = time.perf_counter()
+    written = []
+    rejected = []
+    for attempt in range(RETRY_MAX_RETRIES + 1):
+        batch_resp = REQUEST_SCHEDULER.send(
+            snow_instance.endpoint, snow_instance.client.session, 'POST',
+            snow_instance.batch_url,
+            json={
+                'batch_request_id': rest_requests[0]['id'],
+                'rest_requests': rest_requests
+            })
+        batch_resp.raise_for_status()
+
+        # Sub-requests that were throttled or not run at all are tried again
+        # in the next batch.
+        batch_written, batch_rejected, rest_requests = \
+            check_snow_batch_response(batch_resp.json(), rest_requests,
+                                      snow_devs)
+        written += batch_written
+        rejected += batch_rejected
+        if not rest_requests or attempt == RETRY_MAX_RETRIES:
+            break
+        LOGGER.warning('%d bulk record updates were not run, retrying...',
+                       len(rest_requests))
+        time.sleep(get_retry_delay(attempt))
+
+    log_snow_batch_result(snow_instance, written, rest_requests, snow_devs,
+                          time.perf_counter() - started)
+    RUN_JOURNAL.mark_written(snow_instance, written + rejected)
+    SNOW_SNAPSHOT.stage_updates(snow_instance,
+                                get_written_updates(updates, written))
+    return len(updates) - len(written) - len(rejected)
+
+
+# Return the (sys_id, field updates) pairs of the given updates whose sys_id
+# is one of the given written sys_ids.
+def get_written_updates(updates, written: list[str]) -> list[tuple]:
+    written = set(written)
+    return [(sys_id, snow_update) for sys_id, snow_update in updates
+            if sys_id in written]
+
+
+# Return one Batch API PATCH sub-request for each of the given (sys_id, field
+# updates) pairs, addressed by its sys_id in the given instance's CMDB table.
+def get_snow_batch_requests(snow_instance: SnowInstance,
+                            updates) -> list[dict]:
+    rest_requests = []
+    for sys_id, snow_update in updates:
+        rest_requests.append({
+            'id': sys_id,
+            'method': 'PATCH',
+            'url': snow_instance.table_api_path + '/' + sys_id +
+                   '?sysparm_fields=' + SNOW_WRITE_PARAMS['sysparm_fields'],
+            'headers': [
+                {'name': 'Content-Type', 'value': 'application/json'},
+                {'name': 'Accept', 'value': 'application/json'}
+            ],
+            'body': base64.b64encode(
+                json.dumps(snow_update).encode()).decode()
+        })
+    return rest_requests
+
+
+# Check the given Batch API response to the given sub-requests for the given
+# records (keyed by sys_id), reporting any update that failed. Return the
+# sys_ids of the updates that were written, the sys_ids of the updates
+# ServiceNow turned down for good, and the sub-requests that were throttled
+# or not run and should be sent again. A record that is gone (404) or an
+# update ServiceNow rejects (any other 4xx) would only be turned down again.
+def check_snow_batch_response(batch_resp: dict, rest_requests: list[dict],
+                              snow_devs: dict[str, SnowRecord]) \
+        -> tuple[list[str], list[str], list[dict]]:
+    written = []
+    rejected = []
+    retry_ids = set(batch_resp['unserviced_requests'])
+    for serviced_req in batch_resp['serviced_requests']:
+        snow_dev = snow_devs[serviced_req['id']]
+        status_code = serviced_req['status_code']
+        if status_code in RETRY_STATUS_CODES:
+            retry_ids.add(serviced_req['id'])
+        elif status_code == 404:
+            # Check if this record is gone. We can't update it.
+            log_missing_snow_record(snow_dev)
+            rejected.append(serviced_req['id'])
+        elif status_code >= 300:
+            LOGGER.warning('Bulk update failed for record: %s (status: %d '
+                           '%s)', snow_dev['name'], status_code,
+                           serviced_req['status_text'],
+                           extra={'record': snow_dev['name'],
+                                  'sys_id': serviced_req['id']})
+            if 400 <= status_code < 500:
+                METRICS.count('records_rejected',
+                              instance=snow_dev.instance.name,
+                              status=str(status_code))
+                rejected.append(serviced_req['id'])
+        else:
+            written.append(serviced_req['id'])
+
+    return written, rejected, [rest_request for rest_request in rest_requests
+                               if rest_request['id'] in retry_ids]
+
+
+# Report the end result of a bulk write to the given instance that took the
+# given number of seconds: how many updates were written (given their
+# sys_ids) and the records (keyed by sys_id) whose sub-requests were never
+# run.
+def log_snow_batch_result(snow_instance: SnowInstance, written: list[str],
+                          rest_requests: list[dict],
+                          snow_devs: dict[str, SnowRecord], seconds: float):
+    for rest_request in rest_requests:
+        snow_dev = snow_devs[rest_request['id']]
+        LOGGER.warning('Bulk update was not run for record: %s',
+                       snow_dev['name'],
+                       extra={'record': snow_dev['name'],
+                              'sys_id': rest_request['id']})
+
+    LOGGER.info('Finished writing %d record updates to ServiceNow in bulk!',
+                len(written), extra={'instance': snow_instance.name})
+    METRICS.observe('write_batch_seconds', seconds,
+                    instance=snow_instance.name)
+    METRICS.count('records_written', len(written),
+                  instance=snow_instance.name)
+
+
+# Runs the whole run on one asyncio event loop instead of threads, so a
+# single process can keep hundreds of requests in flight. It reads the CMDB,
+# looks up vendor data and writes back with the same checks and updates as
+# the threaded vendor pipelines, and shares their vendor cache and tokens.
+class AsyncEngine:
+    def __init__(self):
+        self.scheduler = AsyncRequestScheduler({
+            endpoint: AsyncEndpointLimiter(rate_limit,
+                                           provider.batches_in_flight)
+            for provider in VENDOR_PROVIDERS
+            for endpoint, rate_limit in provider.rate_limits.items()
+        })
+        self.snow_clients = dict()
+        self.vendor_clients = dict()
+        self.pending = dict()
+        self.snow_devs = dict()
+        self.failed = dict()
+        self.lookup_tasks = set()
+
+    # Update every given ServiceNow instance, up to 'instance-workers' of them
+    # at the same time, like run_snow_instances(). Return whether every
+    # instance was updated.
+    async def run(self, snow_instances: list[SnowInstance],
+                  resume: bool) -> bool:
+        for snow_instance in snow_instances:
+            self.scheduler.limiters[snow_instance.endpoint] = \
+                AsyncEndpointLimiter(snow_instance.rate_limit,
+                                     ASYNC_MAX_IN_FLIGHT)
+            self.pending[snow_instance] = dict()
+            self.snow_devs[snow_instance] = dict()
+            self.failed[snow_instance] = 0
+
+        async with contextlib.AsyncExitStack() as clients:
+            for snow_instance in snow_instances:
+                self.snow_clients[snow_instance] = \
+                    await clients.enter_async_context(make_async_http_client(
+                        auth=snow_instance.client.session.auth))
+            for provider in VENDOR_PROVIDERS:
+                self.vendor_clients[provider.name] = \
+                    await clients.enter_async_context(
+                        provider.make_async_client())
+
+            instance_slots = asyncio.Semaphore(SNOW_INSTANCE_WORKERS)
+            results = await asyncio.gather(*(
+                self.run_snow_instance(snow_instance, instance_slots, resume)
+                for snow_instance in snow_instances))
+
+        failed = [snow_instance.name for snow_instance, instance_ok in
+                  zip(snow_instances, results) if not instance_ok]
+        if failed:
+            LOGGER.error('Failed ServiceNow instances: %s', ', '.join(failed))
+            return False
+        return True
+
+    # Get and update the devices of every vendor in the given ServiceNow
+    # instance once an instance slot is free, like run_snow_instance().
+    async def run_snow_instance(self, snow_instance: SnowInstance,
+                                instance_slots: asyncio.Semaphore,
+                                resume: bool) -> bool:
+        async with instance_slots:
+            LOGGER.info('Updating ServiceNow instance %s...',
+                        snow_instance.name,
+                        extra={'instance': snow_instance.name})
+            try:
+                run_state = load_run_state(snow_instance)
+                full_read = is_full_run(run_state)
+                await asyncio.to_thread(SNOW_SNAPSHOT.begin, snow_instance,
+                                        resume)
+                await asyncio.to_thread(RUN_JOURNAL.begin, snow_instance,
+                                        resume)
+
+                # Bulk writes also go out every flush interval, so a slow
+                # vendor doesn't hold back the records that are done.
+                closed = asyncio.Event()
+                flusher = None
+                if (SNOW_FLUSH_SIZE and SNOW_FLUSH_INTERVAL > 0
+                        and not SNOW_PLAN.enabled):
+                    flusher = asyncio.create_task(
+                        self.flush_on_interval(snow_instance, closed))
+                try:
+                    await self.write(await asyncio.to_thread(
+                        get_journal_changes, snow_instance))
+                    pipelines_ok = await self.run_vendor_pipelines(
+                        snow_instance, {
+                            provider.name: functools.partial(
+                                provider.run_async_pipeline, self,
+                                snow_instance)
+                            for provider in VENDOR_PROVIDERS
+                        }, run_state)
+                finally:
+                    closed.set()
+                    if flusher is not None:
+                        await flusher
+
+                # Write any updates still staged (such as from a failed
+                # pipeline) or waiting for a bulk write.
+                await self.write(SNOW_CHANGE_SET.pop_all(snow_instance))
+                while self.pending[snow_instance]:
+                    await self.post_pending(snow_instance)
+                if not pipelines_ok or self.failed[snow_instance]:
+                    return False
+
+                # A plan isn't written yet, like in run_snow_instance().
+                if not SNOW_PLAN.enabled:
+                    save_run_state(snow_instance, run_state)
+                    await asyncio.to_thread(SNOW_SNAPSHOT.commit,
+                                            snow_instance, full_read)
+                await asyncio.to_thread(RUN_JOURNAL.clear, snow_instance)
+            except Exception as error:
+                LOGGER.error('ServiceNow instance %s failed: %r',
+                             snow_instance.name, error,
+                             extra={'instance': snow_instance.name})
+                METRICS.count('instance_failures',
+                              instance=snow_instance.name,
+                              error=type(error).__name__)
+                return False
+
+        LOGGER.info('ServiceNow instance %s updated!', snow_instance.name,
+                    extra={'instance': snow_instance.name})
+        return True
+
+    # Read the given instance's CMDB once and run the given vendor pipelines
+    # on its records at the same time, like run_vendor_pipelines().
+    async def run_vendor_pipelines(self, snow_instance: SnowInstance,
+                                   pipelines: dict[str, Callable],
+                                   run_state: dict[str, str]) -> bool:
+        LOGGER.info('Starting %d vendor pipelines...', len(pipelines))
+
+        # Route the CMDB records to each vendor pipeline in the background.
+        vendor_queues = {vendor: asyncio.Queue(maxsize=SNOW_PAGES_AHEAD)
+                         for vendor in pipelines.keys()}
+        router = asyncio.create_task(self.route_snow_records(
+            snow_instance, vendor_queues, run_state))
+
+        # Report each vendor pipeline once they have all finished.
+        results = await asyncio.gather(
+            *(self.run_vendor_pipeline(pipeline, vendor_queues[vendor])
+              for vendor, pipeline in pipelines.items()),
+            return_exceptions=True)
+        await asyncio.gather(router, return_exceptions=True)
+        failed = []
+        for vendor, result in zip(pipelines.keys(), results):
+            if isinstance(result, Exception):
+                LOGGER.error('%s pipeline failed: %r', vendor, result,
+                             extra={'vendor': vendor})
+                METRICS.count('pipeline_failures', vendor=vendor,
+                              error=type(result).__name__)
+                failed.append(vendor)
+                continue
+
+            LOGGER.info('%s pipeline finished!', vendor,
+                        extra={'vendor': vendor})
+
+        if failed:
+            LOGGER.error('Failed vendor pipelines: %s', ', '.join(failed))
+            return False
+
+        LOGGER.info('All vendor pipelines finished!')
+        return True
+
+    # Run the given vendor pipeline on the pages put in the given queue, like
+    # run_vendor_pipeline().
+    async def run_vendor_pipeline(self, pipeline: Callable,
+                                  vendor_queue: asyncio.Queue):
+        snow_pages = self.iter_queue(vendor_queue)
         try:
-            snow_cmdb_table.update(
-                query={
-                    'name': snow_cis_dev['name'],
-                    'serial_number': snow_cis_dev['serial_number']
-                },
-                payload=snow_update
-            )
-        except exceptions.MultipleResults:
-            # We got multiple results. Must be a duplicate.
-            print('Cisco record has duplicate and the EoL field can not be '
-                  'updated!')
-            print('  Name: ' + snow_cis_dev['name'])
-            print('  S/N: ' + snow_cis_dev['serial_number'])
-            print('  Asset Tag: ' + snow_cis_dev['asset_tag'])
+            await pipeline(snow_pages)
+        except Exception:
+            try:
+                async for _ in snow_pages:
+                    pass
+            except Exception:
+                pass
+            raise
+
+    # Hand out the items put in the given queue until None is found. If an
+    # error is found instead, raise it.
+    async def iter_queue(self, items: asyncio.Queue) -> AsyncIterator:
+        while True:
+            item = await items.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    # Get all supported records from the given ServiceNow instance in a
+    # single pass and hand each page's records to their vendor's queue, like
+    # route_snow_records().
+    async def route_snow_records(self, snow_instance: SnowInstance,
+                                 vendor_queues: dict[str, asyncio.Queue],
+                                 run_state: dict[str, str]):
+        LOGGER.info('Getting all supported records from ServiceNow instance '
+                    '%s...', snow_instance.name,
+                    extra={'instance': snow_instance.name})
+        run_start = time.time()
+        server_dates = []
+        try:
+            seen_sys_ids = await asyncio.to_thread(
+                get_snow_finished_sys_ids, snow_instance)
+            async for snow_page in self.get_snow_run_pages(
+                    snow_instance, run_state, server_dates):
+                vendor_pages = await asyncio.to_thread(
+                    split_snow_page, snow_instance, snow_page,
+                    vendor_queues.keys(), seen_sys_ids)
+                for vendor, vendor_page in vendor_pages.items():
+                    if vendor_page:
+                        await vendor_queues[vendor].put(vendor_page)
+        except Exception as error:
+            for vendor_queue in vendor_queues.values():
+                await vendor_queue.put(error)
+            raise
+
+        run_state['watermark'] = get_next_watermark(server_dates, run_start)
+        for vendor_queue in vendor_queues.values():
+            await vendor_queue.put(None)
+        LOGGER.info('All supported records retrieved from ServiceNow '
+                    'instance %s!', snow_instance.name,
+                    extra={'instance': snow_instance.name})
+
+    # Return the pages of records the given instance's run goes through,
+    # like get_snow_run_pages(). The queries (and snapshot pages) come from
+    # the vendor cache and the snapshot, so each one is taken in a thread.
+    async def get_snow_run_pages(self, snow_instance: SnowInstance,
+                                 run_state: dict[str, str],
+                                 server_dates: list[str]) \
+            -> AsyncIterator[list]:
+        snow_run_queries = get_snow_run_queries(
+            snow_instance, get_snow_supported_query(), run_state)
+        while True:
+            snow_run_query = await asyncio.to_thread(next, snow_run_queries,
+                                                     None)
+            if snow_run_query is None:
+                return
+            if isinstance(snow_run_query, list):
+                yield snow_run_query
+                continue
+            async for snow_page in self.get_snow_record_pages(
+                    snow_instance, snow_run_query, SNOW_RECORD_FIELDS,
+                    server_dates):
+                yield snow_page
+
+    # Get the records matching the given query from the given instance's CMDB
+    # table one page at a time, like get_snow_record_pages().
+    async def get_snow_record_pages(self, snow_instance: SnowInstance,
+                                    snow_query: str, fields: list[str],
+                                    server_dates: list[str] = None) \
+            -> AsyncIterator[list]:
+        offset = 0
+        last_sys_id = None
+        while True:
+            # Get this page of records.
+            snow_resp = await self.scheduler.send(
+                snow_instance.endpoint, self.snow_clients[snow_instance],
+                'GET', snow_instance.table_url,
+                params=get_snow_page_params(snow_query, fields, offset,
+                                            last_sys_id))
+            snow_resp.raise_for_status()
+            if server_dates is not None:
+                server_dates.append(snow_resp.headers.get('Date'))
+            snow_page = snow_resp.json()['result']
+            if snow_page:
+                yield snow_page
+
+            # Check if this was the last page.
+            if len(snow_page) < SNOW_PAGE_SIZE:
+                return
+            offset += len(snow_page)
+            last_sys_id = snow_page[-1]['sys_id']
+
+    # Given pages of the given vendor's records from ServiceNow, update them
+    # with what the vendor's lookups find, like update_snow_vendor_records().
+    # Batches are looked up as soon as they fill up, many at a time.
+    async def run_provider_pipeline(self, provider: VendorProvider,
+                                    snow_instance: SnowInstance,
+                                    snow_pages: AsyncIterator):
+        LOGGER.info('Getting all %s records from ServiceNow...',
+                    provider.name)
+        LOGGER.info('Updating all %s records in ServiceNow...',
+                    provider.name)
+        seen_sns = await asyncio.to_thread(RUN_JOURNAL.get_serials,
+                                           snow_instance, provider.name)
+        counts = collections.Counter()
+        merge = provider.make_merge()
+        await self.run_batches(
+            snow_pages,
+            lambda snow_devs: check_snow_records(snow_devs, provider,
+                                                 seen_sns, counts),
+            [(packer, functools.partial(self.update_provider_batch, provider,
+                                        merge, packer.kind))
+             for packer in provider.make_packers()])
+
+        # Look up the last partial batches of follow-up lookups, until there
+        # are none.
+        while True:
+            next_batches = merge.close()
+            if not next_batches:
+                break
+            await asyncio.gather(*(
+                self.update_provider_batch(provider, merge, kind,
+                                           packed_batch)
+                for kind, packed_batch in next_batches))
+        log_snow_vendor_counts(provider, counts)
+        LOGGER.info('All %s records updated in ServiceNow!', provider.name)
+
+    # Check each of the given pages with 'check_page', which journals what it
+    # finds and so runs in a thread, and write back its invalid records. The
+    # valid records go to each of the given packers, and
+    # each batch a packer makes is handed to its update function. Batches run
+    # at the same time, as many as requests allowed in flight. The first
+    # error raised by a batch is raised here.
+    async def run_batches(self, snow_pages: AsyncIterator,
+                          check_page: Callable,
+                          packers: list[tuple[BatchPacker, Callable]]):
+        batch_slots = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+        batch_tasks = []
+
+        async def start_batch(update_batch, batch):
+            await batch_slots.acquire()
+            batch_tasks.append(asyncio.create_task(self.run_batch(
+                update_batch, batch, batch_slots)))
+
+        async for snow_page in snow_pages:
+            valid_devs, invalid_devs = await asyncio.to_thread(check_page,
+                                                               snow_page)
+            await self.write(await asyncio.to_thread(SNOW_CHANGE_SET.pop,
+                                                     invalid_devs))
+
+            # Start every batch that is full. The rest wait for the next
+            # page. Packing reads the vendor cache, so it runs in a thread.
+            for packer, update_batch in packers:
+                for batch in await asyncio.to_thread(packer.add, valid_devs):
+                    await start_batch(update_batch, batch)
+
+        for packer, update_batch in packers:
+            for batch in packer.close():
+                await start_batch(update_batch, batch)
+        await asyncio.gather(*batch_tasks)
+
+    # Run 'update_batch' on the given batch and free its batch slot.
+    async def run_batch(self, update_batch: Callable,
+                        batch: list[SnowRecord],
+                        batch_slots: asyncio.Semaphore):
+        try:
+            await update_batch(batch)
+        finally:
+            batch_slots.release()
+
+    # Look up the given packed batch with the given kind of the given
+    # vendor's lookups, unless it was all cached. Merge the answers, write
+    # back every record that is done, and run the lookups the batch led to.
+    async def update_provider_batch(self, provider: VendorProvider,
+                                    merge: RecordMerge, kind: str,
+                                    packed_batch: tuple[list, list]):
+        batch, answers = packed_batch
+        if answers is None:
+            answers = await self.lookup_once(
+                kind, provider.get_batch_keys(kind, batch),
+                functools.partial(provider.fetch_async, self.scheduler,
+                                  self.vendor_clients[provider.name], kind),
+                functools.partial(provider.get_answers, kind))
+
+        ready_devs, next_batches = await asyncio.to_thread(
+            merge.merge, kind, batch, answers)
+        await self.write(await asyncio.to_thread(SNOW_CHANGE_SET.pop,
+                                                 ready_devs))
+        await asyncio.gather(*(
+            self.update_provider_batch(provider, merge, next_kind, next_batch)
+            for next_kind, next_batch in next_batches))
+
+    # Look up the given keys with the given kind of vendor lookup through
+    # the lookup coordinator, like update_snow_vendor_records() does. Every
+    # other batch that is ready gets to claim its keys first, so they can
+    # fill up the partial batch this lookup's keys end up in. Each batch is
+    # sent in a task of its own, and the answers are waited for without
+    # blocking the event loop.
+    async def lookup_once(self, kind: str, keys: list[str], fetch: Callable,
+                          split: Callable) -> list[dict]:
+        lookup = VendorLookup(kind, keys, functools.partial(
+            self.start_lookup_batch, kind, fetch, split))
+        await asyncio.sleep(0)
+        lookup.flush()
+        return [answer for answer in await asyncio.gather(
+            *(asyncio.wrap_future(flight) for flight in lookup.flights))
+            if answer is not None]
+
+    # Start sending the given batch of keys of the given kind of vendor
+    # lookup in a task of its own.
+    def start_lookup_batch(self, kind: str, fetch: Callable, split: Callable,
+                           batch: list[str]):
+        lookup_task = asyncio.create_task(self.send_lookup_batch(
+            kind, fetch, split, batch))
+        self.lookup_tasks.add(lookup_task)
+        lookup_task.add_done_callback(self.lookup_tasks.discard)
+
+    # Request the given batch of keys of the given kind of vendor lookup and
+    # hand out its answers, like send_lookup_batch(). Errors go to every
+    # pipeline waiting for the batch. If the lookup is cancelled, the waiting
+    # pipelines get the cancellation and it is passed on.
+    async def send_lookup_batch(self, kind: str, fetch: Callable,
+                                split: Callable, batch: list[str]):
+        try:
+            with METRICS.timer('lookup_batch_seconds', kind=kind):
+                answers = split(await fetch(batch))
+            await asyncio.to_thread(VENDOR_CACHE.put_many, kind, answers)
+        except asyncio.CancelledError as error:
+            LOOKUP_COORDINATOR.land(kind, batch, dict(), error)
+            raise
+        except Exception as error:
+            METRICS.count('lookup_batch_errors', kind=kind,
+                          error=type(error).__name__)
+            LOOKUP_COORDINATOR.land(kind, batch, dict(), error)
+            return
+        LOOKUP_COORDINATOR.land(kind, batch, answers)
+
+    # Write the given (record, field updates) pairs back to their ServiceNow
+    # instances, like write_snow_record(). Bulk writes go out once a full
+    # batch is pending for an instance.
+    async def write(self, changes: list[tuple]):
+        if SNOW_PLAN.enabled:
+            SNOW_PLAN.add(changes)
             return
-        except exceptions.NoResults:
-            # We didn't get any results. We can't update this record.
-            print('Cisco record could not be found!')
-            print('  Name: ' + snow_cis_dev['name'])
-            print('  S/N: ' + snow_cis_dev['serial_number'])
-            print('  Asset Tag: ' + snow_cis_dev['asset_tag'])
+        if not SNOW_FLUSH_SIZE:
+            await asyncio.gather(*(self.write_snow_record(*change)
+                                   for change in changes))
             return
 
-        print('EoL was updated for Cisco device: ' + snow_cis_dev['name'] +
-              '!')
+        for snow_dev, snow_update in changes:
+            self.pending[snow_dev.instance].setdefault(
+                snow_dev['sys_id'], {}).update(snow_update)
+            self.snow_devs[snow_dev.instance][snow_dev['sys_id']] = snow_dev
+        for snow_instance in {snow_dev.instance for snow_dev, _ in changes}:
+            while len(self.pending[snow_instance]) >= SNOW_FLUSH_SIZE:
+                await self.post_pending(snow_instance)
+
+    # Write one batch of the given instance's pending updates in bulk. The
+    # batch is taken out of the pending updates before it is sent, so other
+    # batches can be sent at the same time. Every update of a batch that
+    # could not be sent at all counts as failed, like in
+    # SnowWriteBuffer.flush().
+    async def post_pending(self, snow_instance: SnowInstance):
+        pending = self.pending[snow_instance]
+        updates = list(itertools.islice(pending.items(), SNOW_FLUSH_SIZE))
+        snow_devs = dict()
+        for sys_id, _ in updates:
+            del pending[sys_id]
+            snow_devs[sys_id] = self.snow_devs[snow_instance].pop(sys_id)
+        try:
+            self.failed[snow_instance] += await self.post_snow_batch_updates(
+                snow_instance, updates, snow_devs)
+        except Exception as error:
+            LOGGER.error('Bulk ServiceNow update failed: %r', error,
+                         extra={'instance': snow_instance.name})
+            self.failed[snow_instance] += len(updates)
+
+    # Write the given instance's pending updates in bulk every flush
+    # interval until 'closed' is set, like
+    # SnowWriteBuffer.flush_on_interval().
+    async def flush_on_interval(self, snow_instance: SnowInstance,
+                                closed: asyncio.Event):
+        while True:
+            try:
+                await asyncio.wait_for(closed.wait(), SNOW_FLUSH_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            while self.pending[snow_instance]:
+                await self.post_pending(snow_instance)
+
+    # Write the given field updates for a record right away by its sys_id.
+    async def write_snow_record(self, snow_dev: SnowRecord,
+                                snow_update: dict[str, str]):
+        snow_instance = snow_dev.instance
+        LOGGER.debug('Updating record: %s', snow_dev['name'],
+                     extra={'record': snow_dev['name']})
+        snow_resp = await self.scheduler.send(
+            snow_instance.endpoint, self.snow_clients[snow_instance], 'PATCH',
+            snow_instance.table_url + '/' + snow_dev['sys_id'],
+            params=SNOW_WRITE_PARAMS,
+            json=snow_update)
+
+        # Check if this record is gone. We can't update it.
+        if snow_resp.status_code == 404:
+            log_missing_snow_record(snow_dev)
+            await asyncio.to_thread(RUN_JOURNAL.mark_written, snow_instance,
+                                    [snow_dev['sys_id']])
+            return
+        snow_resp.raise_for_status()
+        await asyncio.to_thread(RUN_JOURNAL.mark_written, snow_instance,
+                                [snow_dev['sys_id']])
+        await asyncio.to_thread(SNOW_SNAPSHOT.stage_updates, snow_instance,
+                                [(snow_dev['sys_id'], snow_update)])
+        METRICS.count('records_written', instance=snow_instance.name)
+
+        LOGGER.debug('Finished updating record: %s', snow_dev['name'],
+                     extra={'record': snow_dev['name']})
+
+    # Write the given (sys_id, field updates) pairs to the given ServiceNow
+    # instance in a single Batch API request, like post_snow_batch_updates().
+    async def post_snow_batch_updates(self, snow_instance: SnowInstance,
+                                      updates,
+                                      snow_devs: dict[str, SnowRecord]) \
+            -> int:
+        rest_requests = get_snow_batch_requests(snow_instance, updates)
+        LOGGER.info('Writing %d record updates to ServiceNow in bulk...',
+                    len(rest_requests),
+                    extra={'instance': snow_instance.name})
+        started = time.perf_counter()
+        written = []
+        rejected = []
+        for attempt in range(RETRY_MAX_RETRIES + 1):
+            batch_resp = await self.scheduler.send(
+                snow_instance.endpoint, self.snow_clients[snow_instance],
+                'POST', snow_instance.batch_url,
+                json={
+                    'batch_request_id': rest_requests[0]['id'],
+                    'rest_requests': rest_requests
+                })
+            batch_resp.raise_for_status()
+
+            # Sub-requests that were throttled or not run at all are tried
+            # again in the next batch.
+            batch_written, batch_rejected, rest_requests = \
+                check_snow_batch_response(batch_resp.json(), rest_requests,
+                                          snow_devs)
+            written += batch_written
+            rejected += batch_rejected
+            if not rest_requests or attempt == RETRY_MAX_RETRIES:
+                break
+            LOGGER.warning('%d bulk record updates were not run, '
+                           'retrying...', len(rest_requests))
+            await asyncio.sleep(get_retry_delay(attempt))
+
+        log_snow_batch_result(snow_instance, written, rest_requests,
+                              snow_devs, time.perf_counter() - started)
+        await asyncio.to_thread(RUN_JOURNAL.mark_written, snow_instance,
+                                written + rejected)
+        await asyncio.to_thread(SNOW_SNAPSHOT.stage_updates, snow_instance,
+                                get_written_updates(updates, written))
+        return len(updates) - len(written) - len(rejected)
+
+
+# Return an asyncio HTTP client that keeps as many connections open as the
+# asyncio engine has requests in flight, and asks for compressed responses.
+def make_async_http_client(**kwargs) -> 'httpx.AsyncClient':
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=ASYNC_MAX_IN_FLIGHT,
+                            max_keepalive_connections=ASYNC_MAX_IN_FLIGHT),
+        timeout=REQUEST_TIMEOUT,
+        headers={'Accept-Encoding': 'gzip, deflate'},
+        **kwargs)
+
+
+# Return an asyncio HTTP client for a vendor API that signs every request
+# with a token from the shared token manager, like get_vendor_session(). The
+# token manager may have to fetch a token, so it is asked from a thread. A
+# request the API turns down as unauthorized is sent once more with a new
+# token, like in TokenAuth.
+def make_async_vendor_client(token_url: str, client_id: str,
+                             client_secret: str) -> 'httpx.AsyncClient':
+    # Signs each request, and sends it again with a new token if needed.
+    class VendorTokenAuth(httpx.Auth):
+        async def async_auth_flow(self, request):
+            token = await asyncio.to_thread(TOKEN_MANAGER.get_token,
+                                            token_url, client_id,
+                                            client_secret)
+            request.headers['Authorization'] = \
+                'Bearer ' + token['access_token']
+            response = yield request
+            if response.status_code != 401:
+                return
+
+            LOGGER.warning('API token from %s was turned down, getting a '
+                           'new one...', token_url)
+            await asyncio.to_thread(TOKEN_MANAGER.invalidate, token_url,
+                                    client_id, token)
+            token = await asyncio.to_thread(TOKEN_MANAGER.get_token,
+                                            token_url, client_id,
+                                            client_secret)
+            request.headers['Authorization'] = \
+                'Bearer ' + token['access_token']
+            yield request
+
+    return make_async_http_client(auth=VendorTokenAuth())
+
+
+# The ServiceNow instances this run updates, each with its own request limit,
+# the updates staged for their records by all vendor pipelines, and the plan
+# they are saved to instead when only planning.
+SNOW_INSTANCES = get_snow_instances()
+REQUEST_SCHEDULER.limiters.update({
+    snow_instance.endpoint: EndpointLimiter(snow_instance.rate_limit,
+                                            SNOW_POOL_SIZE)
+    for snow_instance in SNOW_INSTANCES
+})
+SNOW_CHANGE_SET = SnowChangeSet()
+SNOW_PLAN = SnowPlan()
 
 
 # Main method to run the script.
 if __name__ == '__main__':
-    # Get Cisco devices.
-    snow_cisco_records_dict = get_snow_cisco_records()
-
-    # Update Cisco devices in ServiceNow.
-    update_snow_cisco_warranties(snow_cisco_records_dict)
-
-    # Get Dell devices.
-    snow_dell_records_dict = get_snow_dell_records()
-
-    # Update Dell devices in ServiceNow.
-    update_snow_dell_warranties(snow_dell_records_dict)
+    # Pick the engine to run with. The config file's engine is the default.
+    parser = argparse.ArgumentParser(
+        description='Update Cisco and Dell warranty and end-of-life '
+                    'information in ServiceNow.')
+    parser.add_argument('--resume', action='store_true',
+                        help='pick up a failed run where it stopped, '
+                             'skipping the records it finished and writing '
+                             'the updates it left pending')
+    plan_args = parser.add_mutually_exclusive_group()
+    plan_args.add_argument('--plan', metavar='PLAN_FILE',
+                           help='look everything up but save the record '
+                                'updates to this JSON Lines file instead of '
+                                'writing them to ServiceNow')
+    plan_args.add_argument('--apply', metavar='PLAN_FILE',
+                           help='only write the record updates saved to '
+                                'this file by --plan to ServiceNow')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'],
+                        default=PIPELINE_ENGINE,
+                        help='run with thread pools, or on one asyncio event '
+                             'loop (needs httpx)')
+    parser.add_argument('--log-level', default=LOG_LEVEL,
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        type=str.upper,
+                        help='lowest level to log (DEBUG logs every record)')
+    args = parser.parse_args()
+    if args.engine == 'asyncio' and httpx is None:
+        parser.error('the asyncio engine needs httpx to be installed')
+    if args.resume and (args.plan or args.apply):
+        parser.error('--resume can\'t be used with --plan or --apply')
+
+    # Check the lookup settings before anything is looked up. Applying a plan
+    # doesn't look anything up.
+    if not args.apply:
+        if CISCO_EOX_LOOKUP not in ('serial', 'product-id'):
+            parser.error('[Cisco Info] eox-lookup must be \'serial\' or '
+                         '\'product-id\', not %r' % CISCO_EOX_LOOKUP)
+        if CISCO_EOX_LOOKUP == 'product-id' and not CISCO_BASE_EOX_PID_URL:
+            parser.error('[Cisco Info] eox-lookup is \'product-id\', so '
+                         'base-eox-pid-url has to be filled in')
+    LOGGER.setLevel(args.log_level)
+
+    # Get and update Cisco and Dell devices in every ServiceNow instance, or
+    # only write a saved plan back.
+    if args.plan:
+        SNOW_PLAN.open(args.plan)
+    with METRICS.timer('run_seconds', engine=args.engine):
+        if args.apply:
+            run_ok = apply_snow_plan(args.apply, SNOW_INSTANCES)
+        elif args.engine == 'asyncio':
+            run_ok = asyncio.run(AsyncEngine().run(SNOW_INSTANCES,
+                                                   args.resume))
+        else:
+            run_ok = run_snow_instances(SNOW_INSTANCES, args.resume)
+    if args.plan:
+        SNOW_PLAN.close()
+    LOOKUP_COORDINATOR.log_counts()
+    if METRICS_PATH:
+        METRICS.export(METRICS_PATH, METRICS_FORMAT)
+    if not run_ok:
+        raise SystemExit(1)
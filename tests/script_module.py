@@ -0,0 +1,41 @@
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'benchmarks'))
+
+from mock_services import MockCmdb, MockServices  # noqa: E402
+from run_benchmark import REPO_PATH, SCRIPT_NAME, write_config  # noqa: E402
+
+
+# Loads the script as a module for unit tests. Importing the script reads
+# its config and opens its caches next to it, so each loaded copy gets a
+# work directory of its own, with a config (and the given 'section:key=value'
+# overrides) for mock services serving a CMDB of the given size. Nothing is
+# requested until a test asks for it.
+class ScriptModule:
+    def __init__(self, overrides: list[str] = (), cmdb_size: int = 0):
+        self.services = MockServices(MockCmdb(cmdb_size))
+        self.services.start()
+        self.work_path = tempfile.mkdtemp(prefix='diko-test-')
+        shutil.copytree(REPO_PATH + '/src', self.work_path + '/src',
+                        ignore=shutil.ignore_patterns('__pycache__'))
+        write_config(self.work_path, self.services, list(overrides))
+
+    # Import the script from the work directory and return it.
+    def load(self) -> types.ModuleType:
+        spec = importlib.util.spec_from_file_location(
+            'diko_script', self.work_path + '/src/' + SCRIPT_NAME)
+        script = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(script)
+        return script
+
+    # Stop the mock services and remove the work directory.
+    def close(self):
+        self.services.shutdown()
+        self.services.server_close()
+        shutil.rmtree(self.work_path, ignore_errors=True)
@@ -0,0 +1,139 @@
+import unittest
+
+from script_module import ScriptModule
+
+
+def setUpModule():
+    global script, script_module
+    script_module = ScriptModule()
+    script = script_module.load()
+
+
+def tearDownModule():
+    script_module.close()
+
+
+# Return a CMDB record of the test instance with the given sys_id, read with
+# no warranty data.
+def make_record(sys_id: str) -> 'script.SnowRecord':
+    snow_dev = dict.fromkeys(script.SnowRecord.fields, '')
+    snow_dev.update(sys_id=sys_id, name='ci-' + sys_id,
+                    serial_number='SN' + sys_id)
+    return script.SnowRecord(snow_dev, script.SNOW_INSTANCES[0])
+
+
+# Stage the given field updates for the given record the way the update
+# functions do: set each field on the record, then stage the update.
+def stage(change_set: 'script.SnowChangeSet', snow_dev: 'script.SnowRecord',
+          snow_update: dict[str, str]):
+    for field, value in snow_update.items():
+        snow_dev[field] = value
+    change_set.stage(snow_dev, snow_update)
+
+
+# Checks which field updates a record really makes.
+class NetUpdateTest(unittest.TestCase):
+    # A record no stage has changed writes its updates as they are.
+    def test_unchanged_record_keeps_update(self):
+        snow_dev = make_record('1')
+        snow_update = {'serial_number': 'NEW1'}
+        self.assertEqual(snow_dev.get_net_update(snow_update), snow_update)
+
+    # Fields back at the value read from the CMDB are left out, and fields
+    # with a new value are kept.
+    def test_fields_back_at_original_are_left_out(self):
+        snow_dev = make_record('1')
+        snow_dev['u_valid_warranty_data'] = 'true'
+        snow_dev['warranty_expiration'] = '2030-01-01'
+        snow_dev['u_valid_warranty_data'] = ''
+        self.assertEqual(snow_dev.original, {'u_valid_warranty_data': '',
+                                             'warranty_expiration': ''})
+        self.assertEqual(snow_dev.get_net_update({
+            'u_valid_warranty_data': '',
+            'warranty_expiration': '2030-01-01'
+        }), {'warranty_expiration': '2030-01-01'})
+
+    # The first value read is what a field is compared with, however often
+    # it was changed since.
+    def test_original_is_first_value_read(self):
+        snow_dev = make_record('1')
+        for value in ('true', 'false', 'true'):
+            snow_dev['u_valid_warranty_data'] = value
+        self.assertEqual(snow_dev.original, {'u_valid_warranty_data': ''})
+        self.assertEqual(
+            snow_dev.get_net_update({'u_valid_warranty_data': 'true'}),
+            {'u_valid_warranty_data': 'true'})
+
+    # A field that isn't warranty data has no original value, so it is
+    # always written, even next to warranty fields that are left out.
+    def test_other_fields_are_kept(self):
+        snow_dev = make_record('1')
+        snow_dev['u_end_of_life'] = '2030-01-01'
+        snow_dev['serial_number'] = 'NEW1'
+        self.assertNotIn('serial_number', snow_dev.original)
+        self.assertEqual(snow_dev.get_net_update({
+            'serial_number': 'NEW1', 'u_end_of_life': ''
+        }), {'serial_number': 'NEW1'})
+
+
+# Checks how staged updates are merged and handed out.
+class SnowChangeSetTest(unittest.TestCase):
+    def setUp(self):
+        self.snow_instance = script.SNOW_INSTANCES[0]
+        script.RUN_JOURNAL.clear(self.snow_instance)
+        self.change_set = script.SnowChangeSet()
+
+    # Updates staged for the same record by several stages are merged into
+    # one, the later value of a field winning.
+    def test_stages_are_merged(self):
+        snow_dev = make_record('1')
+        stage(self.change_set, snow_dev, {'u_valid_warranty_data': 'true',
+                                          'warranty_expiration': '2029'})
+        stage(self.change_set, snow_dev, {'warranty_expiration': '2030',
+                                          'u_end_of_life': '2031'})
+        self.assertEqual(self.change_set.pop([snow_dev]), [(snow_dev, {
+            'u_valid_warranty_data': 'true', 'warranty_expiration': '2030',
+            'u_end_of_life': '2031'
+        })])
+
+    # A record whose stages only changed fields back is left out, and the
+    # fields one stage changed back are dropped from the others' updates.
+    def test_no_op_changes_are_left_out(self):
+        changed_dev, unchanged_dev = make_record('1'), make_record('2')
+        stage(self.change_set, changed_dev, {'u_valid_warranty_data': 'true',
+                                             'warranty_expiration': '2030'})
+        stage(self.change_set, changed_dev, {'u_valid_warranty_data': ''})
+        stage(self.change_set, unchanged_dev, {'u_end_of_life': '2030'})
+        stage(self.change_set, unchanged_dev, {'u_end_of_life': ''})
+        self.assertEqual(
+            self.change_set.pop([changed_dev, unchanged_dev]),
+            [(changed_dev, {'warranty_expiration': '2030'})])
+
+    # Popped records are journaled: those with updates as pending, the rest
+    # (staged or not) as finished. They are no longer in the change set.
+    def test_pop_journals_records(self):
+        changed_dev, unchanged_dev = make_record('1'), make_record('2')
+        stage(self.change_set, changed_dev, {'u_end_of_life': '2030'})
+        self.change_set.pop([changed_dev, unchanged_dev])
+        self.assertEqual(script.RUN_JOURNAL.get_pending(self.snow_instance),
+                         [('1', 'ci-1', {'u_end_of_life': '2030'})])
+        self.assertEqual(script.RUN_JOURNAL.get_sys_ids(self.snow_instance),
+                         {'1', '2'})
+        self.assertEqual(self.change_set.pop([changed_dev]), [])
+
+    # Popping all of an instance's records hands out their net updates
+    # without journaling them, since their stages may not be done.
+    def test_pop_all(self):
+        changed_dev, unchanged_dev = make_record('1'), make_record('2')
+        stage(self.change_set, changed_dev, {'u_end_of_life': '2030'})
+        stage(self.change_set, unchanged_dev, {'u_end_of_life': '2030'})
+        stage(self.change_set, unchanged_dev, {'u_end_of_life': ''})
+        self.assertEqual(self.change_set.pop_all(self.snow_instance),
+                         [(changed_dev, {'u_end_of_life': '2030'})])
+        self.assertEqual(self.change_set.pop_all(self.snow_instance), [])
+        self.assertEqual(
+            script.RUN_JOURNAL.get_sys_ids(self.snow_instance), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
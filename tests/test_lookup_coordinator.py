@@ -0,0 +1,113 @@
+import functools
+import unittest
+
+from script_module import ScriptModule
+
+
+def setUpModule():
+    global script, script_module
+    script_module = ScriptModule()
+    script = script_module.load()
+
+
+def tearDownModule():
+    script_module.close()
+
+
+# Checks how the keys claimed by every pipeline are packed into batches.
+class LookupCoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        self.coordinator = script.LookupCoordinator({
+            'size': (3, None, 0),
+            'url': (10, 'http://x/', len('http://x/aaaa,bbbb'))
+        })
+
+    # A batch is handed out as soon as it holds the API's batch size.
+    def test_batch_size(self):
+        batches, flights = self.coordinator.claim('size', ['a', 'b'])
+        self.assertEqual((batches, len(flights)), ([], 2))
+        batches, _ = self.coordinator.claim('size', ['c', 'd'])
+        self.assertEqual(batches, [['a', 'b', 'c']])
+        self.assertEqual(list(self.coordinator.pending['size']), ['d'])
+
+    # A batch is handed out before the next key would make its request URL
+    # longer than the API takes, and that key starts the next batch.
+    def test_url_length(self):
+        batches, _ = self.coordinator.claim('url', ['aaaa', 'bbbb'])
+        self.assertEqual(batches, [])
+        batches, _ = self.coordinator.claim('url', ['cccc'])
+        self.assertEqual(batches, [['aaaa', 'bbbb']])
+        self.assertEqual(list(self.coordinator.pending['url']), ['cccc'])
+
+        # A key too long for any batch is still sent, on its own.
+        batches, _ = self.coordinator.claim('url', ['d' * 20, 'e'])
+        self.assertEqual(batches, [['cccc'], ['d' * 20]])
+
+    # A key claimed by several pipelines, such as those of different
+    # ServiceNow instances, is packed once and they all share its flight.
+    # The same key of another kind of lookup is a lookup of its own.
+    def test_keys_are_claimed_once(self):
+        _, first_flights = self.coordinator.claim('size', ['a', 'b'])
+        batches, second_flights = self.coordinator.claim('size', ['b', 'c'])
+        self.assertEqual(batches, [['a', 'b', 'c']])
+        self.assertIs(first_flights[1], second_flights[0])
+
+        _, other_flights = self.coordinator.claim('url', ['b'])
+        self.assertIsNot(other_flights[0], first_flights[1])
+
+    # A pipeline about to wait for its keys only takes out the pending
+    # batch if it holds any of them.
+    def test_flush(self):
+        self.coordinator.claim('size', ['a'])
+        self.assertEqual(self.coordinator.flush('size', ['b']), [])
+        self.assertEqual(self.coordinator.flush('url', ['a']), [])
+        self.assertEqual(self.coordinator.flush('size', ['b', 'a']), [['a']])
+        self.assertEqual(self.coordinator.flush('size', ['a']), [])
+
+    # Landing a batch answers every flight of its keys, and the keys can be
+    # claimed again afterwards.
+    def test_land(self):
+        _, flights = self.coordinator.claim('size', ['a', 'b', 'c'])
+        self.coordinator.land('size', ['a', 'b', 'c'], {'a': {'sn': 'a'}})
+        self.assertEqual([flight.result() for flight in flights],
+                         [{'sn': 'a'}, None, None])
+
+        batches, new_flights = self.coordinator.claim('size', ['a'])
+        self.assertIsNot(new_flights[0], flights[0])
+        error = RuntimeError('lookup failed')
+        self.coordinator.land('size', ['a'], {}, error)
+        self.assertIs(new_flights[0].exception(), error)
+
+
+# Checks that lookups of overlapping keys send each key once and both get
+# their answers.
+class VendorLookupTest(unittest.TestCase):
+    def setUp(self):
+        self.coordinator = script.LOOKUP_COORDINATOR
+        script.LOOKUP_COORDINATOR = script.LookupCoordinator({
+            'test-lookup': (3, None, 0)})
+        self.fetched = []
+
+    def tearDown(self):
+        script.LOOKUP_COORDINATOR = self.coordinator
+
+    # Answer the given batch with a response for each of its keys.
+    def fetch(self, batch: list[str]) -> dict[str, dict]:
+        self.fetched.append(batch)
+        return {key: {'sn': key} for key in batch}
+
+    def test_overlapping_lookups(self):
+        send = functools.partial(script.send_lookup_batch, 'test-lookup',
+                                 self.fetch, lambda answers: answers)
+        first = script.VendorLookup('test-lookup', ['a', 'b'], send)
+        second = script.VendorLookup('test-lookup', ['b', 'c', 'd'], send)
+        self.assertEqual(self.fetched, [['a', 'b', 'c']])
+
+        self.assertEqual(second.result(),
+                         [{'sn': 'b'}, {'sn': 'c'}, {'sn': 'd'}])
+        self.assertEqual(first.result(), [{'sn': 'a'}, {'sn': 'b'}])
+        self.assertEqual(self.fetched, [['a', 'b', 'c'], ['d']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+import asyncio
+import email.utils
+import time
+import unittest
+
+import requests
+
+from script_module import ScriptModule
+
+
+def setUpModule():
+    global script, script_module
+    script_module = ScriptModule(['Retry Info:max-retries=2',
+                                  'Retry Info:base-delay=0.01',
+                                  'Retry Info:max-delay=2'])
+    script = script_module.load()
+
+
+def tearDownModule():
+    script_module.close()
+
+
+# Return a response with the given status code and headers.
+def make_response(status_code: int,
+                  headers: dict[str, str] = None) -> requests.Response:
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.headers.update(headers or {})
+    return resp
+
+
+# A session that answers each request with the next of the given responses,
+# or raises it if it is an exception.
+class FakeSession:
+    def __init__(self, responses: list):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method: str, url: str, **kwargs):
+        self.calls += 1
+        resp = self.responses.pop(0)
+        if isinstance(resp, BaseException):
+            raise resp
+        return resp
+
+
+# An asyncio client that answers requests like FakeSession.
+class FakeAsyncClient(FakeSession):
+    async def request(self, method: str, url: str, **kwargs):
+        return super().request(method, url, **kwargs)
+
+
+# Checks how an endpoint's limits are cut when it throttles us and raised
+# while it doesn't.
+class EndpointLimiterTest(unittest.TestCase):
+    # Each throttled request halves the in-flight limit and the rate, down
+    # to one request in flight and a tenth of the configured rate.
+    def test_throttling_halves_limits(self):
+        limiter = script.EndpointLimiter(10, 8)
+        limiter.adjust(throttled=True)
+        self.assertEqual((limiter.in_flight_limit, limiter.rate), (4, 5))
+        limiter.adjust(throttled=True)
+        self.assertEqual((limiter.in_flight_limit, limiter.rate), (2, 2.5))
+        for _ in range(5):
+            limiter.adjust(throttled=True)
+        self.assertEqual((limiter.in_flight_limit, limiter.rate), (1, 1))
+
+    # The limits are raised a step once a window of requests in a row went
+    # through, up to the configured limits. A throttled request starts the
+    # count over.
+    def test_limits_recover(self):
+        limiter = script.EndpointLimiter(10, 8)
+        limiter.adjust(throttled=True)
+        for _ in range(3):
+            limiter.adjust(throttled=False)
+        self.assertEqual((limiter.in_flight_limit, limiter.rate), (4, 5))
+        limiter.adjust(throttled=False)
+        self.assertEqual((limiter.in_flight_limit, limiter.rate), (5, 6))
+
+        for _ in range(4):
+            limiter.adjust(throttled=False)
+        limiter.adjust(throttled=True)
+        limiter.adjust(throttled=False)
+        self.assertEqual((limiter.in_flight_limit, limiter.rate), (2, 3))
+
+        for _ in range(100):
+            limiter.adjust(throttled=False)
+        self.assertEqual((limiter.in_flight_limit, limiter.rate), (8, 10))
+
+    # Requests are paced to the rate after a one second burst, and a rate
+    # cut only slows down the requests reserved after it.
+    def test_reserve_paces_requests(self):
+        limiter = script.EndpointLimiter(2, 8)
+        delays = [limiter.reserve() for _ in range(3)]
+        for delay, expected in zip(delays, (0, 0, 0.5)):
+            self.assertAlmostEqual(delay, expected, delta=0.05)
+        limiter.adjust(throttled=True)
+        self.assertAlmostEqual(limiter.reserve(), 1.5, delta=0.05)
+        self.assertAlmostEqual(limiter.reserve(), 2.5, delta=0.05)
+
+    # An endpoint without a rate isn't paced, but a pause still holds it.
+    def test_reserve_without_rate(self):
+        limiter = script.EndpointLimiter(0, 8)
+        self.assertEqual([limiter.reserve() for _ in range(10)], [0] * 10)
+        limiter.pause(1)
+        self.assertAlmostEqual(limiter.reserve(), 1, delta=0.05)
+
+
+# Checks how long a response's Retry-After header asks us to wait.
+class RetryAfterTest(unittest.TestCase):
+    # Seconds are used as they are, within 0 and the longest retry delay.
+    def test_seconds(self):
+        for header, expected in (('1.5', 1.5), ('-3', 0), ('60', 2)):
+            with self.subTest(header=header):
+                self.assertEqual(script.get_retry_after(
+                    make_response(429, {'Retry-After': header})), expected)
+
+    # An HTTP date is waited for, within the longest retry delay.
+    def test_http_date(self):
+        for offset, expected in ((1, 1), (-10, 0), (600, 2)):
+            with self.subTest(offset=offset):
+                header = email.utils.formatdate(time.time() + offset,
+                                                usegmt=True)
+                self.assertAlmostEqual(script.get_retry_after(
+                    make_response(429, {'Retry-After': header})), expected,
+                    delta=1)
+
+    # A missing or unreadable header means there is nothing to wait for.
+    def test_unusable_header(self):
+        self.assertIsNone(script.get_retry_after(make_response(429)))
+        self.assertIsNone(script.get_retry_after(
+            make_response(429, {'Retry-After': 'soon'})))
+
+
+# Checks how requests are sent and retried through their endpoint's limiter.
+class RequestSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = script.EndpointLimiter(0, 1)
+        self.scheduler = script.RequestScheduler({'test': self.limiter})
+
+    # A throttled request waits as long as the endpoint asked and is sent
+    # again, with the endpoint's limits cut.
+    def test_throttled_request_is_retried(self):
+        session = FakeSession([make_response(429, {'Retry-After': '0.2'}),
+                               make_response(200)])
+        started = time.monotonic()
+        resp = self.scheduler.send('test', session, 'GET', 'http://test')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(session.calls, 2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(self.limiter.in_flight, 0)
+        self.assertGreater(self.limiter.paused_until, 0)
+
+    # The last response is returned once every retry failed.
+    def test_last_response_is_returned(self):
+        session = FakeSession([make_response(503)] * 3)
+        resp = self.scheduler.send('test', session, 'GET', 'http://test')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(session.calls, 3)
+
+    # Connection errors are retried, and raised once every retry failed.
+    # Either way the request slot is freed.
+    def test_connection_errors(self):
+        session = FakeSession([requests.ConnectionError(), make_response(200)])
+        resp = self.scheduler.send('test', session, 'GET', 'http://test')
+        self.assertEqual(resp.status_code, 200)
+
+        session = FakeSession([requests.ConnectionError()] * 3)
+        with self.assertRaises(requests.ConnectionError):
+            self.scheduler.send('test', session, 'GET', 'http://test')
+        self.assertEqual(self.limiter.in_flight, 0)
+
+    # Any other error raised while sending frees the request slot, so the
+    # next request to the endpoint doesn't wait for it forever.
+    def test_error_frees_slot(self):
+        session = FakeSession([RuntimeError('token fetch failed'),
+                               make_response(200)])
+        with self.assertRaises(RuntimeError):
+            self.scheduler.send('test', session, 'GET', 'http://test')
+        self.assertEqual(self.limiter.in_flight, 0)
+        resp = self.scheduler.send('test', session, 'GET', 'http://test')
+        self.assertEqual(resp.status_code, 200)
+
+    # The asyncio scheduler frees the request slot of a request that raised
+    # too.
+    def test_async_error_frees_slot(self):
+        if script.httpx is None:
+            self.skipTest('httpx is not installed')
+
+        async def send_twice():
+            limiter = script.AsyncEndpointLimiter(0, 1)
+            scheduler = script.AsyncRequestScheduler({'test': limiter})
+            client = FakeAsyncClient([RuntimeError('token fetch failed'),
+                                      make_response(200)])
+            with self.assertRaises(RuntimeError):
+                await scheduler.send('test', client, 'GET', 'http://test')
+            self.assertEqual(limiter.in_flight, 0)
+            resp = await asyncio.wait_for(
+                scheduler.send('test', client, 'GET', 'http://test'), 5)
+            self.assertEqual(resp.status_code, 200)
+
+        asyncio.run(send_twice())
+
+
+if __name__ == '__main__':
+    unittest.main()
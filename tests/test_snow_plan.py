@@ -0,0 +1,123 @@
+import json
+import unittest
+
+from script_module import ScriptModule
+
+
+def setUpModule():
+    global script, script_module
+    script_module = ScriptModule(cmdb_size=10)
+    script = script_module.load()
+
+
+def tearDownModule():
+    script_module.close()
+
+
+# Checks how a saved plan is read and written back.
+class SnowPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.snow_instance = script.SNOW_INSTANCES[0]
+        self.cmdb = script_module.services.cmdb
+        self.cmdb.updates.clear()
+        self.plan_path = script_module.work_path + '/plan.jsonl'
+
+    # Save a plan with the given lines, each a planned update or a line of
+    # text as it is.
+    def write_plan(self, lines: list):
+        with open(self.plan_path, 'w') as plan_file:
+            for line in lines:
+                if not isinstance(line, str):
+                    line = json.dumps(line)
+                plan_file.write(line + '\n')
+
+    # Return a planned update of the test instance's CI at the given index.
+    def planned(self, index: int, snow_update: dict[str, str]) -> dict:
+        return {'instance': self.snow_instance.name,
+                'sys_id': self.cmdb.sys_id(index),
+                'name': 'ci%07d' % index, 'updates': snow_update}
+
+    # Updates planned for the same record are merged in the order they were
+    # planned. Blank lines are skipped, and so are updates for instances
+    # that aren't configured.
+    def test_duplicate_sys_ids_are_merged(self):
+        self.write_plan([
+            self.planned(1, {'u_valid_warranty_data': 'true',
+                             'warranty_expiration': '2029-01-01'}),
+            self.planned(2, {'u_end_of_life': '2030-01-01'}),
+            '',
+            dict(self.planned(1, {'u_end_of_life': '2031-01-01'}),
+                 instance='elsewhere'),
+            self.planned(1, {'warranty_expiration': '2030-01-01'})
+        ])
+        plan = script.load_snow_plan(self.plan_path, [self.snow_instance])
+        self.assertEqual(
+            [(snow_dev['sys_id'], snow_dev['name'], snow_update)
+             for snow_dev, snow_update in plan[self.snow_instance]],
+            [(self.cmdb.sys_id(1), 'ci0000001', {
+                'u_valid_warranty_data': 'true',
+                'warranty_expiration': '2030-01-01'
+            }), (self.cmdb.sys_id(2), 'ci0000002', {
+                'u_end_of_life': '2030-01-01'
+            })])
+
+    # A plan saved by SnowPlan reads back as the updates it was given.
+    def test_saved_plan_reads_back(self):
+        snow_dev = script.get_bare_snow_record(
+            self.snow_instance, self.cmdb.sys_id(3), 'ci0000003')
+        snow_plan = script.SnowPlan()
+        snow_plan.open(self.plan_path)
+        snow_plan.add([(snow_dev, {'u_end_of_life': '2030-01-01'})])
+        snow_plan.close()
+        plan = script.load_snow_plan(self.plan_path, [self.snow_instance])
+        self.assertEqual(
+            [(planned_dev['sys_id'], snow_update)
+             for planned_dev, snow_update in plan[self.snow_instance]],
+            [(snow_dev['sys_id'], {'u_end_of_life': '2030-01-01'})])
+
+    # A line that isn't a planned update turns the plan down, naming the
+    # line.
+    def test_malformed_lines_are_rejected(self):
+        good = self.planned(1, {'u_end_of_life': '2030-01-01'})
+        for bad in ('{"instance":', '[1, 2]', 'null',
+                    {key: value for key, value in good.items()
+                     if key != 'sys_id'},
+                    dict(good, instance=1),
+                    dict(good, updates=['u_end_of_life']),
+                    dict(good, updates={'u_end_of_life': None})):
+            with self.subTest(bad=bad):
+                self.write_plan([good, bad])
+                with self.assertRaisesRegex(ValueError, '^line 2: '):
+                    script.load_snow_plan(self.plan_path,
+                                          [self.snow_instance])
+
+    # A plan with a malformed line is not written back at all, not even
+    # the updates before it.
+    def test_malformed_plan_is_not_applied(self):
+        self.write_plan([self.planned(1, {'u_end_of_life': '2030-01-01'}),
+                         'not a planned update'])
+        self.assertFalse(script.apply_snow_plan(self.plan_path,
+                                                [self.snow_instance]))
+        self.assertEqual(self.cmdb.updates, {})
+        self.assertFalse(script.apply_snow_plan(
+            self.plan_path + '.missing', [self.snow_instance]))
+
+    # Applying a plan writes each record's merged updates back once.
+    def test_plan_is_applied(self):
+        self.write_plan([
+            self.planned(1, {'u_valid_warranty_data': 'true',
+                             'warranty_expiration': '2029-01-01'}),
+            self.planned(2, {'u_end_of_life': '2030-01-01'}),
+            self.planned(1, {'warranty_expiration': '2030-01-01'})
+        ])
+        self.assertTrue(script.apply_snow_plan(self.plan_path,
+                                               [self.snow_instance]))
+        self.assertEqual(sorted(self.cmdb.updates), [1, 2])
+        self.assertEqual([self.cmdb.get(1, field) for field in (
+            'u_valid_warranty_data', 'warranty_expiration', 'u_end_of_life'
+        )], ['true', '2030-01-01', ''])
+        self.assertEqual(self.cmdb.get(2, 'u_end_of_life'), '2030-01-01')
+
+
+if __name__ == '__main__':
+    unittest.main()
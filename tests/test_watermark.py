@@ -0,0 +1,77 @@
+import calendar
+import unittest
+
+from script_module import ScriptModule
+
+
+def setUpModule():
+    global script, script_module
+    script_module = ScriptModule(['Run Info:mode=incremental',
+                                  'Run Info:watermark-margin=90'])
+    script = script_module.load()
+
+
+def tearDownModule():
+    script_module.close()
+
+
+# The local start time of the runs below, 2026-10-17 12:00:00 UTC.
+RUN_START = calendar.timegm((2026, 10, 17, 12, 0, 0))
+
+
+# Checks the watermark an incremental run leaves for the next one.
+class NextWatermarkTest(unittest.TestCase):
+    # The first CMDB response's 'Date' header is when the run started, in
+    # UTC, less the margin. Later responses don't move it.
+    def test_server_date(self):
+        self.assertEqual(script.get_next_watermark([
+            'Sat, 17 Oct 2026 10:00:00 GMT', 'Sat, 17 Oct 2026 10:05:00 GMT'
+        ], RUN_START), '2026-10-17 09:58:30')
+        self.assertEqual(script.get_next_watermark(
+            ['Sat, 17 Oct 2026 10:00:00 +0200'], RUN_START),
+            '2026-10-17 07:58:30')
+
+    # The margin can reach back past midnight.
+    def test_margin_crosses_day(self):
+        self.assertEqual(script.get_next_watermark(
+            ['Sun, 18 Oct 2026 00:00:30 GMT'], RUN_START),
+            '2026-10-17 23:59:00')
+
+    # A run that got no CMDB response, or no usable 'Date' header, falls
+    # back on its local start time.
+    def test_no_usable_date(self):
+        for server_dates in ([], [None], [''], ['yesterday']):
+            with self.subTest(server_dates=server_dates):
+                self.assertEqual(
+                    script.get_next_watermark(server_dates, RUN_START),
+                    '2026-10-17 11:58:30')
+
+
+# Checks the queries an incremental run reads the CMDB with.
+class RunQueriesTest(unittest.TestCase):
+    def setUp(self):
+        self.snow_instance = script.SNOW_INSTANCES[0]
+        self.snow_query = script.get_snow_supported_query()
+
+    # A run without a watermark reads every record.
+    def test_first_run_is_full(self):
+        self.assertTrue(script.is_full_run({}))
+        self.assertEqual(list(script.get_snow_run_queries(
+            self.snow_instance, self.snow_query, {})),
+            [str(self.snow_query)])
+
+    # Records updated at the very second of the watermark, such as several
+    # saved together as the last run started, are read again rather than
+    # skipped.
+    def test_watermark_is_inclusive(self):
+        run_queries = script.get_snow_run_queries(
+            self.snow_instance, self.snow_query,
+            {'watermark': '2026-10-17 11:58:30'})
+        self.assertFalse(script.is_full_run(
+            {'watermark': '2026-10-17 11:58:30'}))
+        self.assertEqual(next(run_queries), str(self.snow_query) +
+                         '^sys_updated_on>=2026-10-17 11:58:30')
+
+
+if __name__ == '__main__':
+    unittest.main()
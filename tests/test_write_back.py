@@ -0,0 +1,115 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'benchmarks'))
+
+from mock_services import MANUFACTURERS, MockCmdb, MockServices  # noqa: E402
+from run_benchmark import REPO_PATH, run_script, write_config  # noqa: E402
+
+
+# Mock services whose first ServiceNow Batch API request fails with a 400.
+class FirstBatchFailingServices(MockServices):
+    def admit(self, api_name: str) -> int:
+        status_code = super().admit(api_name)
+        if api_name == 'snow-batch' and self.calls[api_name] == 1:
+            return 400
+        return status_code
+
+
+# A mock CMDB whose first Dell CI is deleted once the script has read it, so
+# writing it back finds no record.
+class DeletedCiCmdb(MockCmdb):
+    def __init__(self, size: int):
+        super().__init__(size)
+        self.deleted_sys_id = self.sys_id(next(
+            index for index, manufacturer in enumerate(self.manufacturers)
+            if MANUFACTURERS[manufacturer].startswith('Dell') and
+            len(self.serials[index]) == 7))
+
+    def index(self, sys_id: str) -> int:
+        if sys_id == self.deleted_sys_id:
+            return None
+        return super().index(sys_id)
+
+
+# Runs the script against the mock services with a bulk write that fails.
+class WriteBackFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.services = FirstBatchFailingServices(MockCmdb(400),
+                                                  latency=0.002)
+        self.services.start()
+        self.work_path = tempfile.mkdtemp(prefix='diko-test-')
+        shutil.copytree(REPO_PATH + '/src', self.work_path + '/src',
+                        ignore=shutil.ignore_patterns('__pycache__'))
+
+    def tearDown(self):
+        self.services.shutdown()
+        self.services.server_close()
+        shutil.rmtree(self.work_path, ignore_errors=True)
+
+    # A batch that fails on an interval flush fails the run, and its updates
+    # are left in the run journal for --resume.
+    def test_failed_interval_flush_fails_run(self):
+        write_config(self.work_path, self.services, [
+            'ServiceNow Info:bulk-flush-size=1000',
+            'ServiceNow Info:bulk-flush-interval=0.05'
+        ])
+        stats = run_script(self.work_path, ['--engine', 'threads'],
+                           self.work_path + '/run.log')
+        self.assertNotEqual(stats['exit_code'], 0)
+
+        journal = sqlite3.connect(
+            self.work_path + '/cache/2022-DIKO-Project-journal.sqlite3')
+        pending = journal.execute(
+            'SELECT COUNT(*) FROM journal_pending').fetchone()[0]
+        journal.close()
+        self.assertGreater(pending, 0)
+        self.assertFalse(os.path.exists(
+            self.work_path + '/cache/2022-DIKO-Project-state.json'))
+
+
+# Runs the script against the mock services with a CI deleted before its
+# bulk write.
+class WriteBackMissingRecordTest(unittest.TestCase):
+    def setUp(self):
+        self.services = MockServices(DeletedCiCmdb(400), latency=0.002)
+        self.services.start()
+        self.work_path = tempfile.mkdtemp(prefix='diko-test-')
+        shutil.copytree(REPO_PATH + '/src', self.work_path + '/src',
+                        ignore=shutil.ignore_patterns('__pycache__'))
+
+    def tearDown(self):
+        self.services.shutdown()
+        self.services.server_close()
+        shutil.rmtree(self.work_path, ignore_errors=True)
+
+    # A record that is gone by the time it is written back is reported and
+    # journaled as done, on either engine, so it fails neither the run nor
+    # a --resume of it.
+    def test_missing_record_does_not_fail_run(self):
+        write_config(self.work_path, self.services, [])
+        for engine in ('threads', 'asyncio'):
+            with self.subTest(engine=engine):
+                stats = run_script(self.work_path, ['--engine', engine],
+                                   self.work_path + '/' + engine + '.log')
+                self.assertEqual(stats['exit_code'], 0)
+                with open(self.work_path + '/' + engine + '.log') as log:
+                    self.assertIn('Record could not be found!', log.read())
+
+                journal = sqlite3.connect(self.work_path + '/cache/'
+                                          '2022-DIKO-Project-journal.sqlite3')
+                pending = journal.execute(
+                    'SELECT COUNT(*) FROM journal_pending').fetchone()[0]
+                journal.close()
+                self.assertEqual(pending, 0)
+                self.assertTrue(os.path.exists(
+                    self.work_path + '/cache/2022-DIKO-Project-state.json'))
+
+
+if __name__ == '__main__':
+    unittest.main()